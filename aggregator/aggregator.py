@@ -1,14 +1,401 @@
-from fastapi import FastAPI, Request, HTTPException, UploadFile, Form
-from typing import Dict, Tuple
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
 import numpy as np
+import scipy.sparse as sp
+import asyncio
+import hashlib
 import io
+import os
+import tempfile
 import time
+import uuid
 
-app = FastAPI(title="Aggregator Microservice")
+from common.common_utils import (FRAME_CONTENT_TYPE, SSE_HEARTBEAT_SEC, SSE_MIN_INTERVAL_SEC, array_nbytes,
+                                 decode_frame, encode_frame, is_sparse, merge_stats, npy_header,
+                                 parse_range, sse_event, tile_shard)
+from block_log import BlockLog
 
 # Job storage
 jobs: Dict[str, Dict] = {}
 
+# Bytes per chunk when streaming a result download
+RESULT_CHUNK_BYTES = 8 * 1024 * 1024
+
+# Sparse jobs keep their tiles as CSR until the stored nonzeros exceed
+# this fraction of the area of the tiles received so far
+SPARSE_MAX_FILL = float(os.environ.get("AGGREGATOR_SPARSE_MAX_FILL", 0.3))
+
+# Results of jobs initialised with out_of_core, or larger than
+# IN_MEMORY_MAX_BYTES, are accumulated in a .npy memmap under RESULT_DIR
+# (on a shard: its dense tiles, when its share of C is that large)
+IN_MEMORY_MAX_BYTES = int(os.environ.get("AGGREGATOR_IN_MEMORY_MAX_BYTES", 1024 * 1024 * 1024))
+RESULT_DIR = os.environ.get("AGGREGATOR_RESULT_DIR",
+                            os.path.join(tempfile.gettempdir(), "aggregator_results"))
+
+# Jobs are dropped JOB_TTL_SEC after they finish (or after their last
+# block, if they never do). Jobs share MEMORY_BUDGET_BYTES of RAM: when it
+# is exceeded finished results spill to memmaps, and /init_job answers 429
+# if a new job still would not fit.
+JOB_TTL_SEC = float(os.environ.get("AGGREGATOR_JOB_TTL_SEC", 3600))
+MEMORY_BUDGET_BYTES = int(os.environ.get("AGGREGATOR_MEMORY_BUDGET_BYTES", 2 * 1024 * 1024 * 1024))
+REAP_INTERVAL_SEC = 10.0
+jobs_evicted = 0
+results_spilled = 0
+
+# With AGGREGATOR_DATA_DIR set every job keeps an append-only block log
+# there (see block_log.py) and a restarted aggregator replays the logs to
+# recover its jobs. A log is compacted into a snapshot of the job's tiles
+# when the job finishes, and when it grows past LOG_COMPACT_RATIO times
+# the size of that snapshot (and LOG_COMPACT_MIN_BYTES).
+DATA_DIR = os.environ.get("AGGREGATOR_DATA_DIR")
+LOG_FSYNC = os.environ.get("AGGREGATOR_LOG_FSYNC", "false").lower() in ("1", "true", "yes")
+LOG_COMPACT_RATIO = float(os.environ.get("AGGREGATOR_LOG_COMPACT_RATIO", 2.0))
+LOG_COMPACT_MIN_BYTES = int(os.environ.get("AGGREGATOR_LOG_COMPACT_MIN_BYTES", 16 * 1024 * 1024))
+logs_compacted = 0
+
+
+async def reap_jobs():
+    while True:
+        await asyncio.sleep(REAP_INTERVAL_SEC)
+        try:
+            evict_expired()
+            spill_results(memory_used() - MEMORY_BUDGET_BYTES)
+            for job in unique_jobs():
+                if job["log"] is not None and job["log"].size > log_limit(job):
+                    compact_job(job)
+        except Exception as e:
+            print(f"❌ Job reaper error: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if DATA_DIR:
+        recover_jobs()
+    reaper = asyncio.create_task(reap_jobs())
+    yield
+    reaper.cancel()
+
+
+app = FastAPI(title="Aggregator Microservice", lifespan=lifespan)
+
+
+def tile_slices(job: Dict, i: int, j: int) -> Tuple[slice, slice]:
+    """Return the (rows, cols) slices of C covered by output tile (i, j)."""
+    br, bc = job["tile_shape"]
+    return slice(i * br, (i + 1) * br), slice(j * bc, (j + 1) * bc)
+
+
+def tile_extent(job: Dict, i: int, j: int) -> Tuple[int, int]:
+    """Return the shape of output tile (i, j) (edge tiles may be smaller)."""
+    rows, cols = tile_slices(job, i, j)
+    return (len(range(*rows.indices(job["shape"][0]))),
+            len(range(*cols.indices(job["shape"][1]))))
+
+
+def allocate_result(job: Dict, dtype):
+    """Allocate the zeroed dense C of a job, in RAM or as a .npy memmap."""
+    shape = job["shape"]
+    nbytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    if not job["out_of_core"] and nbytes <= IN_MEMORY_MAX_BYTES:
+        return np.zeros(shape, dtype=dtype)
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    path = os.path.join(RESULT_DIR, f"C_{uuid.uuid4().hex}.npy")
+    print(f"💾 Job {job['job_id']}: accumulating the {nbytes / 1e6:.1f} MB result in {path}")
+    job["result_path"] = path
+    # The file is created sparse, so untouched (all-zero) tiles take no disk
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+def job_bytes(job: Dict) -> int:
+    """RAM held by a job: its C (unless memory-mapped), CSR tiles and bookkeeping."""
+    nbytes = job["seen"].nbytes + job["tile_counts"].nbytes + job["tile_expected"].nbytes
+    if job["tiles"] is not None:
+        # A shard's out-of-core tiles are views into its memmap
+        nbytes += sum(array_nbytes(tile) for tile in job["tiles"].values() if not isinstance(tile, np.memmap))
+    if job["C"] is not None and not isinstance(job["C"], np.memmap):
+        nbytes += array_nbytes(job["C"])
+    return nbytes
+
+
+def projected_bytes(job: Dict) -> int:
+    """RAM a job will need once its result is complete."""
+    if job["final"] is not None:
+        return job_bytes(job)
+    if job["owned"] is not None:
+        in_memmap = shard_out_of_core(job)
+    else:
+        in_memmap = (job["out_of_core"] or isinstance(job["C"], np.memmap)
+                     or dense_bytes(job) > IN_MEMORY_MAX_BYTES)
+    if in_memmap:
+        # Accumulated in a memmap (see allocate_result)
+        reserved = 0
+    else:
+        reserved = dense_bytes(job)
+        if job["sparse"]:
+            # CSR up to the fill-in at which the job (or tile) turns dense
+            itemsize = (job["dtype"] or np.dtype(np.float64)).itemsize
+            reserved = int(reserved * SPARSE_MAX_FILL * (itemsize + 4) / itemsize)
+        if job["owned"] is not None:
+            reserved = int(reserved * job["owned"].mean())
+    return max(reserved, job_bytes(job))
+
+
+def dense_bytes(job: Dict) -> int:
+    return job["shape"][0] * job["shape"][1] * (job["dtype"] or np.dtype(np.float64)).itemsize
+
+
+def shard_out_of_core(job: Dict) -> bool:
+    """Whether a shard keeps its dense tiles in a memmap of C rather than in RAM."""
+    return job["out_of_core"] or dense_bytes(job) * job["owned"].mean() > IN_MEMORY_MAX_BYTES
+
+
+def unique_jobs():
+    """Every job once (attached job ids share their job's state)."""
+    return list({id(job): job for job in jobs.values()}.values())
+
+
+def memory_used() -> int:
+    return sum(projected_bytes(job) for job in unique_jobs())
+
+
+def spill_results(excess: int) -> int:
+    """
+    Move finished dense results from RAM into memmap files under
+    RESULT_DIR, oldest first, until `excess` bytes are freed. Returns the
+    bytes freed.
+    """
+    global results_spilled
+    freed = 0
+    finished = sorted((job for job in unique_jobs()
+                       if job["final"] is not None and (type(job["C"]) is np.ndarray
+                                                        or job["owned"] is not None and ram_tiles(job))),
+                      key=lambda job: job["finished_at"])
+    for job in finished:
+        if freed >= excess:
+            break
+        if job["owned"] is not None:
+            freed += spill_shard(job)
+            results_spilled += 1
+            continue
+        C = job["C"]
+        os.makedirs(RESULT_DIR, exist_ok=True)
+        path = os.path.join(RESULT_DIR, f"C_{uuid.uuid4().hex}.npy")
+        spilled = np.lib.format.open_memmap(path, mode="w+", dtype=C.dtype, shape=C.shape)
+        rows = max(1, RESULT_CHUNK_BYTES // max(1, C.shape[1] * C.dtype.itemsize))
+        for start in range(0, C.shape[0], rows):
+            spilled[start:start + rows] = C[start:start + rows]
+        spilled.flush()
+        job["C"], job["result_path"] = np.load(path, mmap_mode="r"), path
+        freed += C.nbytes
+        results_spilled += 1
+        print(f"💾 Spilled the {C.nbytes / 1e6:.1f} MB result of job {job['job_id']} to {path}")
+    return freed
+
+
+def ram_tiles(job: Dict) -> List[Tuple[int, int]]:
+    """The dense tiles of a shard's job held in RAM."""
+    return [key for key, tile in job["tiles"].items() if type(tile) is np.ndarray]
+
+
+def spill_shard(job: Dict) -> int:
+    """Move a finished shard's dense tiles into a memmap of C (see accumulate_tile); returns the bytes freed."""
+    keys = ram_tiles(job)
+    if job["C"] is None:
+        job["out_of_core"] = True
+        job["C"] = allocate_result(job, job["dtype"] or job["tiles"][keys[0]].dtype)
+    freed = 0
+    for i, j in keys:
+        rows, cols = tile_slices(job, i, j)
+        tile = job["C"][rows, cols]
+        tile[...] = job["tiles"][(i, j)]
+        freed += tile.nbytes
+        job["tiles"][(i, j)] = tile
+    job["C"].flush()
+    print(f"💾 Spilled {freed / 1e6:.1f} MB of tiles of job {job['job_id']} to {job['result_path']}")
+    return freed
+
+
+def drop_job(job: Dict):
+    """Forget a job (and the ids attached to it) and delete its result file and log."""
+    global jobs_evicted
+    for job_id in [job_id for job_id, other in jobs.items() if other is job]:
+        del jobs[job_id]
+    if job["log"] is not None:
+        job["log"].delete()
+    if job["result_path"]:
+        try:
+            os.remove(job["result_path"])
+        except FileNotFoundError:
+            pass
+    jobs_evicted += 1
+
+
+def evict_expired():
+    now = time.monotonic()
+    for job in unique_jobs():
+        last_active = job["finished_at"] if job["final"] is not None else job["touched"]
+        if now - last_active > JOB_TTL_SEC:
+            print(f"🧹 Dropping job {job['job_id']} "
+                  f"({'finished' if job['final'] is not None else 'idle'} for {now - last_active:.0f}s)")
+            drop_job(job)
+
+
+def admit(job: Dict):
+    """
+    Make room for a new job within MEMORY_BUDGET_BYTES, spilling finished
+    results if needed; raises 429 if it still does not fit. A job that
+    could never fit on its own accumulates its result in a memmap.
+    """
+    needed = projected_bytes(job)
+    if needed > MEMORY_BUDGET_BYTES:
+        job["out_of_core"] = True
+        needed = projected_bytes(job)
+    evict_expired()
+    excess = memory_used() + needed - MEMORY_BUDGET_BYTES
+    if excess > 0 and spill_results(excess) < excess:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Aggregator memory budget exhausted ({memory_used() / 1e6:.1f} of "
+                   f"{MEMORY_BUDGET_BYTES / 1e6:.1f} MB in use, job needs {needed / 1e6:.1f} MB)",
+            headers={"Retry-After": str(int(REAP_INTERVAL_SEC))}
+        )
+
+
+def log_path(job_id: str) -> str:
+    return os.path.join(DATA_DIR, f"{hashlib.sha1(job_id.encode()).hexdigest()}.log")
+
+
+def init_record(job: Dict):
+    """The log record that recreates a job with new_job."""
+    meta = {
+        "type": "init",
+        "job_id": job["job_id"],
+        "shape": list(job["shape"]),
+        "tile_shape": list(job["tile_shape"]),
+        "dtype": job["dtype"].str if job["dtype"] else None,
+        "blocks_expected": job["blocks_expected"],
+        "sparse": job["sparse"],
+        "out_of_core": job["out_of_core"],
+    }
+    arrays = {"a_occ": job["a_occ"].astype(np.uint8), "b_occ": job["b_occ"].astype(np.uint8)}
+    if job["owned"] is not None:
+        arrays["owned"] = job["owned"].astype(np.uint8)
+    return meta, arrays
+
+
+def open_log(job: Dict):
+    """Start the block log of a new job (replacing any stale log of its id)."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    job["log"] = BlockLog(log_path(job["job_id"]), fsync=LOG_FSYNC)
+    job["log"].rewrite([init_record(job)])
+
+
+def tile_data(job: Dict, i: int, j: int):
+    """The accumulated tile (i, j) of a job (None before its first partial)."""
+    if job["tiles"] is not None:
+        return job["tiles"].get((i, j))
+    if job["C"] is None:
+        return None
+    rows, cols = tile_slices(job, i, j)
+    return job["C"][rows, cols]
+
+
+def snapshot_records(job: Dict):
+    """
+    Log records recreating the job as it stands: init, one record per
+    started tile with its sum so far and the k's it holds, the worker
+    times and the ids attached to the job.
+    """
+    yield init_record(job)
+    for i, j in np.argwhere(job["tile_counts"] > 0):
+        i, j = int(i), int(j)
+        ks = np.flatnonzero(np.unpackbits(job["seen"][i, j], bitorder="little")).tolist()
+        yield {"type": "tile", "i": i, "j": j, "ks": ks}, {"C": tile_data(job, i, j)}
+    yield {"type": "times"}, {"worker_times": np.asarray(job["worker_times"], dtype=np.float64)}
+    for job_id, other in list(jobs.items()):
+        if other is job and job_id != job["job_id"]:
+            yield {"type": "alias", "job_id": job_id}, None
+
+
+def log_limit(job: Dict) -> float:
+    """Log size past which the job's log is compacted (see LOG_COMPACT_RATIO)."""
+    if job["tiles"] is not None:
+        snapshot = sum(array_nbytes(tile) for tile in job["tiles"].values())
+    else:
+        snapshot = dense_bytes(job) * np.count_nonzero(job["tile_counts"]) / job["tile_counts"].size
+    return max(LOG_COMPACT_MIN_BYTES, LOG_COMPACT_RATIO * snapshot)
+
+
+def compact_job(job: Dict):
+    """Replace a job's block log with a snapshot of its state."""
+    global logs_compacted
+    before = job["log"].size
+    job["log"].rewrite(snapshot_records(job))
+    logs_compacted += 1
+    print(f"🗜️ Compacted the log of job {job['job_id']}: "
+          f"{before / 1e6:.1f} MB → {job['log'].size / 1e6:.1f} MB")
+
+
+def replay_log(path: str) -> Optional[Dict]:
+    """Rebuild a job from its block log and register it; None if the log has no job."""
+    job = None
+    for meta, arrays in BlockLog.replay(path):
+        kind = meta["type"]
+        if kind == "init":
+            owned = arrays.get("owned")
+            job = new_job(meta["job_id"], meta["shape"], meta["tile_shape"], meta["dtype"],
+                          arrays["a_occ"].astype(bool), arrays["b_occ"].astype(bool),
+                          meta["blocks_expected"], sparse=meta["sparse"],
+                          out_of_core=meta["out_of_core"],
+                          owned=owned.astype(bool) if owned is not None else None)
+            jobs[job["job_id"]] = job
+        elif job is None:
+            break
+        elif kind in ("block", "tile"):
+            i, j = meta["i"], meta["j"]
+            ks = [meta["k"]] if kind == "block" else meta["ks"]
+            seen = job["seen"][i, j]
+            if any(seen[k >> 3] & (1 << (k & 7)) for k in ks):
+                continue
+            times = [meta["worker_time_sec"]] if kind == "block" else []
+            apply_partial(job["job_id"], job, i, j, ks, times, arrays["C"])
+        elif kind == "times":
+            job["worker_times"] = arrays["worker_times"].tolist()
+        elif kind == "alias":
+            jobs.setdefault(meta["job_id"], job)
+    return job
+
+
+def recover_jobs():
+    """Replay the block logs under DATA_DIR (on startup)."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for name in sorted(os.listdir(DATA_DIR)):
+        path = os.path.join(DATA_DIR, name)
+        if name.endswith(".compact"):
+            # Compaction was interrupted; the log it was replacing is intact
+            os.remove(path)
+            continue
+        if not name.endswith(".log"):
+            continue
+        try:
+            job = replay_log(path)
+        except Exception as e:
+            print(f"❌ Could not replay block log {path}: {e}")
+            continue
+        if job is None:
+            os.remove(path)
+            continue
+        job["log"] = BlockLog(path, fsync=LOG_FSYNC)
+        if job["final"] is None and job["received"] == job["blocks_expected"]:
+            finalize_job(job["job_id"], job)
+        elif job["log"].size > log_limit(job):
+            compact_job(job)
+        print(f"♻️ Recovered job {job['job_id']} from its block log "
+              f"[{job['received']}/{job['blocks_expected']}]")
+
+
 @app.post("/init_job")
 async def init_job(request: Request):
     data = await request.json()
@@ -16,10 +403,35 @@ async def init_job(request: Request):
     blocks_expected = data.get("blocks_expected")
     block_rows = data.get("block_rows")
     block_cols = data.get("block_cols")
+    block_depth = data.get("block_depth")
+    shape = data.get("shape")
+    tile_shape = data.get("tile_shape")
+    dtype = data.get("dtype")
+    a_occupancy = data.get("a_occupancy")
+    b_occupancy = data.get("b_occupancy")
+    alias_of = data.get("alias_of")
+    shard = data.get("shard")
 
     if not job_id:
         raise HTTPException(status_code=400, detail="Missing job_id")
 
+    if alias_of is not None:
+        # An identical job: share the other job's result (finished or not)
+        if alias_of not in jobs:
+            raise HTTPException(status_code=404, detail=f"Job {alias_of} not found")
+        if job_id not in jobs:
+            jobs[job_id] = jobs[alias_of]
+            if jobs[alias_of]["log"] is not None:
+                jobs[alias_of]["log"].append({"type": "alias", "job_id": job_id})
+        print(f"♻️ Job {job_id} attached to job {alias_of}")
+        return {"message": f"Job {job_id} attached to {alias_of}", "expected": jobs[alias_of]["blocks_expected"]}
+
+    if not shape or not tile_shape or not block_depth:
+        raise HTTPException(
+            status_code=400,
+            detail="init_job requires shape, tile_shape and block_depth"
+        )
+
     if job_id in jobs:
         # Job already initialized - return existing info
         print(f"⚠️ Job {job_id} already initialized, returning existing configuration")
@@ -28,105 +440,518 @@ async def init_job(request: Request):
             "expected": jobs[job_id]["blocks_expected"]
         }
 
-    jobs[job_id] = {
-        "results": {},  # key: (i,j,k) -> value: A[i,k] × B[k,j]
+    # The splitter skips (i,j,k) where A[i,k] or B[k,j] is all zero and
+    # sends the tile occupancy of both operands; the expected set is
+    # a_occupancy[i,k] & b_occupancy[k,j]. Without it every k is expected.
+    if a_occupancy is not None and b_occupancy is not None:
+        a_occ = np.asarray(a_occupancy, dtype=bool).reshape(block_rows, block_depth)
+        b_occ = np.asarray(b_occupancy, dtype=bool).reshape(block_depth, block_cols)
+    else:
+        a_occ = np.ones((block_rows, block_depth), dtype=bool)
+        b_occ = np.ones((block_depth, block_cols), dtype=bool)
+    tile_expected = a_occ.astype(np.int32) @ b_occ.astype(np.int32)
+
+    if blocks_expected is None:
+        blocks_expected = int(tile_expected.sum())
+    elif blocks_expected != int(tile_expected.sum()):
+        raise HTTPException(
+            status_code=400,
+            detail=f"blocks_expected={blocks_expected} does not match the occupancy "
+                   f"({int(tile_expected.sum())} blocks)"
+        )
+
+    owned = None
+    if shard is not None:
+        # This aggregator is shard shard["index"] of shard["count"] and
+        # only accumulates the tiles routed to it
+        owned = np.array([[tile_shard(job_id, i, j, shard["count"]) == shard["index"]
+                           for j in range(block_cols)] for i in range(block_rows)], dtype=bool)
+        blocks_expected = int(tile_expected[owned].sum())
+
+    job = new_job(job_id, shape, tile_shape, dtype, a_occ, b_occ, blocks_expected,
+                  sparse=data.get("sparse"), out_of_core=data.get("out_of_core"), owned=owned)
+    admit(job)
+    if DATA_DIR:
+        open_log(job)
+    jobs[job_id] = job
+
+    print(f"✅ Initialized job {job_id} expecting {blocks_expected} blocks")
+    if blocks_expected == 0:
+        # A or B is all zero, nothing will be submitted
+        finalize_job(job_id, job)
+    return {"message": f"Job {job_id} initialized", "expected": blocks_expected}
+
+
+def new_job(job_id, shape, tile_shape, dtype, a_occ, b_occ, blocks_expected,
+            sparse=False, out_of_core=False, owned=None) -> Dict:
+    """
+    Fresh state of a job expecting the (i,j,k) partials a_occ[i,k] &
+    b_occ[k,j], restricted to the tiles in `owned` on a shard.
+    """
+    block_rows, block_depth = a_occ.shape
+    block_cols = b_occ.shape[1]
+    tile_expected = a_occ.astype(np.int32) @ b_occ.astype(np.int32)
+    if owned is not None:
+        tile_expected[~owned] = 0
+    return {
+        "job_id": job_id,
+        # C is allocated when the first partial arrives and every later
+        # A[i,k] × B[k,j] is added into its tile in place.
+        "C": None,
+        "shape": tuple(shape),
+        "tile_shape": tuple(tile_shape),
+        "dtype": np.dtype(dtype) if dtype else None,
+        # Dense C is memory-mapped from result_path for out-of-core jobs
+        "out_of_core": bool(out_of_core),
+        "result_path": None,
+        # Sparse jobs accumulate CSR tiles here (and nonzeros/area of the
+        # stored tiles) until the fill-in makes a dense C cheaper; shards
+        # keep every tile they own here and never build C
+        "sparse": bool(sparse),
+        "owned": owned,
+        "tiles": {} if sparse or owned is not None else None,
+        "nnz": 0,
+        "tiles_area": 0,
+        "a_occ": a_occ,
+        "b_occ": b_occ,
+        # One bit per k for every output tile: bit k of seen[i, j] is set
+        # once the (i,j,k) partial has been accumulated.
+        "seen": np.zeros((block_rows, block_cols, (block_depth + 7) // 8), dtype=np.uint8),
         "blocks_expected": blocks_expected,
         "block_rows": block_rows,
         "block_cols": block_cols,
+        "block_depth": block_depth,
         "received": 0,
-        "worker_times": []
+        # Partials received and expected per output tile; a tile is
+        # complete when they match (tiles expecting none stay zero)
+        "tile_counts": np.zeros((block_rows, block_cols), dtype=np.int32),
+        "tile_expected": tile_expected,
+        # Running min/max/mean/M2 over the completed tiles
+        "stats": None,
+        # Response for /aggregate/final_result, built once when the job completes
+        "final": None,
+        # Last accepted block and completion (time.monotonic), for the TTL
+        "touched": time.monotonic(),
+        "finished_at": None,
+        # Set (and replaced) on every accepted block, to wake event streams
+        "updated": asyncio.Event(),
+        "done": asyncio.Event(),
+        "worker_times": [],
+        # Block log under DATA_DIR (None without durability)
+        "log": None
     }
 
-    print(f"✅ Initialized job {job_id} expecting {blocks_expected} blocks")
-    return {"message": f"Job {job_id} initialized", "expected": blocks_expected}
+
+@app.post("/aggregate/import/{job_id}")
+async def import_result(job_id: str, request: Request, format: str = "npy"):
+    """
+    Create a finished job from a result computed earlier: the body is the
+    .npy (format=npy) or scipy.sparse .npz (format=npz) file of C, as
+    served by /aggregate/result. The splitter uses this to serve repeated
+    jobs from its result cache.
+    """
+    if format not in ("npy", "npz"):
+        raise HTTPException(status_code=400, detail=f"Unknown format '{format}' (expected 'npy' or 'npz')")
+    if job_id in jobs:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already exists")
+
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    path = os.path.join(RESULT_DIR, f"C_{uuid.uuid4().hex}.{format}")
+    with open(path, "wb") as f:
+        async for chunk in request.stream():
+            f.write(chunk)
+    try:
+        if format == "npz":
+            C = sp.load_npz(path).tocsr()
+            os.remove(path)
+            path = None
+        else:
+            C = np.load(path, mmap_mode="r")
+    except (ValueError, OSError, KeyError) as e:
+        if path:
+            os.remove(path)
+        raise HTTPException(status_code=400, detail=f"Invalid result file: {e}")
+
+    one = np.ones((1, 1), dtype=bool)
+    job = new_job(job_id, C.shape, C.shape, C.dtype.str, one, one, 1)
+    job["C"], job["result_path"] = C, path
+    # Recovered from its log as a sparse job (the log holds C as one tile)
+    job["sparse"] = is_sparse(C)
+    job["seen"][0, 0, 0] = 1
+    job["received"] = 1
+    job["tile_counts"][0, 0] = 1
+    # Summarize C a band of rows at a time
+    rows = max(1, RESULT_CHUNK_BYTES // max(1, C.shape[1] * C.dtype.itemsize))
+    for start in range(0, C.shape[0], rows):
+        job["stats"] = merge_stats(job["stats"], tile_stats(C[start:start + rows]))
+    if DATA_DIR:
+        open_log(job)
+    jobs[job_id] = job
+    print(f"📥 Imported result {C.shape} for job {job_id}")
+    finalize_job(job_id, job)
+    return {"message": f"Job {job_id} imported", "shape": list(C.shape)}
 
 
 @app.post("/aggregate/submit_block")
-async def submit_block(
-    job_id: str = Form(...),
-    row_block: int = Form(...),
-    col_block: int = Form(...),
-    depth_block: int = Form(...),  # ✅ ADDED: k-index to prevent duplicates
-    worker_time_sec: float = Form(0.0),
-    file: UploadFile = None
-):
+async def submit_block(request: Request):
+    """
+    Accumulate one partial result A[i,k] × B[k,j] into C[i,j].
+
+    The body is a block frame (see common.common_utils) whose meta holds
+    job_id, row_block, col_block, depth_block (the k-index, used to reject
+    duplicates) and worker_time_sec, with the partial as array "C".
+    """
+    try:
+        meta, arrays = decode_frame(await request.body())
+        job_id = meta["job_id"]
+        row_block, col_block, depth_block = meta["row_block"], meta["col_block"], meta["depth_block"]
+        worker_time_sec = meta.get("worker_time_sec", 0.0)
+        block_data = arrays["C"]
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed block frame: {e}")
+
+    status = accumulate_block(job_id, row_block, col_block, depth_block, worker_time_sec, block_data)
+    notify_job(jobs[job_id])
+
+    if status == "duplicate":
+        return {
+            "message": f"Duplicate block ({row_block},{col_block},{depth_block}) ignored",
+            "job_id": job_id
+        }
+    return {
+        "message": f"Accumulated block ({row_block},{col_block},{depth_block})",
+        "job_id": job_id
+    }
+
+
+@app.post("/aggregate/submit_blocks")
+async def submit_blocks(request: Request):
+    """
+    Accumulate a batch of partial results in one request.
+
+    The body is a block frame whose meta is {"blocks": [...]}, one entry
+    per block with the same fields as /aggregate/submit_block, and whose
+    arrays are the partials named "C0", "C1", ... in the same order. Each
+    block is accepted or rejected on its own; the response lists a status
+    ("accumulated", "duplicate" or "error") per block.
+    """
+    try:
+        meta, arrays = decode_frame(await request.body())
+        blocks = meta["blocks"]
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed block frame: {e}")
+
+    results, touched = [], set()
+    for idx, block_meta in enumerate(blocks):
+        try:
+            job_id = block_meta["job_id"]
+            status = accumulate_block(
+                job_id,
+                block_meta["row_block"],
+                block_meta["col_block"],
+                block_meta["depth_block"],
+                block_meta.get("worker_time_sec", 0.0),
+                arrays[f"C{idx}"]
+            )
+            touched.add(job_id)
+            results.append({"status": status})
+        except KeyError as e:
+            results.append({"status": "error", "detail": f"Missing field {e}"})
+        except HTTPException as e:
+            results.append({"status": "error", "detail": e.detail})
+
+    for job_id in touched:
+        notify_job(jobs[job_id])
+
+    return {"results": results}
+
+
+def accumulate_block(job_id, row_block, col_block, depth_block, worker_time_sec, block_data) -> str:
+    """
+    Add one A[i,k] × B[k,j] partial into C[i,j]. Returns "accumulated", or
+    "duplicate" if this (i,j,k) was already added; raises HTTPException
+    for unknown jobs and out-of-range or misshapen blocks.
+    """
     if job_id not in jobs:
         raise HTTPException(
             status_code=400,
             detail=f"Unknown job_id: {job_id}. Job may not be initialized."
         )
 
-    content = await file.read()
-    buf = io.BytesIO(content)
-    block_data = np.load(buf)
-
     job = jobs[job_id]
-    key = (row_block, col_block, depth_block)  # ✅ 3D key: (i, j, k)
 
-    # ✅ FIXED: Only store once per unique (i,j,k) combination
-    if key in job["results"]:
+    if not (0 <= row_block < job["block_rows"]
+            and 0 <= col_block < job["block_cols"]
+            and 0 <= depth_block < job["block_depth"]):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Block ({row_block},{col_block},{depth_block}) out of range for job {job_id}"
+        )
+
+    if job["owned"] is not None and not job["owned"][row_block, col_block]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tile ({row_block},{col_block}) of job {job_id} belongs to another shard"
+        )
+
+    if not (job["a_occ"][row_block, depth_block] and job["b_occ"][depth_block, col_block]):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Block ({row_block},{col_block},{depth_block}) is not expected for job {job_id} "
+                   f"(all-zero operand tile)"
+        )
+
+    byte_idx, bit = depth_block >> 3, np.uint8(1 << (depth_block & 7))
+    seen = job["seen"][row_block, col_block]
+
+    # ✅ FIXED: Only accumulate once per unique (i,j,k) combination
+    if seen[byte_idx] & bit:
         print(
             f"⚠️ Duplicate block ({row_block},{col_block},{depth_block}) "
             f"for job {job_id} - ignoring"
         )
-        return {
-            "message": f"Duplicate block ({row_block},{col_block},{depth_block}) ignored",
-            "job_id": job_id
-        }
-    
-    job["results"][key] = block_data
-    job["received"] += 1
-    job["worker_times"].append(worker_time_sec)
+        return "duplicate"
+
+    extent = tile_extent(job, row_block, col_block)
+    if block_data.shape != extent:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Block ({row_block},{col_block},{depth_block}) has shape "
+                   f"{block_data.shape}, expected {extent}"
+        )
+
+    if job["log"] is not None:
+        # Write-ahead: a block is only accumulated once it is in the log
+        try:
+            job["log"].append({"type": "block", "i": row_block, "j": col_block, "k": depth_block,
+                               "worker_time_sec": worker_time_sec}, {"C": block_data})
+        except OSError as e:
+            raise HTTPException(status_code=503, detail=f"Could not log block for job {job_id}: {e}")
+
+    apply_partial(job_id, job, row_block, col_block, [depth_block], [worker_time_sec], block_data)
 
     print(
         f"✅ Received block ({row_block},{col_block},{depth_block}) for job {job_id} "
         f"[{job['received']}/{job['blocks_expected']}] (worker {worker_time_sec:.4f}s)"
     )
-    
-    return {
-        "message": f"Stored block ({row_block},{col_block},{depth_block})",
-        "job_id": job_id
-    }
+    return "accumulated"
 
 
-# In aggregator.py, modify get_final_result function:
+def apply_partial(job_id, job, i, j, ks, worker_times, data):
+    """
+    Add `data`, the sum of the (i,j,k) partials for every k in `ks`, into
+    tile (i, j) and mark them received; finalizes the job with its last
+    block. Used for submitted blocks and for replaying a block log.
+    """
+    if job["owned"] is not None:
+        tile = accumulate_tile(job, i, j, data)
+    elif job["tiles"] is not None:
+        tile = accumulate_sparse(job, i, j, data)
+    else:
+        if job["C"] is None:
+            job["C"] = allocate_result(job, job["dtype"] or data.dtype)
+        rows, cols = tile_slices(job, i, j)
+        tile = job["C"][rows, cols]
+        if is_sparse(data):
+            tile += data.toarray()
+        else:
+            tile += data
+    seen = job["seen"][i, j]
+    for k in ks:
+        seen[k >> 3] |= np.uint8(1 << (k & 7))
+    job["received"] += len(ks)
+    job["touched"] = time.monotonic()
+    job["worker_times"].extend(worker_times)
 
-@app.get("/aggregate/final_result/{job_id}")
-async def get_final_result(job_id: str):
-    start_time = time.perf_counter()
-    
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    job["tile_counts"][i, j] += len(ks)
+    if job["tile_counts"][i, j] == job["tile_expected"][i, j]:
+        job["stats"] = merge_stats(job["stats"], tile_stats(tile))
 
-    job = jobs[job_id]
-    results = job["results"]
+    if job["received"] == job["blocks_expected"]:
+        finalize_job(job_id, job)
+
+
+def accumulate_tile(job: Dict, i: int, j: int, block_data):
+    """
+    Add a partial into tile (i, j) of a shard's job: CSR for sparse jobs
+    until the tile's own fill-in passes SPARSE_MAX_FILL, dense otherwise.
+    Dense tiles of an out-of-core shard are views into a memmap of C, of
+    which only the shard's tiles are ever written. Returns the updated tile.
+    """
+    def dense_tile():
+        dtype = job["dtype"] or block_data.dtype
+        if not shard_out_of_core(job):
+            return np.zeros(block_data.shape, dtype=dtype)
+        if job["C"] is None:
+            job["C"] = allocate_result(job, dtype)
+        rows, cols = tile_slices(job, i, j)
+        return job["C"][rows, cols]
+
+    tile = job["tiles"].get((i, j))
+    if job["sparse"] and (tile is None or is_sparse(tile)):
+        tile = sp.csr_matrix(block_data) if tile is None else tile + sp.csr_matrix(block_data)
+        if tile.nnz > SPARSE_MAX_FILL * tile.shape[0] * tile.shape[1]:
+            dense = dense_tile()
+            dense += tile.toarray()
+            tile = dense
+    else:
+        if tile is None:
+            tile = dense_tile()
+        tile += block_data.toarray() if is_sparse(block_data) else block_data
+    job["tiles"][(i, j)] = tile
+    return tile
+
+
+def accumulate_sparse(job: Dict, i: int, j: int, block_data):
+    """
+    Add a partial into the CSR tile (i, j) of a sparse job. Switches the
+    job to a dense C once the observed fill-in passes SPARSE_MAX_FILL.
+    Returns the updated tile (dense after a switch).
+    """
+    previous = job["tiles"].get((i, j))
+    tile = sp.csr_matrix(block_data)
+    if previous is not None:
+        tile = previous + tile
+        job["nnz"] -= previous.nnz
+    else:
+        job["tiles_area"] += tile.shape[0] * tile.shape[1]
+    job["tiles"][(i, j)] = tile
+    job["nnz"] += tile.nnz
 
-    if job["received"] < job["blocks_expected"]:
+    if job["nnz"] > SPARSE_MAX_FILL * job["tiles_area"]:
+        print(f"🔄 Fill-in {job['nnz'] / job['tiles_area']:.1%} above {SPARSE_MAX_FILL:.0%}, "
+              f"switching to a dense result")
+        job["C"] = allocate_result(job, job["dtype"] or tile.dtype)
+        for (ti, tj), stored in job["tiles"].items():
+            rows, cols = tile_slices(job, ti, tj)
+            job["C"][rows, cols] += stored.toarray()
+        job["tiles"] = None
+        rows, cols = tile_slices(job, i, j)
+        return job["C"][rows, cols]
+    return tile
+
+
+def assemble_sparse(job: Dict):
+    """Stitch a sparse job's CSR tiles into one CSR matrix C."""
+    br, bc = job["tile_shape"]
+    rows, cols, values = [], [], []
+    for (i, j), tile in job["tiles"].items():
+        coo = tile.tocoo()
+        rows.append(coo.row.astype(np.int64) + i * br)
+        cols.append(coo.col.astype(np.int64) + j * bc)
+        values.append(coo.data)
+    dtype = job["dtype"] or np.float64
+    if not values:
+        return sp.csr_matrix(job["shape"], dtype=dtype)
+    return sp.csr_matrix(
+        (np.concatenate(values).astype(dtype), (np.concatenate(rows), np.concatenate(cols))),
+        shape=job["shape"]
+    )
+
+
+def notify_job(job: Dict):
+    """Wake the job's event streams after blocks were accepted."""
+    updated, job["updated"] = job["updated"], asyncio.Event()
+    updated.set()
+
+
+def tile_stats(tile) -> Dict:
+    if is_sparse(tile):
+        # The implicit zeros count towards min/max/mean/M2
+        size = tile.shape[0] * tile.shape[1]
+        zeros = size - tile.nnz
+        values = tile.data
+        mean = float(values.sum(dtype=np.float64)) / size
         return {
-            "message": f"Not all blocks received yet ({job['received']}/{job['blocks_expected']})"
+            "count": size,
+            "min": min(float(values.min()) if values.size else 0.0, 0.0 if zeros else np.inf),
+            "max": max(float(values.max()) if values.size else 0.0, 0.0 if zeros else -np.inf),
+            "mean": mean,
+            "m2": float(np.square(values - mean, dtype=np.float64).sum()) + zeros * mean * mean,
         }
+    mean = float(tile.mean(dtype=np.float64))
+    return {
+        "count": tile.size,
+        "min": float(tile.min()),
+        "max": float(tile.max()),
+        "mean": mean,
+        "m2": float(np.square(tile - mean, dtype=np.float64).sum()),
+    }
+
+
+def finalize_shard(job_id: str, job: Dict):
+    """
+    This shard has every block of its tiles: publish its share of the
+    summary (raw stats and worker times) for the front to merge.
+    """
+    rows = np.diff(np.minimum(np.arange(job["block_rows"] + 1) * job["tile_shape"][0], job["shape"][0]))
+    cols = np.diff(np.minimum(np.arange(job["block_cols"] + 1) * job["tile_shape"][1], job["shape"][1]))
+    area = int((np.outer(rows, cols) * job["owned"]).sum())
+    stats = job["stats"]
+    zero_elements = area - (stats["count"] if stats else 0)
+    if zero_elements:
+        stats = merge_stats(stats, {"count": zero_elements, "min": 0.0, "max": 0.0, "mean": 0.0, "m2": 0.0})
+
+    if isinstance(job["C"], np.memmap):
+        job["C"].flush()
+
+    worker_times = job["worker_times"]
+    job["final"] = {
+        "message": "Aggregation complete",
+        "job_id": job_id,
+        "shape": job["shape"],
+        "dtype": (job["dtype"] or np.dtype(np.float64)).str,
+        "format": "csr" if job["sparse"] else "dense",
+        "received": job["received"],
+        "blocks_expected": job["blocks_expected"],
+        "shard": {
+            "job_id": job_id,
+            "tile_shape": job["tile_shape"],
+            "grid": [job["block_rows"], job["block_cols"]],
+            "tiles": len(job["tiles"]),
+            "nnz": int(sum(tile.nnz if is_sparse(tile) else np.count_nonzero(tile)
+                           for tile in job["tiles"].values())),
+            "stats": stats,
+            "worker_times": {
+                "count": len(worker_times),
+                "total": float(np.sum(worker_times)) if worker_times else 0.0,
+                "max": float(np.max(worker_times)) if worker_times else 0.0,
+                "min": float(np.min(worker_times)) if worker_times else 0.0,
+            },
+        },
+    }
+    job["finished_at"] = time.monotonic()
+    job["done"].set()
+    if job["log"] is not None:
+        compact_job(job)
+    print(f"🏁 Job {job_id} — shard share complete ({len(job['tiles'])} tiles)")
 
-    # Accumulate k-contributions properly
-    final_blocks = {}
-    for (i, j, k), partial_result in results.items():
-        ij_key = (i, j)
-        if ij_key not in final_blocks:
-            final_blocks[ij_key] = np.zeros_like(partial_result)
-        final_blocks[ij_key] += partial_result
-
-    # Reconstruct full matrix
-    row_blocks = []
-    for r in range(job["block_rows"]):
-        col_blocks = [final_blocks[(r, c)] for c in range(job["block_cols"])]
-        row_blocks.append(np.hstack(col_blocks))
-    
-    final_result = np.vstack(row_blocks)
+
+def finalize_job(job_id: str, job: Dict):
+    """Build the final_result response once, when the last block arrives."""
+    if job["owned"] is not None:
+        finalize_shard(job_id, job)
+        return
+
+    start_time = time.perf_counter()
+
+    if job["tiles"] is not None:
+        job["C"] = assemble_sparse(job)
+        job["tiles"] = None
+    elif job["C"] is None:
+        job["C"] = allocate_result(job, job["dtype"] or np.float64)
+    if isinstance(job["C"], np.memmap):
+        job["C"].flush()
+
+    # k-contributions were summed into C and tile stats merged as they
+    # arrived; tiles that expected no partials are zero
+    final_result = job["C"]
     shape = final_result.shape
-    
-    elapsed = time.perf_counter() - start_time
-    print(f"✅ Aggregation complete in {elapsed:.4f}s")
-    print(f"🏁 Job {job_id} — Final result ready, shape {shape}")
-    
+    stats = job["stats"]
+    zero_elements = shape[0] * shape[1] - (stats["count"] if stats else 0)
+    if zero_elements:
+        stats = merge_stats(stats, {"count": zero_elements, "min": 0.0, "max": 0.0, "mean": 0.0, "m2": 0.0})
+
     worker_times = job.get("worker_times", [])
     worker_summary = {}
     if worker_times:
@@ -136,35 +961,285 @@ async def get_final_result(job_id: str):
             "worker_time_max": float(np.max(worker_times)),
             "worker_time_min": float(np.min(worker_times)),
         }
-    
+
+    final = {
+        "message": "Aggregation complete",
+        "job_id": job_id,
+        "shape": shape,
+        "dtype": final_result.dtype.str,
+        "format": "csr" if is_sparse(final_result) else "dense",
+        "result_url": f"/aggregate/result/{job_id}.npy",
+        "result_summary": {
+            "min": stats["min"],
+            "max": stats["max"],
+            "mean": stats["mean"],
+            "std": float(np.sqrt(stats["m2"] / stats["count"])),
+        },
+        **worker_summary
+    }
+    if is_sparse(final_result):
+        final["nnz"] = int(final_result.nnz)
+        final["sparse_result_url"] = f"/aggregate/result/{job_id}.npz"
+
     # ✅ NEW: Only return full matrix for small results
     total_elements = shape[0] * shape[1]
     if total_elements <= 10000:  # Only return if <= 100x100
-        return {
-            "message": "Aggregation complete",
-            "job_id": job_id,
-            "shape": shape,
-            "final_result": final_result.tolist(),
-            "aggregation_time_sec": elapsed,
-            **worker_summary
-        }
+        dense = final_result.toarray() if is_sparse(final_result) else final_result
+        final["final_result"] = dense.tolist()
     else:
-        # For large matrices, return shape and stats only
+        final["final_result"] = "Matrix too large to return as JSON. Download it from result_url."
+
+    elapsed = time.perf_counter() - start_time
+    final["aggregation_time_sec"] = elapsed
+    job["final"] = final
+    job["finished_at"] = time.monotonic()
+    job["done"].set()
+    if job["log"] is not None:
+        compact_job(job)
+
+    print(f"✅ Aggregation complete in {elapsed:.4f}s")
+    print(f"🏁 Job {job_id} — Final result ready, shape {shape}")
+
+
+@app.get("/aggregate/final_result/{job_id}")
+async def get_final_result(job_id: str):
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    job = jobs[job_id]
+
+    if job["final"] is None:
         return {
-            "message": "Aggregation complete",
-            "job_id": job_id,
-            "shape": shape,
-            "final_result": "Matrix too large to return via HTTP. Shape and stats provided.",
-            "result_summary": {
-                "min": float(np.min(final_result)),
-                "max": float(np.max(final_result)),
-                "mean": float(np.mean(final_result)),
-                "std": float(np.std(final_result)),
-            },
-            "aggregation_time_sec": elapsed,
-            **worker_summary
+            "message": f"Not all blocks received yet ({job['received']}/{job['blocks_expected']})",
+            "received": job["received"],
+            "blocks_expected": job["blocks_expected"]
         }
 
+    return final_for(job_id, job)
+
+
+def final_for(job_id: str, job: Dict) -> Dict:
+    """The final_result response of job, as seen by job_id (which may be attached to it)."""
+    final = job["final"]
+    if job_id == job["job_id"]:
+        return final
+    final = {**final, "job_id": job_id, "result_url": f"/aggregate/result/{job_id}.npy"}
+    if "sparse_result_url" in final:
+        final["sparse_result_url"] = f"/aggregate/result/{job_id}.npz"
+    return final
+
+
+@app.get("/aggregate/missing/{job_id}")
+async def get_missing_blocks(job_id: str, limit: int = 10000):
+    """
+    List the expected (i,j,k) partials not accumulated yet (at most
+    `limit`), so the splitter can re-dispatch blocks whose submission
+    was lost.
+    """
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    job = jobs[job_id]
+    seen = np.unpackbits(job["seen"], axis=2, bitorder="little")[:, :, :job["block_depth"]].astype(bool)
+    expected = job["a_occ"][:, None, :] & job["b_occ"].T[None, :, :]
+    if job["owned"] is not None:
+        expected &= job["owned"][:, :, None]
+    missing = np.argwhere(expected & ~seen)
+    return {
+        "job_id": job_id,
+        "received": job["received"],
+        "blocks_expected": job["blocks_expected"],
+        "missing_total": len(missing),
+        "missing": missing[:limit].tolist()
+    }
+
+
+@app.get("/aggregate/events/{job_id}")
+async def job_events(job_id: str):
+    """
+    Server-Sent Events stream of a job's progress.
+
+    Emits "progress" events with received/blocks_expected whenever blocks
+    arrive (at most every SSE_MIN_INTERVAL_SEC), then a single "complete"
+    event carrying the final_result response as soon as the last block
+    is accumulated, and closes.
+    """
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    job = jobs[job_id]
+
+    async def stream():
+        while True:
+            updated = job["updated"]
+            yield sse_event("progress", {
+                "job_id": job_id,
+                "received": job["received"],
+                "blocks_expected": job["blocks_expected"]
+            })
+            if job["final"] is not None:
+                yield sse_event("complete", final_for(job_id, job))
+                return
+
+            try:
+                await asyncio.wait_for(updated.wait(), SSE_HEARTBEAT_SEC)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            # Coalesce bursts of blocks into one progress event, but wake
+            # immediately if the job completes in the meantime
+            try:
+                await asyncio.wait_for(job["done"].wait(), SSE_MIN_INTERVAL_SEC)
+            except asyncio.TimeoutError:
+                pass
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.get("/aggregate/result/{job_id}.npy")
+async def download_result(
+    job_id: str,
+    request: Request,
+    row_start: int = 0,
+    row_end: Optional[int] = None
+):
+    """
+    Stream the assembled C (or the row band [row_start, row_end)) as a
+    standalone .npy file. A single HTTP Range is honoured on that file, so
+    clients can fetch slices in parallel either by row band or by bytes.
+    A sparse C is densified one chunk of rows at a time.
+    """
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    job = jobs[job_id]
+    if job["final"] is None:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Not all blocks received yet ({job['received']}/{job['blocks_expected']})"
+        )
+
+    if job["owned"] is not None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is sharded; download it from the front")
+
+    C = job["C"]
+    rows = C.shape[0]
+    row_end = rows if row_end is None else row_end
+    if not 0 <= row_start <= row_end <= rows:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid row band [{row_start}, {row_end}) for {rows} rows"
+        )
+
+    header = npy_header(C.dtype, (row_end - row_start,) + C.shape[1:])
+    row_bytes = C.shape[1] * C.dtype.itemsize
+    size = len(header) + (row_end - row_start) * row_bytes
+
+    status_code = 200
+    start, end = 0, size
+    extra_headers = {"Accept-Ranges": "bytes"}
+    if "range" in request.headers:
+        byte_range = parse_range(request.headers["range"], size)
+        if byte_range is None:
+            raise HTTPException(
+                status_code=416,
+                detail="Unsatisfiable range",
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+        start, end = byte_range
+        status_code = 206
+        extra_headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    def stream():
+        if start < len(header):
+            yield header[start:min(end, len(header))]
+        offset = max(start - len(header), 0)
+        stop = end - len(header)
+        if not is_sparse(C):
+            data = C.reshape(-1).view(np.uint8)[row_start * row_bytes:row_end * row_bytes]
+        while offset < stop:
+            chunk_end = min(offset + RESULT_CHUNK_BYTES, stop)
+            if is_sparse(C):
+                first, last = offset // row_bytes, -(-chunk_end // row_bytes)
+                rows = C[row_start + first:row_start + last].toarray().reshape(-1).view(np.uint8)
+                yield rows[offset - first * row_bytes:chunk_end - first * row_bytes].tobytes()
+            else:
+                yield data[offset:chunk_end].tobytes()
+            offset = chunk_end
+
+    return StreamingResponse(
+        stream(),
+        status_code=status_code,
+        media_type="application/octet-stream",
+        headers={"Content-Length": str(end - start), **extra_headers}
+    )
+
+
+@app.get("/aggregate/tiles/{job_id}")
+async def get_tiles(job_id: str, row_block: int):
+    """
+    Return the finished tiles of one row of output tiles as a block frame:
+    meta {"tiles": [[row_block, j], ...]} with the tiles as arrays "T0",
+    "T1", ... (dense or CSR). Tiles not listed are zero. The sharded front
+    assembles results from these.
+    """
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    job = jobs[job_id]
+    if job["final"] is None:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Not all blocks received yet ({job['received']}/{job['blocks_expected']})"
+        )
+    if not 0 <= row_block < job["block_rows"]:
+        raise HTTPException(status_code=400, detail=f"row_block {row_block} out of range for job {job_id}")
+
+    tiles = {}
+    for j in range(job["block_cols"]):
+        if job["tiles"] is not None:
+            tile = job["tiles"].get((row_block, j))
+        else:
+            rows, cols = tile_slices(job, row_block, j)
+            tile = job["C"][rows, cols]
+        if tile is not None:
+            tiles[j] = tile
+    body = encode_frame(
+        {"tiles": [[row_block, j] for j in tiles]},
+        {f"T{idx}": tile for idx, tile in enumerate(tiles.values())}
+    )
+    return Response(content=body, media_type=FRAME_CONTENT_TYPE)
+
+
+@app.get("/aggregate/result/{job_id}.npz")
+async def download_sparse_result(job_id: str):
+    """Return a sparse C as a scipy.sparse.save_npz (CSR) file."""
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    job = jobs[job_id]
+    if job["final"] is None:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Not all blocks received yet ({job['received']}/{job['blocks_expected']})"
+        )
+    if job["owned"] is not None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is sharded; download it from the front")
+    if not is_sparse(job["C"]):
+        raise HTTPException(
+            status_code=409,
+            detail=f"Job {job_id} has a dense result; download it from {job['final']['result_url']}"
+        )
+
+    buf = io.BytesIO()
+    sp.save_npz(buf, job["C"])
+    return Response(content=buf.getvalue(), media_type="application/octet-stream")
+
 
 @app.get("/aggregate/jobs")
 def list_jobs():
@@ -173,11 +1248,34 @@ def list_jobs():
             "received": job["received"],
             "expected": job["blocks_expected"],
             "rows": job["block_rows"],
-            "cols": job["block_cols"]
+            "cols": job["block_cols"],
+            "state": "done" if job["final"] is not None else "accumulating",
+            # RAM in use, RAM reserved until the result is complete, and
+            # the result file on disk (spilled or out-of-core)
+            "bytes": job_bytes(job),
+            "reserved_bytes": projected_bytes(job),
+            "disk_bytes": os.path.getsize(job["result_path"]) if job["result_path"] else 0,
+            "log_bytes": job["log"].size if job["log"] is not None else 0,
+            **({"attached_to": job["job_id"]} if job["job_id"] != job_id else {})
         } for job_id, job in jobs.items()
     }
 
 
+@app.get("/aggregate/memory")
+def memory_stats():
+    return {
+        "budget_bytes": MEMORY_BUDGET_BYTES,
+        "used_bytes": memory_used(),
+        "jobs": len(unique_jobs()),
+        "job_ttl_sec": JOB_TTL_SEC,
+        "results_spilled": results_spilled,
+        "jobs_evicted": jobs_evicted,
+        "log_dir": DATA_DIR,
+        "log_bytes": sum(job["log"].size for job in unique_jobs() if job["log"] is not None),
+        "logs_compacted": logs_compacted,
+    }
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
\ No newline at end of file
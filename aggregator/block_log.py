@@ -0,0 +1,97 @@
+import os
+import struct
+
+from common.common_utils import decode_frame, encode_frame
+
+# Every record is a block frame (see common.common_utils) preceded by its
+# length as a little-endian u64
+RECORD_HEADER = struct.Struct("<Q")
+
+
+class BlockLog:
+    """
+    Append-only log of one job's aggregator state: the job's parameters,
+    then every accepted partial, so a restarted aggregator can rebuild the
+    job by replaying it. Records go straight to the file with os.write, so
+    they survive a crash of the process (and of the host with fsync); a
+    record torn by a crash mid-write is dropped on replay.
+
+    `rewrite` replaces the log with a compact set of records (a snapshot
+    of the accumulated tiles): the new log is written next to the old one
+    and renamed over it.
+    """
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self._fd).st_size
+        self.records = 0
+
+    def append(self, meta, arrays=None):
+        self.size += self._write(self._fd, meta, arrays)
+        self.records += 1
+        if self.fsync:
+            os.fsync(self._fd)
+
+    def _write(self, fd, meta, arrays):
+        frame = encode_frame(meta, arrays)
+        record = memoryview(RECORD_HEADER.pack(len(frame)) + frame)
+        written = 0
+        while written < len(record):
+            written += os.write(fd, record[written:])
+        return len(record)
+
+    def rewrite(self, records):
+        """Atomically replace the log with `records` ((meta, arrays) pairs)."""
+        tmp_path = f"{self.path}.compact"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        size = count = 0
+        try:
+            for meta, arrays in records:
+                size += self._write(fd, meta, arrays)
+                count += 1
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, self.path)
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.size, self.records = size, count
+
+    def close(self):
+        os.close(self._fd)
+
+    def delete(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def replay(path):
+        """
+        Yield the (meta, arrays) records of a log. A torn record at the
+        end (the process died mid-write) is cut off.
+        """
+        offset = 0
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, = RECORD_HEADER.unpack(header)
+                frame = f.read(length)
+                if len(frame) < length:
+                    break
+                try:
+                    record = decode_frame(frame)
+                except ValueError:
+                    break
+                yield record
+                offset += RECORD_HEADER.size + length
+        if offset < os.path.getsize(path):
+            print(f"⚠️ Cutting a torn record off {path} at byte {offset}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
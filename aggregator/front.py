@@ -0,0 +1,533 @@
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from contextlib import asynccontextmanager
+from typing import Dict, List
+import numpy as np
+import scipy.sparse as sp
+import asyncio
+import io
+import json
+import os
+import time
+import httpx
+
+from common.common_utils import (FRAME_CONTENT_TYPE, SSE_HEARTBEAT_SEC, decode_frame, encode_frame,
+                                 is_sparse, merge_stats, npy_header, parse_range, sse_event, tile_shard)
+
+# Front of a sharded aggregator. The output tiles of every job are spread
+# over the aggregator shards listed in AGGREGATOR_SHARD_URLS (in shard
+# order) by common.common_utils.tile_shard. Workers submit straight to the
+# owning shard (the splitter hands them the shard list as aggregator_url);
+# the front fans /init_job out to the shards and gathers progress, missing
+# blocks and results from them, so clients see a single aggregator.
+SHARD_URLS = [url.strip().rstrip("/") for url in os.environ.get("AGGREGATOR_SHARD_URLS", "").split(",")
+              if url.strip()]
+
+client: httpx.AsyncClient = None
+# Long-lived subscriptions to the shards' event streams use their own
+# client, so they never hold the connections block forwarding needs
+event_client: httpx.AsyncClient = None
+
+# Merged final_result and layout of finished jobs, so polls and downloads
+# of a finished job do not ask the shards again. Entries are dropped after
+# the shards' own job TTL.
+JOB_TTL_SEC = float(os.environ.get("AGGREGATOR_JOB_TTL_SEC", 3600))
+finished_jobs: Dict[str, Dict] = {}
+merging: Dict[str, asyncio.Task] = {}
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global client, event_client
+    if not SHARD_URLS:
+        raise RuntimeError("AGGREGATOR_SHARD_URLS lists no shards")
+    client = httpx.AsyncClient(
+        timeout=float(os.environ.get("AGGREGATOR_FRONT_TIMEOUT", 60)),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64)
+    )
+    # Shards send a keep-alive at least every SSE_HEARTBEAT_SEC
+    event_client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=3 * SSE_HEARTBEAT_SEC),
+                                     limits=httpx.Limits(max_connections=None))
+    print(f"✅ Aggregator front over {len(SHARD_URLS)} shards: {', '.join(SHARD_URLS)}")
+    yield
+    await event_client.aclose()
+    await client.aclose()
+
+
+app = FastAPI(title="Aggregator Front", lifespan=lifespan)
+
+
+def check(resp: httpx.Response) -> httpx.Response:
+    """Pass a shard's error response on to the caller."""
+    if resp.status_code != 200:
+        try:
+            detail = resp.json().get("detail")
+        except ValueError:
+            detail = resp.text
+        headers = {"Retry-After": resp.headers["Retry-After"]} if "Retry-After" in resp.headers else None
+        raise HTTPException(status_code=resp.status_code, detail=detail, headers=headers)
+    return resp
+
+
+async def gather_shards(requests) -> List[httpx.Response]:
+    try:
+        return await asyncio.gather(*requests)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Aggregator shard unreachable: {e}")
+
+
+async def fan_out(method: str, path: str, shards=None, **kwargs) -> List[httpx.Response]:
+    """Send a request to every shard (or the given shard indices) concurrently."""
+    shards = range(len(SHARD_URLS)) if shards is None else shards
+    return await gather_shards(client.request(method, f"{SHARD_URLS[s]}{path}", **kwargs) for s in shards)
+
+
+@app.get("/shards")
+def list_shards():
+    return {"shards": SHARD_URLS}
+
+
+@app.post("/init_job")
+async def init_job(request: Request):
+    """
+    Initialize a job on every shard; each one is told its index and only
+    expects the blocks of the tiles routed to it. A 429 from any shard is
+    passed on.
+    """
+    data = await request.json()
+    if data.get("alias_of") is not None:
+        responses = await fan_out("POST", "/init_job", json=data)
+    else:
+        responses = await gather_shards(
+            client.post(f"{url}/init_job", json={**data, "shard": {"index": s, "count": len(SHARD_URLS)}})
+            for s, url in enumerate(SHARD_URLS)
+        )
+    expected = sum(check(resp).json()["expected"] for resp in responses)
+    return {"message": f"Job {data.get('job_id')} initialized on {len(SHARD_URLS)} shards", "expected": expected}
+
+
+@app.post("/aggregate/submit_block")
+async def submit_block(request: Request):
+    """Forward a block frame to the shard owning its tile."""
+    body = await request.body()
+    try:
+        meta, _ = decode_frame(body)
+        shard = tile_shard(meta["job_id"], meta["row_block"], meta["col_block"], len(SHARD_URLS))
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed block frame: {e}")
+    resp, = await fan_out("POST", "/aggregate/submit_block", shards=[shard], content=body,
+                          headers={"Content-Type": FRAME_CONTENT_TYPE})
+    return check(resp).json()
+
+
+@app.post("/aggregate/submit_blocks")
+async def submit_blocks(request: Request):
+    """Split a batch of blocks by owning shard and forward each part."""
+    try:
+        meta, arrays = decode_frame(await request.body())
+        by_shard: Dict[int, List[int]] = {}
+        for idx, block in enumerate(meta["blocks"]):
+            shard = tile_shard(block["job_id"], block["row_block"], block["col_block"], len(SHARD_URLS))
+            by_shard.setdefault(shard, []).append(idx)
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed block frame: {e}")
+
+    shards = list(by_shard)
+    responses = await gather_shards(
+        client.post(
+            f"{SHARD_URLS[shard]}/aggregate/submit_blocks",
+            content=encode_frame(
+                {"blocks": [meta["blocks"][idx] for idx in by_shard[shard]]},
+                {f"C{n}": arrays[f"C{idx}"] for n, idx in enumerate(by_shard[shard])}
+            ),
+            headers={"Content-Type": FRAME_CONTENT_TYPE}
+        ) for shard in shards
+    )
+    results = [None] * len(meta["blocks"])
+    for shard, resp in zip(shards, responses):
+        for idx, result in zip(by_shard[shard], check(resp).json()["results"]):
+            results[idx] = result
+    return {"results": results}
+
+
+async def shard_finals(job_id: str) -> List[Dict]:
+    return [check(resp).json() for resp in await fan_out("GET", f"/aggregate/final_result/{job_id}")]
+
+
+def is_complete(finals: List[Dict]) -> bool:
+    return all(final.get("message") == "Aggregation complete" for final in finals)
+
+
+def progress(job_id: str, finals: List[Dict]) -> Dict:
+    return {
+        "job_id": job_id,
+        "received": sum(final["received"] for final in finals),
+        "blocks_expected": sum(final["blocks_expected"] for final in finals)
+    }
+
+
+class Layout:
+    """Shape, tiling and dtype of a finished sharded job."""
+
+    def __init__(self, job_id: str, finals: List[Dict]):
+        shard = finals[0]["shard"]
+        self.job_id = job_id
+        # Tiles are routed by the id of the job that computed them, which
+        # differs from job_id for a job attached to an identical one
+        self.routing_id = shard["job_id"]
+        self.shape = tuple(finals[0]["shape"])
+        self.dtype = np.dtype(finals[0]["dtype"])
+        self.tile_shape = tuple(shard["tile_shape"])
+        self.grid = tuple(shard["grid"])
+        self.sparse = all(final["format"] == "csr" for final in finals)
+
+    def band_rows(self, i: int) -> int:
+        return min(self.tile_shape[0], self.shape[0] - i * self.tile_shape[0])
+
+
+async def tile_row(layout: Layout, i: int):
+    """Return {j: tile} for row i of output tiles, from the shards owning them."""
+    shards = sorted({tile_shard(layout.routing_id, i, j, len(SHARD_URLS)) for j in range(layout.grid[1])})
+    tiles = {}
+    for resp in await fan_out("GET", f"/aggregate/tiles/{layout.job_id}", shards=shards,
+                              params={"row_block": i}):
+        meta, arrays = decode_frame(check(resp).content)
+        for idx, (_, j) in enumerate(meta["tiles"]):
+            tiles[j] = arrays[f"T{idx}"]
+    return tiles
+
+
+async def dense_band(layout: Layout, i: int) -> np.ndarray:
+    """Row i of output tiles as a dense (rows × n) band of C."""
+    band = np.zeros((layout.band_rows(i), layout.shape[1]), dtype=layout.dtype)
+    bc = layout.tile_shape[1]
+    for j, tile in (await tile_row(layout, i)).items():
+        band[:, j * bc:j * bc + tile.shape[1]] = tile.toarray() if is_sparse(tile) else tile
+    return band
+
+
+async def sparse_result(layout: Layout):
+    """Gather the whole C as CSR."""
+    br, bc = layout.tile_shape
+    rows, cols, values = [], [], []
+    for i in range(layout.grid[0]):
+        for j, tile in (await tile_row(layout, i)).items():
+            coo = sp.coo_matrix(tile)
+            rows.append(coo.row.astype(np.int64) + i * br)
+            cols.append(coo.col.astype(np.int64) + j * bc)
+            values.append(coo.data)
+    if not values:
+        return sp.csr_matrix(layout.shape, dtype=layout.dtype)
+    return sp.csr_matrix(
+        (np.concatenate(values).astype(layout.dtype), (np.concatenate(rows), np.concatenate(cols))),
+        shape=layout.shape
+    )
+
+
+async def merge_finals(job_id: str, finals: List[Dict]) -> Dict:
+    """Build the final_result response of a job from its shards' shares."""
+    start_time = time.perf_counter()
+    layout = Layout(job_id, finals)
+    shares = [final["shard"] for final in finals]
+
+    # Shards owning no tiles (or only empty ones) report no stats
+    stats = None
+    for share in shares:
+        if share["stats"] and share["stats"]["count"]:
+            stats = merge_stats(stats, share["stats"])
+
+    final = {
+        "message": "Aggregation complete",
+        "job_id": job_id,
+        "shape": layout.shape,
+        "dtype": layout.dtype.str,
+        "format": "csr" if layout.sparse else "dense",
+        "result_url": f"/aggregate/result/{job_id}.npy",
+        "result_summary": {
+            "min": stats["min"],
+            "max": stats["max"],
+            "mean": stats["mean"],
+            "std": float(np.sqrt(stats["m2"] / stats["count"])),
+        } if stats else None,
+        "shards": len(shares),
+    }
+
+    times = [share["worker_times"] for share in shares if share["worker_times"]["count"]]
+    if times:
+        count = sum(t["count"] for t in times)
+        final["worker_time_total"] = sum(t["total"] for t in times)
+        final["worker_time_avg"] = final["worker_time_total"] / count
+        final["worker_time_max"] = max(t["max"] for t in times)
+        final["worker_time_min"] = min(t["min"] for t in times)
+
+    if layout.sparse:
+        final["nnz"] = sum(share["nnz"] for share in shares)
+        final["sparse_result_url"] = f"/aggregate/result/{job_id}.npz"
+
+    # Same rule as a single aggregator: small results are returned inline
+    if layout.shape[0] * layout.shape[1] <= 10000:
+        bands = [await dense_band(layout, i) for i in range(layout.grid[0])]
+        final["final_result"] = np.vstack(bands).tolist()
+    else:
+        final["final_result"] = "Matrix too large to return as JSON. Download it from result_url."
+
+    final["aggregation_time_sec"] = time.perf_counter() - start_time
+    return final
+
+
+async def finished_job(job_id: str, finals: List[Dict]) -> Dict:
+    """
+    The merged final_result and layout of a job whose shards all report
+    it finished, merged once (concurrent callers share the merge).
+    """
+    if job_id in finished_jobs:
+        return finished_jobs[job_id]
+    task = merging.get(job_id)
+    if task is None:
+        task = merging[job_id] = asyncio.create_task(merge_finals(job_id, finals))
+    try:
+        final = await task
+    finally:
+        merging.pop(job_id, None)
+    if job_id not in finished_jobs:
+        now = time.monotonic()
+        for expired in [key for key, entry in finished_jobs.items() if now - entry["at"] > JOB_TTL_SEC]:
+            del finished_jobs[expired]
+        finished_jobs[job_id] = {"final": final, "layout": Layout(job_id, finals), "at": now}
+    return finished_jobs[job_id]
+
+
+@app.get("/aggregate/final_result/{job_id}")
+async def get_final_result(job_id: str):
+    if job_id in finished_jobs:
+        return finished_jobs[job_id]["final"]
+    finals = await shard_finals(job_id)
+    if not is_complete(finals):
+        status = progress(job_id, finals)
+        return {
+            "message": f"Not all blocks received yet ({status['received']}/{status['blocks_expected']})",
+            "received": status["received"],
+            "blocks_expected": status["blocks_expected"]
+        }
+    return (await finished_job(job_id, finals))["final"]
+
+
+@app.get("/aggregate/missing/{job_id}")
+async def get_missing_blocks(job_id: str, limit: int = 10000):
+    """The expected (i,j,k) partials no shard has accumulated yet (at most `limit`)."""
+    shares = [check(resp).json() for resp in
+              await fan_out("GET", f"/aggregate/missing/{job_id}", params={"limit": limit})]
+    missing = [block for share in shares for block in share["missing"]]
+    return {
+        "job_id": job_id,
+        "received": sum(share["received"] for share in shares),
+        "blocks_expected": sum(share["blocks_expected"] for share in shares),
+        "missing_total": sum(share["missing_total"] for share in shares),
+        "missing": missing[:limit]
+    }
+
+
+async def relay_events(shard: int, job_id: str, queue: asyncio.Queue):
+    """Put (shard, event, data) for every event of a shard's event stream on queue."""
+    try:
+        async with event_client.stream("GET", f"{SHARD_URLS[shard]}/aggregate/events/{job_id}") as resp:
+            if resp.status_code != 200:
+                await resp.aread()
+                check(resp)
+            event = None
+            async for line in resp.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    await queue.put((shard, event, json.loads(line[len("data: "):])))
+                    if event == "complete":
+                        return
+        raise httpx.ReadError("event stream closed before the job completed")
+    except (httpx.HTTPError, HTTPException) as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        await queue.put((shard, "error", {"detail": f"Shard {SHARD_URLS[shard]}: {detail}"}))
+
+
+@app.get("/aggregate/events/{job_id}")
+async def job_events(job_id: str):
+    """
+    Server-Sent Events stream of a job's progress, like a single
+    aggregator's, relayed from the shards' own event streams: "progress"
+    events with the totals over the shards, then "complete" once every
+    shard has completed, or "error" if a shard's stream fails.
+    """
+    finals = await shard_finals(job_id)
+
+    async def stream():
+        if is_complete(finals):
+            yield sse_event("progress", progress(job_id, finals))
+            yield sse_event("complete", (await finished_job(job_id, finals))["final"])
+            return
+
+        queue: asyncio.Queue = asyncio.Queue()
+        relays = [asyncio.create_task(relay_events(shard, job_id, queue)) for shard in range(len(SHARD_URLS))]
+        shares = list(finals)
+        last = None
+        try:
+            while True:
+                try:
+                    events = [await asyncio.wait_for(queue.get(), SSE_HEARTBEAT_SEC)]
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                # Coalesce the events the shards sent meanwhile into one
+                while not queue.empty():
+                    events.append(queue.get_nowait())
+                for shard, event, data in events:
+                    if event == "error":
+                        yield sse_event("error", data)
+                        return
+                    if event == "complete":
+                        shares[shard] = data
+                    elif shares[shard].get("message") != "Aggregation complete":
+                        shares[shard] = {**shares[shard], "received": data["received"],
+                                         "blocks_expected": data["blocks_expected"]}
+
+                status = progress(job_id, shares)
+                if status != last or is_complete(shares):
+                    yield sse_event("progress", status)
+                    last = status
+                if is_complete(shares):
+                    yield sse_event("complete", (await finished_job(job_id, shares))["final"])
+                    return
+        finally:
+            for relay in relays:
+                relay.cancel()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+async def finished_layout(job_id: str) -> Layout:
+    if job_id in finished_jobs:
+        return finished_jobs[job_id]["layout"]
+    finals = await shard_finals(job_id)
+    if not is_complete(finals):
+        status = progress(job_id, finals)
+        raise HTTPException(
+            status_code=409,
+            detail=f"Not all blocks received yet ({status['received']}/{status['blocks_expected']})"
+        )
+    return (await finished_job(job_id, finals))["layout"]
+
+
+@app.get("/aggregate/result/{job_id}.npy")
+async def download_result(
+    job_id: str,
+    request: Request,
+    row_start: int = 0,
+    row_end: int = None
+):
+    """
+    Stream C (or the row band [row_start, row_end)) as a .npy file,
+    gathering one row of output tiles at a time from the shards. Single
+    HTTP Ranges are honoured as on a single aggregator.
+    """
+    layout = await finished_layout(job_id)
+    rows = layout.shape[0]
+    row_end = rows if row_end is None else row_end
+    if not 0 <= row_start <= row_end <= rows:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid row band [{row_start}, {row_end}) for {rows} rows"
+        )
+
+    header = npy_header(layout.dtype, (row_end - row_start, layout.shape[1]))
+    row_bytes = layout.shape[1] * layout.dtype.itemsize
+    size = len(header) + (row_end - row_start) * row_bytes
+
+    status_code = 200
+    start, end = 0, size
+    extra_headers = {"Accept-Ranges": "bytes"}
+    if "range" in request.headers:
+        byte_range = parse_range(request.headers["range"], size)
+        if byte_range is None:
+            raise HTTPException(
+                status_code=416,
+                detail="Unsatisfiable range",
+                headers={"Content-Range": f"bytes */{size}"}
+            )
+        start, end = byte_range
+        status_code = 206
+        extra_headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    async def stream():
+        if start < len(header):
+            yield header[start:min(end, len(header))]
+        offset = max(start - len(header), 0)
+        stop = end - len(header)
+        br = layout.tile_shape[0]
+        while offset < stop:
+            i = (row_start + offset // row_bytes) // br
+            band = (await dense_band(layout, i)).reshape(-1).view(np.uint8)
+            # Offsets relative to the band, which starts at row i * br
+            local = offset + (row_start - i * br) * row_bytes
+            chunk_end = min(stop, (min((i + 1) * br, row_end) - row_start) * row_bytes)
+            yield band[local:local + chunk_end - offset].tobytes()
+            offset = chunk_end
+
+    return StreamingResponse(
+        stream(),
+        status_code=status_code,
+        media_type="application/octet-stream",
+        headers={"Content-Length": str(end - start), **extra_headers}
+    )
+
+
+@app.get("/aggregate/result/{job_id}.npz")
+async def download_sparse_result(job_id: str):
+    """Gather a sparse C from the shards as a scipy.sparse.save_npz (CSR) file."""
+    layout = await finished_layout(job_id)
+    if not layout.sparse:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Job {job_id} has a dense result; download it from /aggregate/result/{job_id}.npy"
+        )
+    buf = io.BytesIO()
+    sp.save_npz(buf, await sparse_result(layout))
+    return Response(content=buf.getvalue(), media_type="application/octet-stream")
+
+
+@app.post("/aggregate/import/{job_id}")
+async def import_result(job_id: str):
+    raise HTTPException(status_code=501, detail="Importing results is not supported by a sharded aggregator")
+
+
+@app.get("/aggregate/jobs")
+async def list_jobs():
+    """Per-job totals over the shards."""
+    merged: Dict[str, Dict] = {}
+    for resp in await fan_out("GET", "/aggregate/jobs"):
+        for job_id, share in check(resp).json().items():
+            job = merged.setdefault(job_id, {
+                "received": 0, "expected": 0, "rows": share["rows"], "cols": share["cols"],
+                "state": "done", "bytes": 0, "reserved_bytes": 0, "disk_bytes": 0, "shards": 0
+            })
+            for key in ("received", "expected", "bytes", "reserved_bytes", "disk_bytes"):
+                job[key] += share[key]
+            if share["state"] != "done":
+                job["state"] = share["state"]
+            job["shards"] += 1
+    return merged
+
+
+@app.get("/aggregate/memory")
+async def memory_stats():
+    return {"shards": [check(resp).json() for resp in await fan_out("GET", "/aggregate/memory")]}
+
+
+@app.get("/health")
+async def health():
+    responses = await asyncio.gather(*(client.get(f"{url}/health") for url in SHARD_URLS),
+                                     return_exceptions=True)
+    healthy = sum(1 for resp in responses if isinstance(resp, httpx.Response) and resp.status_code == 200)
+    return {"status": "ok" if healthy == len(SHARD_URLS) else "degraded",
+            "shards": len(SHARD_URLS), "healthy_shards": healthy}
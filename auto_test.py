@@ -12,6 +12,8 @@ import pandas as pd
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
+from submit import submit_job, wait_for_result
+
 # Set matplotlib backend for Docker
 import matplotlib
 matplotlib.use('Agg')
@@ -163,7 +165,7 @@ def create_matrix(n, identity=False):
     dtype = np.float32
     return np.eye(n, dtype=dtype) if identity else np.arange(1, n * n + 1, dtype=dtype).reshape(n, n)
 
-def run_pipeline(n=10, block_size=500, job_id=None, splitter_url=SPLITTER_URL):
+def run_pipeline(n=10, block_size=500, job_id=None, splitter_url=SPLITTER_URL, mode="block"):
     job_label = f"[Job-{job_id[:8]}]" if job_id is not None else ""
     print(f"\n{job_label} ⚙️ Creating matrices A({n}x{n}) and B({n}x{n})")
 
@@ -185,72 +187,58 @@ def run_pipeline(n=10, block_size=500, job_id=None, splitter_url=SPLITTER_URL):
     
     data = {
         "block_size": str(block_size),
+        "mode": mode,
         "worker_url": "http://worker:8001",
         "aggregator_url": AGGREGATOR_URL,
         "job_id": job_id
     }
 
     try:
-        resp = requests.post(f"{SPLITTER_URL}/split", files=files, data=data, timeout=1200)
+        resp = submit_job(SPLITTER_URL, files, data, job_label)
         resp.raise_for_status()
     except Exception as e:
         print(f"\n{job_label} ❌ Splitter request failed: {e}")
         return None
 
     job_info = resp.json()
-    print(f"{job_label} ✅ Splitter accepted job {job_id[:8]}, dispatched {job_info.get('blocks_dispatched', '?')} blocks")
+    print(f"{job_label} ✅ Splitter accepted job {job_id[:8]}, queued {job_info.get('blocks_total', '?')} blocks")
 
-    # --- Poll aggregator for completion ---
-    result_url = f"{AGGREGATOR_URL}/aggregate/final_result/{job_id}"
+    # --- Follow the aggregator's event stream until completion ---
     print(f"{job_label} ⏳ Waiting for aggregator result...")
+    data = wait_for_result(AGGREGATOR_URL, job_id, job_label)
+    if data is None:
+        print(f"\n{job_label} ❌ Aggregator timeout after 45 minutes.")
+        return None
 
-    for attempt in range(900):
-        time.sleep(3)
-        try:
-            r = requests.get(result_url, timeout=1000)
-            if r.status_code == 404:
-                if attempt % 20 == 0 and attempt > 0:
-                    print(f"\n{job_label} ⏳ Still waiting... ({attempt * 3}s elapsed)")
-                continue
-            
-            data = r.json()
-            if data.get("message") == "Aggregation complete":
-                print(f"\n{job_label} 🏁 Final result ready! Shape: {data['shape']}")
-                
-                if n <= 1000:
-                    if isinstance(data.get("final_result"), list):
-                        print(f"{job_label} 🔍 Verifying correctness...")
-                        final = np.array(data["final_result"], dtype=np.float32)
-                        expected = A @ B
-                        if np.allclose(final, expected, rtol=1e-3, atol=1e-4):
-                            print(f"{job_label} ✅ Correct final matrix.")
-                        else:
-                            print(f"{job_label} ❌ Incorrect matrix result!")
-                    elif isinstance(data.get("final_result"), str):
-                        print(f"{job_label} ℹ️ Large matrix — correctness check skipped.")
-                        print(f"{job_label} Summary: {data['final_result']}")
-                        if "result_summary" in data:
-                            print(f"{job_label} Stats: {data['result_summary']}")
-                else:
-                    print(f"{job_label} ✅ Job completed (verification skipped for n > 1000)")
-                    if isinstance(data.get("final_result"), str):
-                        print(f"{job_label} Result: {data['final_result']}")
-                        if "result_summary" in data:
-                            print(f"{job_label} Stats: {data['result_summary']}")
-                
-                if "worker_time_total" in data:
-                    print(f"{job_label} 📊 Worker time: {data['worker_time_total']:.2f}s")
-                if "aggregation_time_sec" in data:
-                    print(f"{job_label} 📊 Aggregation time: {data['aggregation_time_sec']:.2f}s")
+    print(f"\n{job_label} 🏁 Final result ready! Shape: {data['shape']}")
 
-                return data
-        except Exception as e:
-            if attempt % 20 == 0 and attempt > 0:
-                print(f"\n{job_label} ⚠️ Poll error (attempt {attempt}): {e}")
-            continue
-    
-    print(f"\n{job_label} ❌ Aggregator timeout after 45 minutes.")
-    return None
+    if n <= 1000:
+        if isinstance(data.get("final_result"), list):
+            print(f"{job_label} 🔍 Verifying correctness...")
+            final = np.array(data["final_result"], dtype=np.float32)
+            expected = A @ B
+            if np.allclose(final, expected, rtol=1e-3, atol=1e-4):
+                print(f"{job_label} ✅ Correct final matrix.")
+            else:
+                print(f"{job_label} ❌ Incorrect matrix result!")
+        elif isinstance(data.get("final_result"), str):
+            print(f"{job_label} ℹ️ Large matrix — correctness check skipped.")
+            print(f"{job_label} Summary: {data['final_result']}")
+            if "result_summary" in data:
+                print(f"{job_label} Stats: {data['result_summary']}")
+    else:
+        print(f"{job_label} ✅ Job completed (verification skipped for n > 1000)")
+        if isinstance(data.get("final_result"), str):
+            print(f"{job_label} Result: {data['final_result']}")
+            if "result_summary" in data:
+                print(f"{job_label} Stats: {data['result_summary']}")
+
+    if "worker_time_total" in data:
+        print(f"{job_label} 📊 Worker time: {data['worker_time_total']:.2f}s")
+    if "aggregation_time_sec" in data:
+        print(f"{job_label} 📊 Aggregation time: {data['aggregation_time_sec']:.2f}s")
+
+    return data
 
 if __name__ == "__main__":
     time.sleep(15)  # wait for containers to boot
@@ -258,12 +246,14 @@ if __name__ == "__main__":
     n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
     block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
     num_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    mode = sys.argv[4] if len(sys.argv) > 4 else "block"
 
     print("="*70)
     print(f"🚀 Distributed Matrix Multiplication - Real-Time Resource Monitor")
     print(f"   Matrix size: {n}×{n}")
     print(f"   Block size: {block_size}×{block_size}")
     print(f"   Concurrent jobs: {num_jobs}")
+    print(f"   Dispatch mode: {mode}")
     print(f"   Start time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("="*70)
 
@@ -285,13 +275,13 @@ if __name__ == "__main__":
         if num_jobs == 1:
             print("\n🔧 Running single job (optimized mode)\n")
             job_id = str(uuid.uuid4())
-            result = run_pipeline(n, block_size, job_id, SPLITTER_URL)
+            result = run_pipeline(n, block_size, job_id, SPLITTER_URL, mode)
             results = [result] if result else []
         else:
             print(f"\n🔧 Running {num_jobs} concurrent jobs\n")
             with ProcessPoolExecutor(max_workers=num_jobs) as executor:
                 futures = [
-                    executor.submit(run_pipeline, n, block_size, str(uuid.uuid4()), SPLITTER_URL)
+                    executor.submit(run_pipeline, n, block_size, str(uuid.uuid4()), SPLITTER_URL, mode)
                     for i in range(num_jobs)
                 ]
                 
@@ -0,0 +1,83 @@
+"""
+End-to-end benchmark: mode=block vs. mode=summa on a running stack.
+
+Submits the same random float32 A and B to the splitter in both modes,
+waits for the aggregator's result and the splitter's job status, and
+prints wall time and operand bytes shipped (measured and planned).
+
+    SPLITTER_URL=http://localhost:8000 AGGREGATOR_URL=http://aggregator:8002 \
+    WORKER_URLS=http://worker-1:8001,http://worker-2:8001 \
+        python benchmarks/bench_summa.py [size] [block_size]
+"""
+import io
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+import requests
+
+SPLITTER_URL = os.environ.get("SPLITTER_URL", "http://localhost:8000")
+AGGREGATOR_URL = os.environ.get("AGGREGATOR_URL", "http://aggregator:8002")
+WORKER_URL = os.environ.get("WORKER_URL", "http://worker:8001")
+WORKER_URLS = os.environ.get("WORKER_URLS", "")
+# The aggregator as seen from this machine, for polling the result
+AGGREGATOR_PUBLIC_URL = os.environ.get("AGGREGATOR_PUBLIC_URL", "http://localhost:8002")
+
+
+def npy_bytes(M):
+    buf = io.BytesIO()
+    np.save(buf, M, allow_pickle=False)
+    return buf.getvalue()
+
+
+def run(mode, A_npy, B_npy, block_size, timeout=600):
+    job_id = str(uuid.uuid4())
+    start = time.perf_counter()
+    resp = requests.post(f"{SPLITTER_URL}/split", files={
+        "A_file": ("A.npy", A_npy),
+        "B_file": ("B.npy", B_npy),
+    }, data={
+        "worker_url": WORKER_URL,
+        "worker_urls": WORKER_URLS,
+        "aggregator_url": AGGREGATOR_URL,
+        "block_size": block_size,
+        "job_id": job_id,
+        "mode": mode,
+        "use_cache": "false",
+    })
+    resp.raise_for_status()
+    planned = resp.json().get("assignment") or {}
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = requests.get(f"{SPLITTER_URL}/jobs/{job_id}").json()
+        if status["state"] in ("done", "failed"):
+            break
+        time.sleep(0.1)
+    result = requests.get(f"{AGGREGATOR_PUBLIC_URL}/aggregate/final_result/{job_id}").json()
+    elapsed = time.perf_counter() - start
+    return status, result, elapsed, planned
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    rng = np.random.default_rng(0)
+    A_npy = npy_bytes(rng.standard_normal((size, size)).astype(np.float32))
+    B_npy = npy_bytes(rng.standard_normal((size, size)).astype(np.float32))
+
+    print(f"{size}×{size} float32, block_size={block_size}")
+    print(f"{'mode':>6}  {'state':>7}  {'wall s':>8}  {'sent MB':>9}  {'planned MB':>10}")
+    for mode in ("block", "summa"):
+        status, result, elapsed, planned = run(mode, A_npy, B_npy, block_size)
+        if result.get("message") != "Aggregation complete":
+            print(f"⚠️ {mode} job did not complete: {result.get('message')}")
+        expected = planned.get("expected_bytes")
+        expected = f"{expected / 1e6:10.1f}" if expected else f"{'-':>10}"
+        print(f"{mode:>6}  {status['state']:>7}  {elapsed:8.2f}  {status['bytes_sent'] / 1e6:9.1f}  {expected}")
+
+
+if __name__ == "__main__":
+    main()
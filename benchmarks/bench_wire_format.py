@@ -0,0 +1,101 @@
+"""
+Microbenchmark: block frame vs. npy-in-multipart for one /multiply hop.
+
+Measures the sender side (serialize both operand blocks and build the
+request body) and the receiver side (parse the body back into arrays) for
+square float32 blocks, the way the splitter and worker did it before and
+after the binary frame.
+
+    python benchmarks/bench_wire_format.py [repeats]
+"""
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from python_multipart.multipart import MultipartParser
+from urllib3.filepost import encode_multipart_formdata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.common_utils import encode_frame, decode_frame  # noqa: E402
+
+BLOCK_SIZES = [100, 250, 500, 1000, 2000]
+META = {"job_id": "bench", "row_block": 0, "col_block": 0, "depth_block": 0,
+        "aggregator_url": "http://aggregator:8002"}
+
+
+def npy_multipart_encode(A, B):
+    fields = {key: str(value) for key, value in META.items()}
+    for name, block in (("A_file", A), ("B_file", B)):
+        buf = io.BytesIO()
+        np.save(buf, block, allow_pickle=False)
+        fields[name] = (f"{name}.npy", buf.getvalue(), "application/octet-stream")
+    return encode_multipart_formdata(fields)
+
+
+def npy_multipart_decode(body, content_type):
+    boundary = content_type.split("boundary=")[1].encode()
+    parts, current = {}, []
+
+    def on_part_data(data, start, end):
+        current.append(data[start:end])
+
+    def on_part_end():
+        parts[len(parts)] = b"".join(current)
+        current.clear()
+
+    parser = MultipartParser(boundary, {"on_part_data": on_part_data, "on_part_end": on_part_end})
+    parser.write(body)
+    parser.finalize()
+    # The last two parts are the operand files
+    return [np.load(io.BytesIO(parts[idx])) for idx in sorted(parts)[-2:]]
+
+
+def frame_encode(A, B):
+    return encode_frame(META, {"A": A, "B": B})
+
+
+def frame_decode(body):
+    _, arrays = decode_frame(body)
+    return arrays["A"], arrays["B"]
+
+
+def best_of(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rng = np.random.default_rng(0)
+
+    print(f"{'block':>6} | {'npy+multipart enc/dec (ms)':>27} | {'frame enc/dec (ms)':>19} | "
+          f"{'bytes npy':>11} | {'bytes frame':>11} | speedup")
+    print("-" * 100)
+    for b in BLOCK_SIZES:
+        # Blocks are sliced out of a larger memmap, so start non-contiguous
+        A = rng.standard_normal((b, 2 * b), dtype=np.float32)[:, :b]
+        B = rng.standard_normal((b, 2 * b), dtype=np.float32)[:, b:]
+
+        enc_npy, (body_npy, content_type) = best_of(lambda: npy_multipart_encode(A, B), repeats)
+        dec_npy, (A_npy, B_npy) = best_of(lambda: npy_multipart_decode(body_npy, content_type), repeats)
+        enc_frame, body_frame = best_of(lambda: frame_encode(A, B), repeats)
+        dec_frame, (A_frame, B_frame) = best_of(lambda: frame_decode(body_frame), repeats)
+
+        assert np.array_equal(A_npy, A) and np.array_equal(A_frame, A)
+        assert np.array_equal(B_npy, B) and np.array_equal(B_frame, B)
+
+        total_npy = enc_npy + dec_npy
+        total_frame = enc_frame + dec_frame
+        print(f"{b:>6} | {enc_npy * 1e3:>12.3f} / {dec_npy * 1e3:>12.3f} | "
+              f"{enc_frame * 1e3:>8.3f} / {dec_frame * 1e3:>8.3f} | "
+              f"{len(body_npy):>11} | {len(body_frame):>11} | {total_npy / total_frame:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import io
+import json
+import re
+import struct
+import zlib
+
+import numpy as np
+
+# Binary block frame shared by the splitter, workers and aggregator:
+#
+#   b"MMF1" | u32 header length | JSON header | pad | array 0 | pad | array 1 ...
+#
+# The JSON header holds the request metadata ("meta") and, for every
+# array, its name, dtype, shape and offset into the data section. The data
+# section and every array in it start on a 64-byte boundary, so receivers
+# can wrap the request body with np.frombuffer without copying.
+#
+# A scipy.sparse CSR/CSC matrix is sent as its data, indices and indptr
+# arrays: its header entry carries "format" and "shape" and the three
+# arrays as "parts". Other sparse formats are sent as CSR.
+FRAME_MAGIC = b"MMF1"
+FRAME_CONTENT_TYPE = "application/octet-stream"
+FRAME_ALIGN = 64
+
+
+def _padding(size):
+    return -size % FRAME_ALIGN
+
+
+def is_sparse(array):
+    """True for scipy.sparse matrices and arrays (without importing scipy)."""
+    return hasattr(array, "tocsr") and hasattr(array, "nnz")
+
+
+def array_nbytes(array):
+    """Payload bytes of a dense array or of a sparse matrix's components."""
+    if is_sparse(array):
+        array = array if array.format in ("csr", "csc") else array.tocsr()
+        return array.data.nbytes + array.indices.nbytes + array.indptr.nbytes
+    return array.nbytes
+
+
+def encode_frame(meta, arrays=None):
+    """Encode `meta` and a dict of named arrays into one frame (a single copy)."""
+    entries, chunks = [], []
+    offset = 0
+
+    def add(array):
+        nonlocal offset
+        array = np.ascontiguousarray(array)
+        entry = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        chunks.append(memoryview(array.reshape(-1).view(np.uint8)))
+        chunks.append(b"\0" * _padding(array.nbytes))
+        offset += array.nbytes + _padding(array.nbytes)
+        return entry
+
+    for name, array in (arrays or {}).items():
+        if is_sparse(array):
+            if array.format not in ("csr", "csc"):
+                array = array.tocsr()
+            entries.append({
+                "name": name,
+                "format": array.format,
+                "shape": list(array.shape),
+                "parts": [add(array.data), add(array.indices), add(array.indptr)],
+            })
+        else:
+            entries.append({"name": name, **add(array)})
+
+    header = json.dumps({"meta": meta, "arrays": entries}).encode()
+    prefix = FRAME_MAGIC + struct.pack("<I", len(header)) + header
+    return b"".join([prefix, b"\0" * _padding(len(prefix)), *chunks])
+
+
+def decode_frame(body):
+    """
+    Decode a frame into (meta, arrays). The arrays are read-only views of
+    `body`; raises ValueError if `body` is not a valid frame.
+    """
+    if len(body) < 8 or body[:4] != FRAME_MAGIC:
+        raise ValueError("Not a block frame (bad magic)")
+    (header_len,) = struct.unpack_from("<I", body, 4)
+    if 8 + header_len > len(body):
+        raise ValueError("Truncated block frame header")
+    header = json.loads(bytes(body[8:8 + header_len]))
+
+    data_start = 8 + header_len + _padding(8 + header_len)
+
+    def view(name, entry):
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        count = int(np.prod(shape))
+        start = data_start + entry["offset"]
+        if start + count * dtype.itemsize > len(body):
+            raise ValueError(f"Truncated block frame array '{name}'")
+        return np.frombuffer(body, dtype=dtype, count=count, offset=start).reshape(shape)
+
+    arrays = {}
+    for entry in header["arrays"]:
+        name = entry["name"]
+        if "format" in entry:
+            # Only frames that carry sparse operands need scipy
+            import scipy.sparse as sp
+
+            matrix_cls = {"csr": sp.csr_matrix, "csc": sp.csc_matrix}.get(entry["format"])
+            if matrix_cls is None:
+                raise ValueError(f"Unsupported sparse format '{entry['format']}' for '{name}'")
+            data, indices, indptr = (view(name, part) for part in entry["parts"])
+            arrays[name] = matrix_cls((data, indices, indptr), shape=tuple(entry["shape"]))
+        else:
+            arrays[name] = view(name, entry)
+    return header["meta"], arrays
+
+
+# Sharded aggregator: the output tiles of a job are spread over N shards
+# by a hash of (job_id, row_block, col_block) that every service computes
+# the same way. An aggregator_url listing several comma-separated URLs
+# names the shards in shard-index order.
+
+
+def tile_shard(job_id, row_block, col_block, shards):
+    """Index of the shard owning output tile (row_block, col_block) of job_id."""
+    return zlib.crc32(f"{job_id}:{row_block}:{col_block}".encode()) % shards
+
+
+def shard_url(aggregator_url, meta):
+    """URL a block with this meta is submitted to (its tile's shard, if sharded)."""
+    if "," not in aggregator_url:
+        return aggregator_url
+    shards = aggregator_url.split(",")
+    return shards[tile_shard(meta["job_id"], meta["row_block"], meta["col_block"], len(shards))]
+
+
+# Helpers shared by a single aggregator and the front of a sharded one:
+# the progress event stream, result summaries and ranged .npy downloads.
+
+# Server-Sent Events: keep-alive comment interval and minimum spacing of
+# progress events (the completion event is never delayed)
+SSE_HEARTBEAT_SEC = 15.0
+SSE_MIN_INTERVAL_SEC = 0.25
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def merge_stats(a, b):
+    """Combine two partial summaries (Chan et al. parallel variance)."""
+    if a is None:
+        return b
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    return {
+        "count": count,
+        "min": min(a["min"], b["min"]),
+        "max": max(a["max"], b["max"]),
+        "mean": a["mean"] + delta * b["count"] / count,
+        "m2": a["m2"] + b["m2"] + delta * delta * a["count"] * b["count"] / count,
+    }
+
+
+def npy_header(dtype, shape):
+    buf = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buf, {
+        "descr": np.lib.format.dtype_to_descr(dtype),
+        "fortran_order": False,
+        "shape": tuple(shape),
+    })
+    return buf.getvalue()
+
+
+def parse_range(header, size):
+    """Parse a single-range "bytes=a-b" header into a half-open [start, end), or None."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    if start >= end:
+        return None
+    return start, end
@@ -4,7 +4,9 @@ import time
 import uuid
 import sys
 import io
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from submit import submit_job, wait_for_result
 
 # --- service URLs ---
 SPLITTER_URL = "http://splitter:8000"
@@ -14,7 +16,29 @@ def create_matrix(n, identity=False):
     dtype = np.float32
     return np.eye(n, dtype=dtype) if identity else np.arange(1, n * n + 1, dtype=dtype).reshape(n, n)
 
-def run_pipeline(n=10, block_size=500, job_id=None, splitter_url=SPLITTER_URL):
+def download_result(job_id, shape, dtype, path, bands=4):
+    """
+    Download C from the aggregator's .npy endpoint straight into an .npy
+    file at `path`, fetching `bands` row bands in parallel.
+    """
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.dtype(dtype), shape=tuple(shape))
+    rows = shape[0]
+    step = max(1, -(-rows // bands))
+    url = f"{AGGREGATOR_URL}/aggregate/result/{job_id}.npy"
+
+    def fetch(row_start):
+        row_end = min(row_start + step, rows)
+        r = requests.get(url, params={"row_start": row_start, "row_end": row_end}, timeout=600)
+        r.raise_for_status()
+        out[row_start:row_end] = np.load(io.BytesIO(r.content))
+
+    with ThreadPoolExecutor(max_workers=bands) as executor:
+        list(executor.map(fetch, range(0, rows, step)))
+    out.flush()
+    return path
+
+
+def run_pipeline(n=10, block_size="auto", job_id=None, splitter_url=SPLITTER_URL, mode="block"):
     job_label = f"[Job-{job_id[:8]}]" if job_id is not None else ""
     print(f"{job_label}  Creating matrices A({n}x{n}) and B({n}x{n})")
 
@@ -36,88 +60,82 @@ def run_pipeline(n=10, block_size=500, job_id=None, splitter_url=SPLITTER_URL):
     
     data = {
         "block_size": str(block_size),
+        "mode": mode,
         "worker_url": "http://worker:8001",
         "aggregator_url": AGGREGATOR_URL,
         "job_id": job_id
     }
 
     try:
-        resp = requests.post(f"{SPLITTER_URL}/split", files=files, data=data, timeout=1200)
+        resp = submit_job(SPLITTER_URL, files, data, job_label)
         resp.raise_for_status()
     except Exception as e:
         print(f"{job_label}  Splitter request failed: {e}")
         return None
 
     job_info = resp.json()
-    print(f"{job_label}  Splitter accepted job {job_id[:8]}, dispatched {job_info.get('blocks_dispatched', '?')} blocks")
+    print(f"{job_label}  Splitter accepted job {job_id[:8]}, queued {job_info.get('blocks_total', '?')} blocks")
+    if "tiling" in job_info:
+        print(f"{job_label}  Tiling: {job_info['tiling']['tile_shape']} tiles, depth {job_info['tiling']['depth']}")
 
-    # --- Poll aggregator for completion ---
-    result_url = f"{AGGREGATOR_URL}/aggregate/final_result/{job_id}"
+    # --- Follow the aggregator's event stream until completion ---
     print(f"{job_label}  Waiting for aggregator result...")
+    data = wait_for_result(AGGREGATOR_URL, job_id, job_label)
+    if data is None:
+        print(f"{job_label}  Aggregator timeout after 45 minutes.")
+        return None
 
-    for attempt in range(900):
-        time.sleep(3)
-        try:
-            r = requests.get(result_url, timeout=1000)
-            if r.status_code == 404:
-                # Print progress every minute
-                if attempt % 20 == 0 and attempt > 0:
-                    print(f"{job_label}  Still waiting... ({attempt * 3}s elapsed)")
-                continue
-            
-            data = r.json()
-            if data.get("message") == "Aggregation complete":
-                print(f"{job_label}  Final result ready! Shape: {data['shape']}")
-                
-                # OPTIMIZATION 1: Only verify correctness for small matrices
-                if n <= 1000:  # Skip verification for large matrices
-                    if isinstance(data.get("final_result"), list):
-                        print(f"{job_label}  Verifying correctness...")
-                        final = np.array(data["final_result"], dtype=np.float32)
-                        expected = A @ B
-                        if np.allclose(final, expected, rtol=1e-3, atol=1e-4):
-                            print(f"{job_label}  Correct final matrix.")
-                        else:
-                            print(f"{job_label}  Incorrect matrix result!")
-                    elif isinstance(data.get("final_result"), str):
-                        print(f"{job_label}  Large matrix — correctness check skipped.")
-                        print(f"{job_label} Summary: {data['final_result']}")
-                        if "result_summary" in data:
-                            print(f"{job_label} Stats: {data['result_summary']}")
-                else:
-                    #  For very large matrices, skip verification entirely
-                    print(f"{job_label}  Job completed (verification skipped for n > 1000)")
-                    if isinstance(data.get("final_result"), str):
-                        print(f"{job_label} Result: {data['final_result']}")
-                        if "result_summary" in data:
-                            print(f"{job_label} Stats: {data['result_summary']}")
-                
-                # Print timing stats if available
-                if "worker_time_total" in data:
-                    print(f"{job_label}  Worker time: {data['worker_time_total']:.2f}s")
-                if "aggregation_time_sec" in data:
-                    print(f"{job_label}  Aggregation time: {data['aggregation_time_sec']:.2f}s")
-
-                return data
-        except Exception as e:
-            if attempt % 20 == 0 and attempt > 0:
-                print(f"{job_label}  Poll error (attempt {attempt}): {e}")
-            continue
-    
-    print(f"{job_label}  Aggregator timeout after 45 minutes.")
-    return None
+    print(f"{job_label}  Final result ready! Shape: {data['shape']}")
+
+    try:
+        result_path = download_result(
+            job_id, data["shape"], data["dtype"],
+            f"/app/results/final_result_{job_id}.npy"
+        )
+    except requests.RequestException as e:
+        print(f"{job_label}  Result download failed: {e}")
+        return None
+    data["result_path"] = result_path
+    print(f"{job_label}  Downloaded result to {result_path}")
+
+    # OPTIMIZATION 1: Only verify correctness for small matrices
+    if n <= 1000:  # Skip verification for large matrices
+        print(f"{job_label}  Verifying correctness...")
+        final = np.load(result_path, mmap_mode="r")
+        expected = A @ B
+        if np.allclose(final, expected, rtol=1e-3, atol=1e-4):
+            print(f"{job_label}  Correct final matrix.")
+        else:
+            print(f"{job_label}  Incorrect matrix result!")
+    else:
+        #  For very large matrices, skip verification entirely
+        print(f"{job_label}  Job completed (verification skipped for n > 1000)")
+        if isinstance(data.get("final_result"), str):
+            print(f"{job_label} Result: {data['final_result']}")
+            if "result_summary" in data:
+                print(f"{job_label} Stats: {data['result_summary']}")
+
+    # Print timing stats if available
+    if "worker_time_total" in data:
+        print(f"{job_label}  Worker time: {data['worker_time_total']:.2f}s")
+    if "aggregation_time_sec" in data:
+        print(f"{job_label}  Aggregation time: {data['aggregation_time_sec']:.2f}s")
+
+    return data
 
 if __name__ == "__main__":
     time.sleep(15)  # wait for containers to boot
     n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
-    block_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    block_size = sys.argv[2] if len(sys.argv) > 2 else "auto"
     num_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    mode = sys.argv[4] if len(sys.argv) > 4 else "block"
 
     print("="*70)
     print(f"   Distributed Matrix Multiplication")
     print(f"   Matrix size: {n}×{n}")
-    print(f"   Block size: {block_size}×{block_size}")
+    print(f"   Block size: {block_size}")
     print(f"   Concurrent jobs: {num_jobs}")
+    print(f"   Dispatch mode: {mode}")
     print("="*70)
 
     start = time.time()
@@ -126,14 +144,14 @@ if __name__ == "__main__":
     if num_jobs == 1:
         print("\n Running single job (optimized mode)")
         job_id = str(uuid.uuid4())
-        result = run_pipeline(n, block_size, job_id, SPLITTER_URL)
+        result = run_pipeline(n, block_size, job_id, SPLITTER_URL, mode)
         results = [result] if result else []
     else:
         print(f"\n Running {num_jobs} concurrent jobs")
         with ProcessPoolExecutor(max_workers=num_jobs) as executor:
             # Each job gets a unique ID - no sharing
             futures = [
-                executor.submit(run_pipeline, n, block_size, str(uuid.uuid4()), SPLITTER_URL)
+                executor.submit(run_pipeline, n, block_size, str(uuid.uuid4()), SPLITTER_URL, mode)
                 for i in range(num_jobs)
             ]
             
@@ -144,11 +162,8 @@ if __name__ == "__main__":
                     results.append(result)
     
     end = time.time()
-    if len(results) > 0:
-        final_result = np.array(results[0]["final_result"])
-        job_id = results[0]["job_id"]
-        np.savetxt(f"/app/results/final_result_{job_id}.csv", final_result, delimiter=",")
-        print(f"Saved final_result_{job_id}.csv")
+    for result in results:
+        print(f"Saved {result['result_path']}")
 
     
     print("\n" + "="*70)
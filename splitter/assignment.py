@@ -0,0 +1,154 @@
+import os
+import socket
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from common.common_utils import is_sparse
+
+
+def discover_workers(worker_url, worker_urls=None):
+    """
+    Return the base URLs of the individual worker instances: the explicit
+    comma-separated `worker_urls` (or SPLITTER_WORKER_URLS), else every
+    address the worker_url host resolves to (one per replica behind a
+    Docker service name), else worker_url itself.
+    """
+    listed = worker_urls or os.environ.get("SPLITTER_WORKER_URLS", "")
+    urls = [url.strip().rstrip("/") for url in listed.split(",") if url.strip()]
+    if urls:
+        return urls
+
+    parts = urlsplit(worker_url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        infos = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        print(f"⚠️ Could not resolve workers behind {worker_url}: {e}")
+        return [worker_url]
+
+    hosts = sorted({info[4][0] for info in infos})
+    return [f"{parts.scheme}://{f'[{host}]' if ':' in host else host}:{port}" for host in hosts]
+
+
+def choose_grid(workers, row_blocks, col_blocks, A_total, B_total):
+    """
+    Pick a pr × pc processor grid (pr * pc <= workers). Worker (p, q) owns
+    a contiguous range of tile rows and tile columns, so it needs 1/pr of
+    A and 1/pc of B and the shipped bytes are about pc·|A| + pr·|B|. Grids
+    using more workers win, then the cheaper one.
+    """
+    best = None
+    for pr in range(1, min(workers, row_blocks) + 1):
+        pc = min(workers // pr, col_blocks)
+        key = (-pr * pc, pc * A_total + pr * B_total)
+        if best is None or key < best[0]:
+            best = (key, (pr, pc))
+    return best[1]
+
+
+def grid_owner(pr, pc, row_blocks, col_blocks):
+    """Map output tile (i, j) to its worker index on a pr × pc grid."""
+    def owner(i, j):
+        return (i * pr // row_blocks) * pc + (j * pc // col_blocks)
+    return owner
+
+
+def tile_bytes(M, row_size, col_size):
+    """Bytes of every (row_size × col_size) tile of M as it goes on the wire."""
+    rows, cols = M.shape
+    row_sizes = np.diff(np.append(np.arange(0, rows, row_size), rows))
+    col_sizes = np.diff(np.append(np.arange(0, cols, col_size), cols))
+    if is_sparse(M):
+        coo = M.tocoo()
+        nnz = np.zeros((len(row_sizes), len(col_sizes)), dtype=np.int64)
+        np.add.at(nnz, (coo.row // row_size, coo.col // col_size), 1)
+        per_nnz = M.dtype.itemsize + np.dtype(np.int32).itemsize
+        # Plus one indptr entry per row (CSR) or column (CSC) of the slice
+        pointers = row_sizes[:, None] if M.format == "csr" else col_sizes[None, :]
+        return nnz * per_nnz + (pointers + 1) * np.dtype(np.int32).itemsize
+    return np.outer(row_sizes, col_sizes) * M.dtype.itemsize
+
+
+def shipped_bytes(tasks, owners, A_bytes, B_bytes, cached):
+    """
+    Operand bytes sent for `tasks` ((N, 3) array of i, j, k) given each
+    task's worker. With worker caches every worker receives each operand
+    block it needs once; without them every task carries both operands.
+    """
+    i, j, k = tasks[:, 0], tasks[:, 1], tasks[:, 2]
+    if not cached:
+        return int(A_bytes[i, k].sum() + B_bytes[k, j].sum())
+
+    depth = A_bytes.shape[1]
+    a_keys = np.unique((owners * A_bytes.shape[0] + i) * depth + k)
+    b_keys = np.unique((owners * depth + k) * B_bytes.shape[1] + j)
+    a_sent = A_bytes[(a_keys // depth) % A_bytes.shape[0], a_keys % depth].sum()
+    b_sent = B_bytes[(b_keys // B_bytes.shape[1]) % depth, b_keys % B_bytes.shape[1]].sum()
+    return int(a_sent + b_sent)
+
+
+def interleave_units(tasks, owners, batch_size):
+    """
+    Split tasks into units of up to batch_size tasks with a single owner,
+    ordered so that consecutive units go to different workers.
+    """
+    rank = np.zeros(len(tasks), dtype=np.int64)
+    for owner in np.unique(owners):
+        mask = owners == owner
+        rank[mask] = np.arange(mask.sum())
+    group = rank // batch_size
+    order = np.lexsort((rank, owners, group))
+    tasks, owners, group = tasks[order], owners[order], group[order]
+    starts = np.flatnonzero(np.r_[True, (group[1:] != group[:-1]) | (owners[1:] != owners[:-1])])
+    for start, end in zip(starts, np.r_[starts[1:], len(tasks)]):
+        yield [tuple(int(x) for x in task) for task in tasks[start:end]]
+
+
+def plan_grid(workers, A, B, br, bc, bk, A_occ, B_occ, cached):
+    """
+    Choose the processor grid for `workers` instances and estimate the
+    operand bytes shipped with it and with naive round-robin of the tasks
+    (A is cut into br × bk tiles and B into bk × bc).
+    """
+    A_bytes, B_bytes = tile_bytes(A, br, bk), tile_bytes(B, bk, bc)
+    row_blocks, col_blocks = A_occ.shape[0], B_occ.shape[1]
+    pr, pc = choose_grid(len(workers), row_blocks, col_blocks,
+                         int(A_bytes[A_occ].sum()), int(B_bytes[B_occ].sum()))
+
+    tasks = np.argwhere(A_occ[:, None, :] & B_occ.T[None, :, :])
+    owners = grid_owner(pr, pc, row_blocks, col_blocks)(tasks[:, 0], tasks[:, 1])
+    round_robin = np.arange(len(tasks)) % len(workers)
+    return {
+        "mode": "grid",
+        "workers": workers,
+        "grid": [pr, pc],
+        "operand_cache": cached,
+        "expected_bytes": shipped_bytes(tasks, owners, A_bytes, B_bytes, cached),
+        "round_robin_bytes": shipped_bytes(tasks, round_robin, A_bytes, B_bytes, cached),
+    }
+
+
+def plan_summa(workers, A, B, panel_width):
+    """
+    Lay out a SUMMA job: one C tile per worker on a pr × pc grid and
+    ceil(n / panel_width) steps. Every step sends grid row p its slice of
+    the A panel and grid column q its slice of the B panel, so worker
+    (p, q) receives A[rows_p, :] and B[:, cols_q] once in total:
+    pc·|A| + pr·|B| bytes, against ceil(p/b)·|A| + ceil(m/b)·|B| for
+    block mode without the operand cache.
+    """
+    (m, n), p = A.shape, B.shape[1]
+    A_total, B_total = m * n * A.dtype.itemsize, n * p * B.dtype.itemsize
+    pr, pc = choose_grid(len(workers), m, p, A_total, B_total)
+    tile_rows, tile_cols = -(-m // pr), -(-p // pc)
+    pr, pc = -(-m // tile_rows), -(-p // tile_cols)
+    return {
+        "mode": "summa",
+        "workers": workers[:pr * pc],
+        "grid": [pr, pc],
+        "tile_shape": [tile_rows, tile_cols],
+        "steps": -(-n // panel_width),
+        "expected_bytes": pc * A_total + pr * B_total,
+        "block_mode_bytes": -(-p // panel_width) * A_total + -(-m // panel_width) * B_total,
+    }
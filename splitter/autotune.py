@@ -0,0 +1,124 @@
+import math
+import threading
+from collections import deque
+
+import numpy as np
+
+# Tile sizes tried for every dimension, besides even splits of it into
+# SPLIT_PARTS parts (or 1, 2 and 4 per worker)
+CANDIDATE_SIZES = (32, 64, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096)
+SPLIT_PARTS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64)
+
+
+class CostModel:
+    """
+    Model of one worker request: a fixed overhead, the transfer of its
+    bytes, and the product at the workers' GFLOP/s.
+
+    It is fitted to the most recent `window` requests of all jobs:
+    GFLOP/s from the compute time the workers report, and the overhead
+    and bandwidth from a line through (bytes, latency - compute time).
+    Until `min_samples` requests have been seen the given defaults are
+    used.
+    """
+
+    def __init__(self, overhead_sec=0.005, bytes_per_sec=200e6, gflops=10.0, window=256, min_samples=8):
+        self.overhead_sec = overhead_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.gflops = gflops
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, flops, nbytes, latency_sec, compute_sec):
+        with self._lock:
+            self._samples.append((flops, nbytes, latency_sec, compute_sec))
+
+    def estimate(self):
+        with self._lock:
+            samples = np.array(self._samples, dtype=np.float64).reshape(-1, 4)
+        model = {
+            "overhead_sec": self.overhead_sec,
+            "bytes_per_sec": self.bytes_per_sec,
+            "gflops": self.gflops,
+            "samples": len(samples),
+        }
+        if len(samples) < self.min_samples:
+            return model
+
+        flops, nbytes, latency, compute = samples.T
+        if compute.sum() > 0 and flops.sum() > 0:
+            model["gflops"] = float(flops.sum() / compute.sum() / 1e9)
+        transfer = np.maximum(latency - compute, 0.0)
+        if nbytes.std() > 0:
+            slope, intercept = np.polyfit(nbytes, transfer, 1)
+            if slope > 0:
+                model["bytes_per_sec"] = float(1.0 / slope)
+                model["overhead_sec"] = float(max(intercept, 1e-4))
+                return model
+        model["overhead_sec"] = float(max(transfer.mean() - nbytes.mean() / model["bytes_per_sec"], 1e-4))
+        return model
+
+
+def candidates(dim, workers, fixed=None):
+    """
+    Tile sizes to try for a dimension: the fixed sizes and even splits into
+    SPLIT_PARTS or 1, 2 and 4 per worker parts. At most
+    len(CANDIDATE_SIZES) + len(SPLIT_PARTS) + 3 sizes, whatever the
+    dimension and worker count.
+    """
+    if fixed is not None:
+        return [fixed]
+    parts = {count for count in SPLIT_PARTS + (workers, 2 * workers, 4 * workers) if count <= dim}
+    splits = {math.ceil(dim / count) for count in parts}
+    return sorted(splits | {size for size in CANDIDATE_SIZES if size < dim})
+
+
+def choose_tiling(m, n, p, itemsize, workers, model, batch_size, max_task_bytes,
+                  rows=None, cols=None, depth=None, flop_scale=1.0):
+    """
+    Pick the (rows × depth) · (depth × cols) task shape for C = A(m×n) ×
+    B(n×p) with the lowest predicted time on `workers` workers. Tasks
+    are packed `batch_size(rows, cols, depth)` to a request and requests
+    run in waves of one per worker, each costing the model's overhead
+    plus the transfer and product of its tasks, so small tiles pay
+    overhead on every request and large ones leave workers idle.
+    `rows`, `cols` or `depth` fix that dimension; flop_scale scales the
+    product (the density of sparse operands). Tasks whose operands
+    exceed max_task_bytes are only picked if nothing smaller is possible.
+
+    The candidates of every dimension are bounded (see candidates), and
+    depths past max_task_bytes are skipped, so the search takes constant
+    time whatever the sizes and worker count.
+    """
+    est = model.estimate()
+    workers = max(1, workers)
+    depths = candidates(n, workers, depth)
+    best = None
+    for br in candidates(m, workers, rows):
+        for bc in candidates(p, workers, cols):
+            tiles = math.ceil(m / br) * math.ceil(p / bc)
+            for bk in depths:
+                operand_bytes = (br * bk + bk * bc) * itemsize
+                if operand_bytes > max_task_bytes and bk != depths[0]:
+                    # Depths are ascending: the rest are over the bound too
+                    break
+                tasks = tiles * math.ceil(n / bk)
+                batch = batch_size(br, bc, bk)
+                requests = math.ceil(tasks / batch)
+                per_task = ((operand_bytes + br * bc * itemsize) / est["bytes_per_sec"]
+                            + flop_scale * 2.0 * br * bc * bk / (est["gflops"] * 1e9))
+                per_request = est["overhead_sec"] + min(batch, tasks) * per_task
+                cost = math.ceil(requests / workers) * per_request
+                # Ties go to the larger tasks (fewer partials to aggregate)
+                key = (operand_bytes > max_task_bytes, cost, -br * bc * bk)
+                if best is None or key < best[0]:
+                    best = (key, {
+                        "tile_shape": [br, bc],
+                        "depth": bk,
+                        "tasks": tasks,
+                        "requests": requests,
+                        "batch_size": batch,
+                        "estimated_sec": cost,
+                    })
+    return {**best[1], "workers": workers, "model": est}
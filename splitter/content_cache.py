@@ -0,0 +1,115 @@
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+
+class ContentCache:
+    """
+    Disk-backed LRU of files keyed by content: uploaded operands by the
+    hash of their bytes, finished results by the memo key of the job that
+    produced them. Bounded by `max_bytes` in total; entries unused for
+    `ttl_sec` are dropped. The index is rebuilt from the directory on
+    startup (file mtimes are the last use), so entries survive restarts.
+
+    Evicting a file only unlinks it, so jobs that still have it
+    memory-mapped keep reading it.
+    """
+
+    def __init__(self, root: str, max_bytes: int, ttl_sec: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for name in os.listdir(root):
+            st = os.stat(os.path.join(root, name))
+            found.append((st.st_mtime, name, st.st_size))
+        for mtime, name, size in sorted(found):
+            self._entries[name] = [size, mtime]
+            self._bytes += size
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def get(self, name: str):
+        """Return the path of a cached entry (marking it used), or None."""
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(name)
+            if entry is not None:
+                try:
+                    # Under the lock, so a concurrent put cannot evict it first
+                    os.utime(self.path(name))
+                except FileNotFoundError:
+                    # Deleted behind the cache's back: forget it
+                    self._entries.pop(name)
+                    self._bytes -= entry[0]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            entry[1] = time.time()
+            self.hits += 1
+        return self.path(name)
+
+    def put(self, name: str, src: str):
+        """
+        Move the file at `src` into the cache as `name` and return its new
+        path. If `name` is cached already `src` is deleted and the cached
+        copy returned; if the file is larger than the whole cache it is
+        left where it is and None is returned.
+        """
+        size = os.path.getsize(src)
+        if size > self.max_bytes:
+            return None
+        with self._lock:
+            self._evict_expired()
+            if name in self._entries:
+                os.remove(src)
+                self._entries.move_to_end(name)
+                self._entries[name][1] = time.time()
+                return self.path(name)
+            while self._entries and self._bytes + size > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+            shutil.move(src, self.path(name))
+            self._entries[name] = [size, time.time()]
+            self._bytes += size
+        return self.path(name)
+
+    def _evict(self, name):
+        size, _ = self._entries.pop(name)
+        self._bytes -= size
+        self.evictions += 1
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.ttl_sec
+        for name in [name for name, (_, used) in self._entries.items() if used < cutoff]:
+            self._evict(name)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_sec": self.ttl_sec,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,176 @@
+import asyncio
+import time
+from collections import deque
+
+import httpx
+
+
+class LatencyTracker:
+    """
+    Sliding window of successful request latencies, used to decide when a
+    request is late enough to be worth a speculative copy.
+    """
+
+    def __init__(self, percentile=95.0, factor=2.0, min_deadline=0.5, min_samples=20, window=512):
+        self.percentile = percentile
+        self.factor = factor
+        self.min_deadline = min_deadline
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self._samples.append(seconds)
+
+    def deadline(self):
+        """Seconds after which a request counts as straggling, or None until enough samples."""
+        if len(self._samples) < self.min_samples:
+            return None
+        samples = sorted(self._samples)
+        rank = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_deadline, samples[rank] * self.factor)
+
+    def stats(self):
+        samples = sorted(self._samples)
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "p50_sec": samples[len(samples) // 2],
+            "max_sec": samples[-1],
+            "deadline_sec": self.deadline(),
+        }
+
+
+class Dispatcher:
+    """
+    Async block dispatcher with one persistent keep-alive connection pool
+    per endpoint.
+
+    Blocks are prepared (sliced out of the memmap and serialized) by a few
+    producer coroutines running `prepare` in threads, and handed through a
+    bounded queue to `window` sender coroutines, so at most `window`
+    requests are in flight and at most `window` prepared blocks wait in
+    memory per job.
+
+    `send_hedged` wraps a send with retries and speculative copies for
+    stragglers, driven by a per-job LatencyTracker.
+    """
+
+    def __init__(self, pool_size: int = 32, timeout: float = 30.0):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._clients = {}
+        self.retries = 0
+        self.speculative = 0
+
+    def client(self, base_url: str) -> httpx.AsyncClient:
+        """Return the pooled client for `base_url`, creating it on first use."""
+        client = self._clients.get(base_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                ),
+            )
+            self._clients[base_url] = client
+        return client
+
+    async def dispatch(self, tasks, prepare, send, window=16, producers=2, on_result=None):
+        """
+        Run `prepare(task)` in a thread for every task and `await send(item)`
+        on the result. `send` returns True on success. Returns the number of
+        (succeeded, failed) tasks; `on_result(task, ok)` is called after each
+        one.
+        """
+        queue = asyncio.Queue(maxsize=window)
+        task_iter = iter(tasks)
+        counts = {"ok": 0, "failed": 0}
+
+        def record(task, ok):
+            counts["ok" if ok else "failed"] += 1
+            if on_result is not None:
+                on_result(task, ok)
+
+        async def produce():
+            # Producers share one iterator, so each task is prepared once
+            for task in task_iter:
+                try:
+                    item = await asyncio.to_thread(prepare, task)
+                except Exception as e:
+                    print(f"❌ Failed to prepare task {task}: {e}")
+                    record(task, False)
+                    continue
+                await queue.put((task, item))
+
+        async def consume():
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    return
+                task, item = entry
+                try:
+                    ok = await send(item)
+                except Exception as e:
+                    print(f"❌ Send failed: {e}")
+                    ok = False
+                record(task, ok)
+
+        senders = [asyncio.create_task(consume()) for _ in range(window)]
+        try:
+            await asyncio.gather(*(produce() for _ in range(producers)))
+        finally:
+            for _ in senders:
+                await queue.put(None)
+            await asyncio.gather(*senders)
+
+        return counts["ok"], counts["failed"]
+
+    async def send_hedged(self, send, item, latency, attempts=3, backoff=0.1):
+        """
+        Await `send(item)` with retries and speculative copies. If an attempt
+        fails, or is still running at `latency.deadline()`, another copy is
+        started (failures back off exponentially) while the earlier ones keep
+        going; the first success wins and the rest are cancelled. At most
+        `attempts` copies are started. Receivers must tolerate duplicates.
+        Returns True on success.
+        """
+        async def attempt(delay):
+            if delay:
+                await asyncio.sleep(delay)
+            start = time.perf_counter()
+            ok = await send(item)
+            if ok:
+                latency.observe(time.perf_counter() - start)
+            return ok
+
+        started, failures = 1, 0
+        pending = {asyncio.create_task(attempt(0))}
+        try:
+            while pending:
+                timeout = latency.deadline() if started < attempts else None
+                done, pending = await asyncio.wait(pending, timeout=timeout,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result():
+                        return True
+                    failures += 1
+                if started < attempts:
+                    if not done:
+                        self.speculative += 1
+                    else:
+                        self.retries += 1
+                    delay = backoff * 2 ** (failures - 1) if done else 0
+                    pending.add(asyncio.create_task(attempt(delay)))
+                    started += 1
+            return False
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
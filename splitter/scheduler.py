@@ -0,0 +1,346 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class LeaseScheduler:
+    """
+    Pull-based task queue: workers lease batches of (i,j,k) tasks instead
+    of having blocks pushed at them, so faster or idle workers take more.
+
+    Each job's tasks are drawn lazily from its task iterator. A lease
+    hands up to the job's batch size of them to one worker until
+    `lease_timeout` seconds pass; tasks of expired or failed leases are
+    queued again ahead of fresh ones, up to `max_attempts` times.
+
+    With fairness="fair" every lease goes to the job with the lowest
+    virtual time (tasks leased / weight, starting from the current
+    minimum when the job arrives), so concurrent jobs share the workers in
+    proportion to their weights; with fairness="fifo" the oldest job is
+    drained first.
+
+    A job's priority comes before fairness: leases go to the jobs with
+    the highest priority that have tasks left.
+    """
+
+    def __init__(self, lease_timeout=60.0, max_attempts=3, fairness="fair"):
+        if fairness not in ("fair", "fifo"):
+            raise ValueError(f"Unknown fairness policy '{fairness}' (expected 'fair' or 'fifo')")
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.fairness = fairness
+        self._jobs = {}
+        self._leases = {}
+        self._lease_ids = itertools.count(1)
+        self._work_available = asyncio.Event()
+        self.workers = {}
+        self.expired = 0
+
+    async def run(self, job_id, tasks, total, batch_size, build, on_result, weight=1.0, priority=0):
+        """
+        Offer the `total` tasks of job_id for lease and wait until every
+        task is completed or has used up its attempts. `build(tasks)`
+        produces the lease payload (run in a thread) and `on_result(tasks,
+        ok)` is called as leases complete or tasks are given up on.
+        """
+        if total == 0:
+            return
+        job = {
+            "fresh": iter(tasks),
+            "unleased": total,
+            "retry": deque(),
+            "attempts": {},
+            "remaining": total,
+            "batch_size": batch_size,
+            "weight": weight,
+            "priority": priority,
+            "leased": 0,
+            "vtime": min((other["vtime"] for other in self._jobs.values()), default=0.0),
+            "build": build,
+            "on_result": on_result,
+            "done": asyncio.Event(),
+        }
+        self._jobs[job_id] = job
+        self._work_available.set()
+        try:
+            await job["done"].wait()
+        finally:
+            del self._jobs[job_id]
+
+    def _pick_job(self):
+        candidates = [(job_id, job) for job_id, job in self._jobs.items()
+                      if job["retry"] or job["unleased"]]
+        if not candidates:
+            return None
+        top = max(job["priority"] for _, job in candidates)
+        candidates = [(job_id, job) for job_id, job in candidates if job["priority"] == top]
+        if self.fairness == "fifo":
+            return candidates[0]
+        return min(candidates, key=lambda item: item[1]["vtime"])
+
+    async def lease(self, worker_id, max_tasks, wait_sec):
+        """
+        Lease up to max_tasks tasks of one job, waiting up to wait_sec for
+        work. Returns (lease_id, job_id, tasks, build) or None.
+        """
+        deadline = time.monotonic() + wait_sec
+        while True:
+            self._expire_leases()
+            picked = self._pick_job()
+            if picked is not None:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._work_available.clear()
+            try:
+                await asyncio.wait_for(self._work_available.wait(), min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+        job_id, job = picked
+        tasks, size = [], min(max_tasks, job["batch_size"])
+        while job["retry"] and len(tasks) < size:
+            tasks.append(job["retry"].popleft())
+        while job["unleased"] and len(tasks) < size:
+            tasks.append(next(job["fresh"]))
+            job["unleased"] -= 1
+        job["leased"] += len(tasks)
+        job["vtime"] += len(tasks) / job["weight"]
+
+        lease_id = f"{worker_id}-{next(self._lease_ids)}"
+        self._leases[lease_id] = {
+            "job_id": job_id,
+            "tasks": tasks,
+            "worker_id": worker_id,
+            "expires": time.monotonic() + self.lease_timeout,
+        }
+        worker = self.workers.setdefault(worker_id, {"leased": 0, "completed": 0, "failed": 0})
+        worker["leased"] += len(tasks)
+        worker["last_seen"] = time.time()
+        return lease_id, job_id, tasks, job["build"]
+
+    def complete(self, lease_id, ok=True):
+        """Finish a lease; a failed lease puts its tasks back in the queue."""
+        lease = self._leases.pop(lease_id, None)
+        if lease is None:
+            # Expired and requeued already; the aggregator drops the duplicates
+            return False
+        worker = self.workers[lease["worker_id"]]
+        worker["completed" if ok else "failed"] += len(lease["tasks"])
+        worker["last_seen"] = time.time()
+        if ok:
+            self._finish(lease["job_id"], lease["tasks"], True)
+        else:
+            self._requeue(lease)
+        return True
+
+    def release(self, lease_id):
+        """Give a lease's tasks back (the lease could not be delivered)."""
+        lease = self._leases.pop(lease_id, None)
+        if lease is not None:
+            self._requeue(lease)
+
+    def _finish(self, job_id, tasks, ok):
+        job = self._jobs.get(job_id)
+        if job is None or not tasks:
+            return
+        job["remaining"] -= len(tasks)
+        job["on_result"](tasks, ok)
+        if job["remaining"] <= 0:
+            job["done"].set()
+
+    def _requeue(self, lease):
+        job = self._jobs.get(lease["job_id"])
+        if job is None:
+            return
+        retry, give_up = [], []
+        for task in lease["tasks"]:
+            job["attempts"][task] = job["attempts"].get(task, 0) + 1
+            (retry if job["attempts"][task] < self.max_attempts else give_up).append(task)
+        job["retry"].extendleft(reversed(retry))
+        if retry:
+            self._work_available.set()
+        self._finish(lease["job_id"], give_up, False)
+
+    def _expire_leases(self):
+        now = time.monotonic()
+        for lease_id in [lid for lid, lease in self._leases.items() if lease["expires"] <= now]:
+            lease = self._leases.pop(lease_id)
+            self.expired += 1
+            print(f"⏰ Lease {lease_id} expired, requeueing {len(lease['tasks'])} tasks")
+            self._requeue(lease)
+
+    async def reap(self, interval=1.0):
+        """Requeue expired leases even while no worker is asking for work."""
+        while True:
+            await asyncio.sleep(interval)
+            self._expire_leases()
+
+    def stats(self):
+        return {
+            "fairness": self.fairness,
+            "lease_timeout_sec": self.lease_timeout,
+            "jobs": {
+                job_id: {
+                    "pending": len(job["retry"]) + job["unleased"],
+                    "remaining": job["remaining"],
+                    "leased": job["leased"],
+                    "weight": job["weight"],
+                    "priority": job["priority"],
+                } for job_id, job in self._jobs.items()
+            },
+            "active_leases": len(self._leases),
+            "expired_leases": self.expired,
+            "workers": self.workers,
+        }
+
+
+class SendGate:
+    """
+    Global cap on the requests pushed to each worker, shared by every
+    job: a request waits for one of the worker's `worker_cap` slots per
+    instance, so the load on a worker no longer grows with the number of
+    concurrent jobs. A worker URL fronting several replicas (a Docker
+    service name) gets `worker_cap` slots for each of them, see
+    set_replicas.
+
+    A freed slot goes to the waiting request of the job with the highest
+    priority, then to the lowest virtual time (bytes granted / weight,
+    starting from the current minimum when the job registers): weighted
+    fair queuing, so a large job cannot starve small ones and an
+    interactive job skips the queue. The time every request waited for
+    its slot is recorded per job.
+    """
+
+    def __init__(self, worker_cap=32, window=1024):
+        self.worker_cap = worker_cap
+        self.window = window
+        self._jobs = {}
+        self._in_flight = {}
+        self._waiting = {}
+        self._replicas = {}
+        self._seq = itertools.count()
+
+    def register(self, job_id, weight=1.0, priority=0):
+        self._jobs[job_id] = {
+            "weight": weight,
+            "priority": priority,
+            "vtime": min((job["vtime"] for job in self._jobs.values()), default=0.0),
+            "granted": 0,
+            "bytes": 0,
+            "waited": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "waits": deque(maxlen=self.window),
+        }
+
+    def set_replicas(self, worker, replicas):
+        """Set the number of worker instances behind `worker` (1 unless set)."""
+        self._replicas[worker] = max(1, replicas)
+        self._grant(worker)
+
+    def cap(self, worker):
+        return self.worker_cap * self._replicas.get(worker, 1)
+
+    def unregister(self, job_id):
+        """Forget a job and return its wait statistics."""
+        stats = self.job_stats(job_id)
+        self._jobs.pop(job_id, None)
+        return stats
+
+    @asynccontextmanager
+    async def slot(self, job_id, worker, cost):
+        """Hold one of `worker`'s slots for a request of `cost` bytes."""
+        await self._acquire(job_id, worker, cost)
+        try:
+            yield
+        finally:
+            self._release(worker)
+
+    async def _acquire(self, job_id, worker, cost):
+        job = self._jobs[job_id]
+        enqueued = time.monotonic()
+        waiting = self._waiting.setdefault(worker, [])
+        if self._in_flight.get(worker, 0) < self.cap(worker) and not waiting:
+            self._in_flight[worker] = self._in_flight.get(worker, 0) + 1
+            self._charge(job, cost, 0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiting.append((next(self._seq), job_id, cost, enqueued, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the request was cancelled
+                self._release(worker)
+            raise
+
+    def _release(self, worker):
+        self._in_flight[worker] -= 1
+        self._grant(worker)
+
+    def _grant(self, worker):
+        waiting = self._waiting.get(worker, [])
+        while waiting and self._in_flight.get(worker, 0) < self.cap(worker):
+            waiting[:] = [entry for entry in waiting if not entry[4].done()]
+            if not waiting:
+                break
+            entry = min(waiting, key=self._rank)
+            waiting.remove(entry)
+            _, job_id, cost, enqueued, future = entry
+            self._in_flight[worker] += 1
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._charge(job, cost, time.monotonic() - enqueued)
+            future.set_result(None)
+
+    def _rank(self, entry):
+        seq, job_id = entry[0], entry[1]
+        job = self._jobs.get(job_id)
+        if job is None:
+            return (0, 0.0, seq)
+        return (-job["priority"], job["vtime"], seq)
+
+    def _charge(self, job, cost, waited):
+        job["granted"] += 1
+        job["bytes"] += cost
+        job["vtime"] += cost / job["weight"]
+        job["wait_total"] += waited
+        job["wait_max"] = max(job["wait_max"], waited)
+        job["waits"].append(waited)
+        if waited > 0:
+            job["waited"] += 1
+
+    def job_stats(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        waits = sorted(job["waits"])
+        return {
+            "requests": job["granted"],
+            "requests_waited": job["waited"],
+            "bytes": job["bytes"],
+            "wait_total_sec": job["wait_total"],
+            "wait_mean_sec": job["wait_total"] / job["granted"] if job["granted"] else 0.0,
+            "wait_p95_sec": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+            "wait_max_sec": job["wait_max"],
+            "weight": job["weight"],
+            "priority": job["priority"],
+        }
+
+    def stats(self):
+        return {
+            "worker_cap": self.worker_cap,
+            "workers": {
+                worker: {
+                    "cap": self.cap(worker),
+                    "in_flight": self._in_flight.get(worker, 0),
+                    "waiting": sum(1 for entry in waiting if not entry[4].done()),
+                } for worker, waiting in self._waiting.items()
+            },
+            "jobs": {job_id: self.job_stats(job_id) for job_id in self._jobs},
+        }
@@ -1,36 +1,613 @@
-from fastapi import FastAPI, HTTPException, UploadFile, Form
+from fastapi import FastAPI, HTTPException, Request, Response, UploadFile, Form
+from contextlib import asynccontextmanager
+from typing import Dict
+from collections import Counter
 import numpy as np
-import requests, uuid, math, io, time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import scipy.sparse as sp
+import httpx
+import uuid, math, time
+import asyncio
+import hashlib
+import shutil
 import tempfile
+import threading
 import os
 
-app = FastAPI(title="Splitter Microservice")
+from common.common_utils import FRAME_CONTENT_TYPE, array_nbytes, encode_frame, is_sparse
+from content_cache import ContentCache
+from autotune import CostModel, choose_tiling
+from assignment import discover_workers, grid_owner, interleave_units, plan_grid, plan_summa
+from dispatcher import Dispatcher, LatencyTracker
+from scheduler import LeaseScheduler, SendGate
+
+# Keep-alive connection pools to the workers and the aggregator, shared by all jobs
+dispatcher = Dispatcher(
+    pool_size=int(os.environ.get("SPLITTER_POOL_SIZE", 32)),
+    timeout=float(os.environ.get("SPLITTER_REQUEST_TIMEOUT", 30))
+)
+
+DEFAULT_MAX_IN_FLIGHT = int(os.environ.get("SPLITTER_MAX_IN_FLIGHT", 16))
+
+# Blocks smaller than BATCH_THRESHOLD are packed into /multiply_batch
+# requests of about BATCH_TARGET_BYTES of operands (at most MAX_BATCH_TASKS)
+BATCH_THRESHOLD = int(os.environ.get("SPLITTER_BATCH_THRESHOLD", 256))
+BATCH_TARGET_BYTES = int(os.environ.get("SPLITTER_BATCH_TARGET_BYTES", 4 * 1024 * 1024))
+MAX_BATCH_TASKS = int(os.environ.get("SPLITTER_MAX_BATCH_TASKS", 256))
+
+# block_size="auto" picks the task shape with a cost model of worker
+# requests (overhead, bandwidth and GFLOP/s, refitted to the latest
+# requests of all jobs, starting from these defaults); a task's operands
+# stay under AUTO_MAX_TASK_BYTES
+cost_model = CostModel(
+    overhead_sec=float(os.environ.get("SPLITTER_MODEL_OVERHEAD_SEC", 0.005)),
+    bytes_per_sec=float(os.environ.get("SPLITTER_MODEL_BYTES_PER_SEC", 200e6)),
+    gflops=float(os.environ.get("SPLITTER_MODEL_GFLOPS", 10.0))
+)
+AUTO_MAX_TASK_BYTES = int(os.environ.get("SPLITTER_AUTO_MAX_TASK_BYTES", 64 * 1024 * 1024))
+
+# Straggler mitigation: a request still running after FACTOR × the
+# PERCENTILE latency of the job's requests so far (at least MIN_SEC) gets a
+# speculative copy, failures are retried, up to SEND_ATTEMPTS copies total
+SEND_ATTEMPTS = int(os.environ.get("SPLITTER_SEND_ATTEMPTS", 3))
+HEDGE_PERCENTILE = float(os.environ.get("SPLITTER_HEDGE_PERCENTILE", 95))
+HEDGE_FACTOR = float(os.environ.get("SPLITTER_HEDGE_FACTOR", 2.0))
+HEDGE_MIN_SEC = float(os.environ.get("SPLITTER_HEDGE_MIN_SEC", 0.5))
+
+# After dispatch, blocks the aggregator still misses once arrivals have
+# stalled for RECONCILE_GRACE_SEC are dispatched again (up to RECONCILE_ROUNDS)
+RECONCILE_ROUNDS = int(os.environ.get("SPLITTER_RECONCILE_ROUNDS", 3))
+RECONCILE_GRACE_SEC = float(os.environ.get("SPLITTER_RECONCILE_GRACE_SEC", 3.0))
+# Reconciliation keeps asking an unreachable aggregator for this long, so
+# jobs ride out an aggregator restart (it recovers them from its block log)
+AGGREGATOR_RESTART_SEC = float(os.environ.get("SPLITTER_AGGREGATOR_RESTART_SEC", 30.0))
+
+# Jobs submitted with dispatch="pull" are leased by workers in batches of
+# up to the job's batch size (at least PULL_MIN_LEASE tasks); leases not
+# completed within SPLITTER_LEASE_TIMEOUT_SEC are requeued. With
+# SPLITTER_FAIRNESS=fair concurrent jobs share workers by weight, with
+# fifo the oldest job goes first.
+DEFAULT_DISPATCH = os.environ.get("SPLITTER_DISPATCH", "push")
+PULL_MIN_LEASE = int(os.environ.get("SPLITTER_PULL_MIN_LEASE", 1))
+scheduler = LeaseScheduler(
+    lease_timeout=float(os.environ.get("SPLITTER_LEASE_TIMEOUT_SEC", 60)),
+    max_attempts=SEND_ATTEMPTS,
+    fairness=os.environ.get("SPLITTER_FAIRNESS", "fair")
+)
+
+# Out-of-core bounds: uploads are streamed to disk in UPLOAD_CHUNK_BYTES
+# chunks, and a job reads, prepares and holds in flight about
+# TILE_BUDGET_BYTES of operand tiles at a time, whatever the matrix size
+UPLOAD_CHUNK_BYTES = int(os.environ.get("SPLITTER_UPLOAD_CHUNK_BYTES", 8 * 1024 * 1024))
+TILE_BUDGET_BYTES = int(os.environ.get("SPLITTER_TILE_BUDGET_BYTES", 512 * 1024 * 1024))
+
+# Uploaded operands (keyed by content hash) and finished results (keyed
+# by operand hashes, dtype and block size) are kept in a disk-backed LRU,
+# so repeated jobs are served without recomputing
+content_cache = ContentCache(
+    os.environ.get("SPLITTER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "splitter_cache")),
+    max_bytes=int(os.environ.get("SPLITTER_CACHE_MAX_BYTES", 4 * 1024 * 1024 * 1024)),
+    ttl_sec=float(os.environ.get("SPLITTER_CACHE_TTL_SEC", 24 * 3600))
+)
+
+# Number of jobs dispatched concurrently by the background job runners
+JOB_RUNNERS = int(os.environ.get("SPLITTER_JOB_RUNNERS", 4))
+
+# Pushed requests share SPLITTER_WORKER_MAX_IN_FLIGHT slots per worker
+# instance across all jobs (a worker URL fronting several replicas gets
+# that many slots per replica), granted by priority and then weighted fair
+# queuing.
+# Once MAX_QUEUED_JOBS jobs of the same or higher priority wait for a
+# runner, /split answers 503 with Retry-After instead of taking the job.
+gate = SendGate(worker_cap=int(os.environ.get("SPLITTER_WORKER_MAX_IN_FLIGHT", 32)))
+MAX_QUEUED_JOBS = int(os.environ.get("SPLITTER_MAX_QUEUED_JOBS", 16))
+QUEUE_RETRY_AFTER_SEC = 5
+
+# Status of every job accepted by /split, reported by /jobs/{job_id}.
+# Finished jobs are forgotten after the content cache's TTL.
+split_jobs: Dict[str, Dict] = {}
+JOB_PRUNE_INTERVAL_SEC = 60
+
+# Memo key -> the job computing (or that computed) that result, and its aggregator
+memo_jobs: Dict[str, Dict] = {}
+
+# Accepted jobs waiting for a runner, highest priority first (then in
+# order of arrival), and how many of each priority are waiting
+job_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+queued_priorities: Counter = Counter()
+job_seq = 0
+
+
+async def job_runner():
+    while True:
+        _, _, spec = await job_queue.get()
+        queued_priorities[spec["priority"]] -= 1
+        status = split_jobs[spec["job_id"]]
+        status["queue_wait_sec"] = time.perf_counter() - spec["queued_at"]
+        gate.register(spec["job_id"], weight=spec["weight"], priority=spec["priority"])
+        try:
+            if spec["mode"] == "summa":
+                await run_summa(spec)
+            else:
+                await run_job(spec)
+            if spec["memo_key"] and split_jobs[spec["job_id"]]["state"] == "done":
+                await cache_result(spec)
+        except Exception as e:
+            status = split_jobs[spec["job_id"]]
+            status["state"] = "failed"
+            status["error"] = str(e)
+            print(f"❌ Splitter job {spec['job_id']} failed: {e}")
+        finally:
+            status["send_wait"] = gate.unregister(spec["job_id"])
+            status["finished_at"] = time.time()
+            if status["state"] == "failed":
+                fail_attached(spec["job_id"], spec["memo_key"])
+            shutil.rmtree(spec["tmp_dir"], ignore_errors=True)
+            job_queue.task_done()
+
+
+def fail_attached(job_id, memo_key):
+    """
+    Fail the jobs attached to a failed job and forget it as the provider
+    of its result, so identical jobs submitted later compute it again.
+    """
+    if memo_key and memo_jobs.get(memo_key, {}).get("job_id") == job_id:
+        del memo_jobs[memo_key]
+    error = split_jobs[job_id].get("error") or "blocks failed"
+    for status in split_jobs.values():
+        if status.get("attached_to") == job_id and status["state"] == "attached":
+            status["state"] = "failed"
+            status["error"] = f"Identical job {job_id} failed: {error}"
+            status["finished_at"] = time.time()
+            print(f"❌ Splitter job {status['job_id']} failed with identical job {job_id}")
+
+
+def prune_jobs():
+    """
+    Forget jobs finished longer than the content cache's TTL ago, the jobs
+    attached to them, and their memo entries.
+    """
+    cutoff = time.time() - content_cache.ttl_sec
+    expired = {
+        job_id for job_id, status in split_jobs.items()
+        if status["state"] in ("done", "failed")
+        and status.get("finished_at", status["submitted_at"]) < cutoff
+    }
+    expired |= {
+        job_id for job_id, status in split_jobs.items()
+        if status["state"] == "attached" and status["attached_to"] in expired
+    }
+    for job_id in expired:
+        del split_jobs[job_id]
+    for memo_key in [key for key, memo in memo_jobs.items() if memo["job_id"] in expired]:
+        del memo_jobs[memo_key]
+    if expired:
+        print(f"🧹 Forgot {len(expired)} finished jobs")
+
+
+async def job_reaper():
+    while True:
+        await asyncio.sleep(JOB_PRUNE_INTERVAL_SEC)
+        prune_jobs()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    runners = [asyncio.create_task(job_runner()) for _ in range(JOB_RUNNERS)]
+    reaper = asyncio.create_task(scheduler.reap())
+    pruner = asyncio.create_task(job_reaper())
+    yield
+    pruner.cancel()
+    reaper.cancel()
+    for runner in runners:
+        runner.cancel()
+    await dispatcher.aclose()
+
+
+app = FastAPI(title="Splitter Microservice", lifespan=lifespan)
+
+
+def batch_size_for(br, bc, bk, itemsize):
+    """
+    Tasks per request for br × bk · bk × bc block tasks: blocks smaller
+    than BATCH_THRESHOLD are packed into batches of about
+    BATCH_TARGET_BYTES of operands, larger ones go one per request.
+    """
+    if max(br, bc, bk) >= BATCH_THRESHOLD:
+        return 1
+    block_bytes = (br * bk + bk * bc) * itemsize
+    return int(min(MAX_BATCH_TASKS, max(1, BATCH_TARGET_BYTES // block_bytes)))
+
+
+def block_ref(block):
+    """Content hash identifying an operand block in the workers' caches."""
+    h = hashlib.blake2b(digest_size=16)
+    if is_sparse(block):
+        h.update(f"{block.format}{block.dtype.str}{block.shape}".encode())
+        for part in (block.data, block.indices, block.indptr):
+            h.update(np.ascontiguousarray(part).data)
+        return h.hexdigest()
+    block = np.ascontiguousarray(block)
+    h.update(f"{block.dtype.str}{block.shape}".encode())
+    h.update(block.data)
+    return h.hexdigest()
+
+
+def tile_occupancy(M, row_size, col_size):
+    """
+    Return a bool grid with one entry per (row_size × col_size) tile of M,
+    True where the tile has a nonzero. M is read in chunks of whole rows
+    of about TILE_BUDGET_BYTES, so a memmap is never loaded whole.
+    """
+    rows, cols = M.shape
+    col_starts = np.arange(0, cols, col_size)
+    occupancy = np.zeros((math.ceil(rows / row_size), len(col_starts)), dtype=bool)
+    if is_sparse(M):
+        coo = M.tocoo()
+        nonzero = coo.data != 0
+        occupancy[coo.row[nonzero] // row_size, coo.col[nonzero] // col_size] = True
+        return occupancy
+    chunk_rows = max(1, TILE_BUDGET_BYTES // max(1, cols * M.dtype.itemsize))
+    for r in range(occupancy.shape[0]):
+        band_end = min((r+1)*row_size, rows)
+        for start in range(r*row_size, band_end, chunk_rows):
+            chunk = M[start:min(start + chunk_rows, band_end)]
+            occupancy[r] |= np.logical_or.reduceat(np.any(chunk != 0, axis=0), col_starts)
+    return occupancy
+
+
+def tiled_tasks(A_occ, B_occ, group):
+    """
+    Yield the nonzero (i, j, k) tasks one group × group block of output
+    tiles at a time, so the A row-panels and B column-panels a block reads
+    are reused while they are still in the page cache.
+    """
+    (row_blocks, depth_blocks), col_blocks = A_occ.shape, B_occ.shape[1]
+    for I in range(0, row_blocks, group):
+        for J in range(0, col_blocks, group):
+            for i in range(I, min(I + group, row_blocks)):
+                for j in range(J, min(J + group, col_blocks)):
+                    for k in range(depth_blocks):
+                        if A_occ[i, k] and B_occ[k, j]:
+                            yield i, j, k
+
+
+def budget_window(max_in_flight, unit_bytes):
+    """
+    Cap a job's in-flight window so its prepared requests fit the tile
+    budget: each holds its operands and encoded body, and up to `window`
+    wait in the queue while `window` more are being sent.
+    """
+    return max(1, min(max_in_flight, TILE_BUDGET_BYTES // max(1, 4 * unit_bytes)))
+
+
+async def save_upload(upload, path):
+    """
+    Stream an upload to disk in UPLOAD_CHUNK_BYTES chunks, hashing it on
+    the way. Returns the hex content hash.
+    """
+    h = hashlib.blake2b(digest_size=16)
+
+    def write(chunk):
+        f.write(chunk)
+        h.update(chunk)
+
+    with open(path, "wb") as f:
+        while chunk := await upload.read(UPLOAD_CHUNK_BYTES):
+            await asyncio.to_thread(write, chunk)
+    return h.hexdigest()
+
+
+async def receive_operand(name, upload, content_hash, tmp_dir, memoize):
+    """
+    Store an operand upload, or find the earlier upload with content_hash
+    when no file is sent. Returns (path, content hash). With memoize the
+    upload moves into the content cache, so identical uploads share a file.
+    """
+    if upload is None:
+        if not content_hash:
+            raise HTTPException(status_code=400, detail=f"Send {name}_file or {name}_hash")
+        path = await asyncio.to_thread(content_cache.get, f"in-{content_hash}")
+        if path is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No cached upload with hash {content_hash}; send {name}_file"
+            )
+        return path, content_hash
+
+    path = os.path.join(tmp_dir, f"{name}_{uuid.uuid4()}.npy")
+    content_hash = await save_upload(upload, path)
+    if memoize:
+        path = await asyncio.to_thread(content_cache.put, f"in-{content_hash}", path) or path
+    return path, content_hash
+
+
+async def read_chunks(path):
+    """Yield a file in UPLOAD_CHUNK_BYTES chunks (an httpx request body)."""
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, UPLOAD_CHUNK_BYTES):
+            yield chunk
+
+
+async def reuse_result(job_id, memo_key, aggregator_url):
+    """
+    Serve a job from an identical earlier one: attach it at the aggregator
+    to the job computing (or holding) the result, or else import the
+    result from the content cache. Returns the memo fields of the job's
+    status, or None if the job has to be computed.
+    """
+    aggregator = dispatcher.client(aggregator_url)
+    source = memo_jobs.get(memo_key)
+    if source is not None and source["aggregator_url"] == aggregator_url:
+        # Wait until the source job is registered with the aggregator
+        await source["ready"].wait()
+    if (source is not None and source["aggregator_url"] == aggregator_url
+            and source["job_id"] in split_jobs and split_jobs[source["job_id"]]["state"] != "failed"):
+        try:
+            resp = await aggregator.post("/init_job", json={
+                "job_id": job_id,
+                "alias_of": source["job_id"]
+            }, timeout=10)
+            if resp.status_code == 200:
+                print(f"♻️ Job {job_id} attached to identical job {source['job_id']}")
+                return {"state": "attached", "attached_to": source["job_id"]}
+        except httpx.HTTPError as e:
+            print(f"⚠️ Could not attach job {job_id} to {source['job_id']}: {e}")
+
+    # This job provides the result now; identical jobs arriving meanwhile
+    # wait for it (see settle_memo) and then attach to it
+    memo_jobs[memo_key] = {"job_id": job_id, "aggregator_url": aggregator_url, "ready": asyncio.Event()}
+
+    for fmt in ("npy", "npz"):
+        path = await asyncio.to_thread(content_cache.get, f"out-{memo_key}.{fmt}")
+        if path is None:
+            continue
+        try:
+            resp = await aggregator.post(f"/aggregate/import/{job_id}", params={"format": fmt},
+                                         content=read_chunks(path), timeout=None)
+        except (httpx.HTTPError, FileNotFoundError) as e:
+            print(f"⚠️ Could not import the cached result for job {job_id}: {e}")
+            return None
+        if resp.status_code != 200:
+            print(f"⚠️ Aggregator returned {resp.status_code} importing the result for job {job_id}")
+            return None
+        print(f"♻️ Job {job_id} served from the result cache")
+        return {"state": "done", "attached_to": None}
+    return None
+
+
+def settle_memo(memo_key, job_id):
+    """Wake the jobs waiting to attach to job_id; forget it if it was not accepted."""
+    memo = memo_jobs.get(memo_key)
+    if memo is None or memo["job_id"] != job_id:
+        return
+    memo["ready"].set()
+    if job_id not in split_jobs:
+        del memo_jobs[memo_key]
+
+
+async def cache_result(spec):
+    """Download a finished job's result from the aggregator into the content cache."""
+    job_id = spec["job_id"]
+    aggregator = dispatcher.client(spec["aggregator_url"])
+    final = (await aggregator.get(f"/aggregate/final_result/{job_id}")).json()
+    if final.get("message") != "Aggregation complete":
+        return
+    if final["format"] == "dense":
+        fmt, url = "npy", final["result_url"]
+        nbytes = math.prod(final["shape"]) * np.dtype(final["dtype"]).itemsize
+        if nbytes > content_cache.max_bytes:
+            return
+    else:
+        fmt, url = "npz", final["sparse_result_url"]
+
+    path = os.path.join(spec["tmp_dir"], f"C.{fmt}")
+    async with aggregator.stream("GET", url, timeout=None) as resp:
+        resp.raise_for_status()
+        with open(path, "wb") as f:
+            async for chunk in resp.aiter_bytes(UPLOAD_CHUNK_BYTES):
+                await asyncio.to_thread(f.write, chunk)
+    if await asyncio.to_thread(content_cache.put, f"out-{spec['memo_key']}.{fmt}", path):
+        print(f"💾 Cached the result of job {job_id}")
+
+
+def load_operand(path, fmt):
+    """
+    Load an upload: .npy files are memory-mapped, npz files written by
+    scipy.sparse.save_npz (CSR, CSC or COO) are loaded as a sparse matrix
+    in `fmt`, so row panels of A and column panels of B slice cheaply.
+    """
+    with open(path, "rb") as f:
+        is_npz = f.read(2) == b"PK"
+    if not is_npz:
+        return np.load(path, mmap_mode="r")
+    try:
+        return sp.load_npz(path).asformat(fmt)
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid sparse npz upload: {e}")
+
+
+def batched(iterable, size):
+    """Yield lists of up to `size` consecutive items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def task_frame(meta, operands, names):
+    """Encode a /multiply request carrying the named operands by value."""
+    return encode_frame(meta, {name: operands[name] for name in names})
+
+
+def queued_priorities_from(priority):
+    """Jobs waiting for a runner that go before a new job of `priority`."""
+    return sum(count for queued, count in queued_priorities.items() if queued >= priority)
+
 
 @app.post("/split")
 async def split_and_dispatch(
-    A_file: UploadFile,
-    B_file: UploadFile,
+    A_file: UploadFile = None,
+    B_file: UploadFile = None,
     worker_url: str = Form("http://worker:8001"),
     aggregator_url: str = Form("http://aggregator:8002"),
-    block_size: int = Form(500),
-    job_id: str = Form(None)
+    block_size: str = Form("auto"),
+    job_id: str = Form(None),
+    mode: str = Form("block"),
+    use_cache: bool = Form(True),
+    skip_zero_blocks: bool = Form(True),
+    max_in_flight: int = Form(DEFAULT_MAX_IN_FLIGHT),
+    dispatch: str = Form(DEFAULT_DISPATCH),
+    weight: float = Form(1.0),
+    priority: int = Form(0),
+    assignment: str = Form("shared"),
+    worker_urls: str = Form(None),
+    out_of_core: bool = Form(False),
+    memoize: bool = Form(True),
+    A_hash: str = Form(None),
+    B_hash: str = Form(None)
 ):
+    """
+    Split A × B into tasks and dispatch them to the workers.
+
+    block_size is the side of the square tiles A, B and C are cut into
+    (the panel width in summa mode), or "auto": the splitter then picks
+    the tile shape, possibly non-square and with its own depth, that a
+    cost model predicts to be fastest for the matrix shapes, dtype and
+    live workers. The model's per-request overhead, bandwidth and worker
+    GFLOP/s are refitted to recent requests (GET /autotune). The chosen
+    tiling and its estimate are returned as "tiling".
+
+    mode="block" sends one task per (i, j, k): the worker returns the
+    partial A[i,k] × B[k,j] and the aggregator sums the k contributions.
+
+    mode="tile" sends one task per output tile (i, j) carrying the full
+    A row-panel and B column-panel, so the worker does the k-reduction
+    itself and the aggregator receives one finished tile.
+
+    If either upload is a scipy.sparse npz (CSR/CSC/COO from save_npz)
+    the job runs in "sparse" mode: like tile mode, but A row-panels are
+    sent as CSR and B column-panels as CSC, so bytes moved and worker
+    memory scale with nnz. The aggregator keeps the result sparse unless
+    its fill-in gets too high.
+
+    With skip_zero_blocks, the tile occupancy of A and B is scanned first
+    and only (i, j, k) tasks where both A[i,k] and B[k,j] have a nonzero
+    are dispatched; the aggregator is told the exact expected set and
+    leaves tiles without contributions at zero.
+
+    With use_cache, operands are first sent by content hash and only
+    uploaded to workers that report them missing from their cache.
+
+    Blocks go out over pooled keep-alive connections with at most
+    max_in_flight requests outstanding for this job, and at most
+    SPLITTER_WORKER_MAX_IN_FLIGHT per worker across all jobs. Failed requests are
+    retried and requests slower than the job's latency deadline get a
+    speculative copy; after dispatch, blocks the aggregator still misses
+    are dispatched again.
+
+    If aggregator_url is a sharded aggregator front (it answers /shards),
+    workers submit every block straight to the shard owning its tile.
+
+    With dispatch="pull" nothing is pushed to worker_url: the tasks wait
+    in the lease scheduler and workers started with WORKER_PULL_URL lease
+    them in batches, so faster workers take more.
+
+    Concurrent jobs share the workers in proportion to `weight` (weighted
+    fair queuing of pushed bytes, or of leased tasks with dispatch="pull").
+    Jobs with a higher `priority` go first: they leave the job queue
+    before lower-priority jobs and their requests take freed worker slots
+    first, so small interactive jobs skip the queue. GET /jobs/{job_id}
+    reports how long the job waited for a runner (queue_wait_sec) and its
+    requests for worker slots (send_wait). When too many jobs are queued
+    the request fails with 503 and a Retry-After header.
+
+    assignment="grid" addresses the worker instances individually (the
+    comma-separated worker_urls, SPLITTER_WORKER_URLS, or every address
+    the worker_url host resolves to) and gives each one a block of output
+    tiles on a 2-D processor grid, so it reuses the same A row-panels and
+    B column-panels across its tasks. The response reports the operand
+    bytes expected under the grid and under round-robin of the tasks.
+
+    mode="summa" runs SUMMA over the worker instances (found as for
+    assignment="grid"): each worker owns one C tile on a processor grid,
+    and every step broadcasts a block_size-wide panel of A along the grid
+    rows and of B along the grid columns. Workers accumulate their tile
+    locally and submit it once, so operands cost about pc·|A| + pr·|B|
+    bytes instead of growing with the number of blocks.
+
+    Uploads are streamed to disk and read back as memmaps in blocks of
+    output tiles sized to SPLITTER_TILE_BUDGET_BYTES. With out_of_core
+    the aggregator accumulates C in a memory-mapped .npy file instead of
+    in RAM (it also does so on its own for results above its limit).
+
+    Uploads are hashed as they stream in. With memoize, identical uploads
+    share one file in the splitter's content cache, and a job whose
+    operands, dtype and block_size match an earlier job is not computed:
+    it is attached at the aggregator to that job (finished or still in
+    flight), or its result is imported from the cache. The response then
+    says "attached_to" (or state "done"). A_hash/B_hash (the hashes
+    returned by an earlier /split) stand in for an upload that is still
+    cached.
+
+    The request returns as soon as the inputs are validated and the job is
+    registered with the aggregator; dispatch continues in the background
+    and its progress is reported by GET /jobs/{job_id}.
+    If the aggregator has no memory left for the result, the request
+    fails with 429 and a Retry-After header.
+    """
+    tmp_dir = None
+    memo_key = None
     try:
-        start_time = time.perf_counter()
+        if mode not in ("block", "tile", "summa"):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown mode '{mode}' (expected 'block', 'tile' or 'summa')"
+            )
+        if dispatch not in ("push", "pull"):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown dispatch '{dispatch}' (expected 'push' or 'pull')"
+            )
+        if weight <= 0:
+            raise HTTPException(status_code=400, detail="weight must be positive")
+        if block_size != "auto" and not (block_size.isdigit() and int(block_size) > 0):
+            raise HTTPException(
+                status_code=400,
+                detail=f"block_size must be a positive integer or 'auto', got '{block_size}'"
+            )
+        if queued_priorities_from(priority) >= MAX_QUEUED_JOBS:
+            # Backpressure: refuse new jobs until the queue drains
+            raise HTTPException(
+                status_code=503,
+                detail=f"Splitter queue full ({job_queue.qsize()} jobs waiting)",
+                headers={"Retry-After": str(QUEUE_RETRY_AFTER_SEC)}
+            )
+        if assignment not in ("shared", "grid"):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown assignment '{assignment}' (expected 'shared' or 'grid')"
+            )
+        if assignment == "grid" and dispatch == "pull":
+            raise HTTPException(status_code=400, detail="assignment=grid needs dispatch=push")
+        if mode == "summa" and dispatch == "pull":
+            raise HTTPException(status_code=400, detail="mode=summa needs dispatch=push")
+
+        # Generate job_id if not provided
+        job_id = job_id or str(uuid.uuid4())
+        if job_id in split_jobs:
+            raise HTTPException(status_code=409, detail=f"Job {job_id} already submitted")
 
         # Unique temporary paths for each request
         tmp_dir = tempfile.mkdtemp(prefix="splitjob_")
-        A_path = os.path.join(tmp_dir, f"A_{uuid.uuid4()}.npy")
-        B_path = os.path.join(tmp_dir, f"B_{uuid.uuid4()}.npy")
+        A_path, A_hash = await receive_operand("A", A_file, A_hash, tmp_dir, memoize)
+        B_path, B_hash = await receive_operand("B", B_file, B_hash, tmp_dir, memoize)
 
-        with open(A_path, "wb") as f:
-            f.write(await A_file.read())
-        with open(B_path, "wb") as f:
-            f.write(await B_file.read())
-
-        A = np.load(A_path, mmap_mode="r")
-        B = np.load(B_path, mmap_mode="r")
+        A = load_operand(A_path, "csr")
+        B = load_operand(B_path, "csc")
 
         if A.shape[1] != B.shape[0]:
             raise HTTPException(
@@ -38,135 +615,814 @@ async def split_and_dispatch(
                 detail=f"Incompatible matrix dimensions: A{A.shape} × B{B.shape}"
             )
 
+        # Jobs with the same operands, result dtype and block size share a result
+        result_dtype = np.result_type(A.dtype, B.dtype)
+        memo_key = f"{A_hash}-{B_hash}-{result_dtype.name}-{block_size}" if memoize else None
+        memo = await reuse_result(job_id, memo_key, aggregator_url) if memoize else None
+        if memo is not None:
+            split_jobs[job_id] = {
+                "job_id": job_id,
+                **memo,
+                "mode": mode,
+                "block_size": block_size,
+                "shape_A": list(A.shape),
+                "shape_B": list(B.shape),
+                "A_hash": A_hash,
+                "B_hash": B_hash,
+                "blocks_total": 0,
+                "blocks_acknowledged": 0,
+                "submitted_at": time.time(),
+                "time_sec": 0.0
+            }
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return {
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}",
+                **memo,
+                "mode": mode,
+                "shape_A": list(A.shape),
+                "shape_B": list(B.shape),
+                "A_hash": A_hash,
+                "B_hash": B_hash
+            }
+
+        if mode == "summa" and (is_sparse(A) or is_sparse(B)):
+            raise HTTPException(status_code=400, detail="mode=summa needs dense .npy operands")
+        if is_sparse(A) or is_sparse(B):
+            # Sparse jobs always send row/column panels, so every worker
+            # runs one sparse product per output tile
+            mode = "sparse"
+
         m, n = A.shape
         _, p = B.shape
-        b = block_size
+        itemsize = result_dtype.itemsize
+
+        plan = None
+        tiling = None
+        if mode == "summa":
+            # One C tile per worker on a processor grid; the k-loop runs
+            # as SUMMA steps over panels of width block_size
+            workers = await asyncio.to_thread(discover_workers, worker_url, worker_urls)
+            if block_size == "auto":
+                # The grid does not depend on the width: pick the width for its tiles
+                grid = plan_summa(workers, A, B, n)
+                tiling = await asyncio.to_thread(
+                    choose_tiling, m, n, p, itemsize, len(grid["workers"]), cost_model,
+                    lambda *_: 1, AUTO_MAX_TASK_BYTES,
+                    rows=grid["tile_shape"][0], cols=grid["tile_shape"][1]
+                )
+                bk = tiling["depth"]
+            else:
+                bk = int(block_size)
+            plan = plan_summa(workers, A, B, bk)
+            row_blocks, col_blocks = plan["grid"]
+            depth_blocks = 1
+            tile_shape = plan["tile_shape"]
+            br, bc = tile_shape
+            A_occ = np.ones((row_blocks, depth_blocks), dtype=bool)
+            B_occ = np.ones((depth_blocks, col_blocks), dtype=bool)
+            print(f"🧭 Job {job_id}: SUMMA on a {row_blocks}×{col_blocks} grid, {plan['steps']} steps, "
+                  f"~{plan['expected_bytes'] / 1e6:.1f} MB of operands "
+                  f"(block mode ~{plan['block_mode_bytes'] / 1e6:.1f} MB)")
+        else:
+            # In tile mode the depth slice spans the whole inner dimension,
+            # so each task is a full row-panel × column-panel product.
+            panels = mode in ("tile", "sparse")
+            if block_size == "auto":
+                if assignment == "grid":
+                    workers = await asyncio.to_thread(discover_workers, worker_url, worker_urls)
+                    live = len(workers)
+                else:
+                    live = await live_workers(worker_url, worker_urls, dispatch)
+                # Sparse operands: scale bytes and products by the stored fraction
+                density = 1.0
+                if mode == "sparse":
+                    density = min(1.0, (array_nbytes(A) + array_nbytes(B)) / ((m * n + n * p) * itemsize))
+                tiling = await asyncio.to_thread(
+                    choose_tiling, m, n, p, itemsize * density, live, cost_model,
+                    (lambda br, bc, bk: batch_size_for(br, bc, bk, itemsize)) if mode == "block" else (lambda *_: 1),
+                    AUTO_MAX_TASK_BYTES, depth=n if panels else None, flop_scale=density
+                )
+                br, bc = tiling["tile_shape"]
+                bk = tiling["depth"]
+            else:
+                br = bc = int(block_size)
+                bk = n if panels else br
+            tile_shape = [br, bc]
 
-        row_blocks = math.ceil(m / b)
-        col_blocks = math.ceil(p / b)
-        depth_blocks = math.ceil(n / b)
+            row_blocks = math.ceil(m / br)
+            col_blocks = math.ceil(p / bc)
+            depth_blocks = math.ceil(n / bk)
 
-        # Generate job_id if not provided
-        job_id = job_id or str(uuid.uuid4())
-        total_blocks = row_blocks * col_blocks * depth_blocks
+            if skip_zero_blocks:
+                A_occ = await asyncio.to_thread(tile_occupancy, A, br, bk)
+                B_occ = await asyncio.to_thread(tile_occupancy, B, bk, bc)
+            else:
+                A_occ = np.ones((row_blocks, depth_blocks), dtype=bool)
+                B_occ = np.ones((depth_blocks, col_blocks), dtype=bool)
+
+            if assignment == "grid":
+                workers = await asyncio.to_thread(discover_workers, worker_url, worker_urls)
+                plan = await asyncio.to_thread(plan_grid, workers, A, B, br, bc, bk, A_occ, B_occ, use_cache)
+                print(f"🧭 Job {job_id}: {plan['grid'][0]}×{plan['grid'][1]} grid over {len(workers)} workers, "
+                      f"~{plan['expected_bytes'] / 1e6:.1f} MB of operands "
+                      f"(round-robin ~{plan['round_robin_bytes'] / 1e6:.1f} MB)")
+
+        if tiling is not None:
+            print(f"📐 Job {job_id}: auto tiling {br}×{bk} · {bk}×{bc} for {tiling['workers']} workers, "
+                  f"~{tiling['estimated_sec']:.2f}s predicted")
+        tiling = {"tile_shape": [br, bc], "depth": bk, **(tiling or {})}
+
+        # Tasks per output tile: the k where both A[i,k] and B[k,j] are nonzero
+        total_blocks = int((A_occ.astype(np.int64) @ B_occ.astype(np.int64)).sum())
+        skipped_blocks = row_blocks * col_blocks * depth_blocks - total_blocks
+
+        # Workers submit straight to the shards of a sharded aggregator
+        shards = await aggregator_shards(aggregator_url)
+        submit_url = ",".join(shards) if shards else aggregator_url
 
         # Initialize job at aggregator
         init_payload = {
             "job_id": job_id,
             "blocks_expected": total_blocks,
             "block_rows": row_blocks,
-            "block_cols": col_blocks
+            "block_cols": col_blocks,
+            "block_depth": depth_blocks,
+            "shape": [m, p],
+            "tile_shape": tile_shape,
+            "dtype": result_dtype.str,
+            "sparse": mode == "sparse",
+            "out_of_core": out_of_core
         }
-        
+        if skipped_blocks:
+            # The expected (i,j,k) set is A_occ[i,k] & B_occ[k,j]
+            init_payload["a_occupancy"] = A_occ.astype(np.uint8).tolist()
+            init_payload["b_occupancy"] = B_occ.astype(np.uint8).tolist()
+
         try:
-            resp = requests.post(
-                f"{aggregator_url}/init_job",
+            resp = await dispatcher.client(aggregator_url).post(
+                "/init_job",
                 json=init_payload,
                 timeout=10
             )
+        except httpx.HTTPError as e:
+            raise HTTPException(status_code=502, detail=f"Aggregator init failed: {e}")
+        if resp.status_code != 200:
+            # The job is not queued: nothing would ever complete it. A 429
+            # means the aggregator cannot hold another result right now.
+            try:
+                detail = resp.json().get("detail")
+            except ValueError:
+                detail = resp.text
+            headers = None
+            if resp.status_code == 429:
+                headers = {"Retry-After": resp.headers.get("Retry-After", "10")}
+            raise HTTPException(status_code=resp.status_code, detail=detail, headers=headers)
+        print(f"✅ Initialized aggregator job {job_id}")
+
+        split_jobs[job_id] = {
+            "job_id": job_id,
+            "state": "queued",
+            "mode": mode,
+            "dispatch": dispatch,
+            "priority": priority,
+            "weight": weight,
+            "assignment": plan or {"mode": "shared"},
+            "block_size": block_size,
+            "tiling": tiling,
+            "shape_A": list(A.shape),
+            "shape_B": list(B.shape),
+            "A_hash": A_hash,
+            "B_hash": B_hash,
+            "blocks_total": total_blocks,
+            "blocks_skipped": skipped_blocks,
+            "blocks_serialized": 0,
+            "blocks_sent": 0,
+            "blocks_acknowledged": 0,
+            "blocks_failed": 0,
+            "blocks_redispatched": 0,
+            "blocks_missing": None,
+            "bytes_sent": 0,
+            "aggregator_shards": len(shards) if shards else 1,
+            "submitted_at": time.time(),
+            "time_sec": None
+        }
+
+        global job_seq
+        job_seq += 1
+        queued_priorities[priority] += 1
+        await job_queue.put((-priority, job_seq, {
+            "job_id": job_id,
+            "tmp_dir": tmp_dir,
+            "mode": mode,
+            "A": A,
+            "B": B,
+            "br": br,
+            "bc": bc,
+            "bk": bk,
+            "grid": (row_blocks, col_blocks, depth_blocks),
+            "A_occ": A_occ,
+            "B_occ": B_occ,
+            "worker_url": worker_url,
+            "worker_urls": worker_urls,
+            "aggregator_url": aggregator_url,
+            "submit_url": submit_url,
+            "use_cache": use_cache,
+            "max_in_flight": max_in_flight,
+            "dispatch": dispatch,
+            "weight": weight,
+            "plan": plan,
+            "memo_key": memo_key,
+            "priority": priority,
+            "queued_at": time.perf_counter()
+        }))
+
+        print(f"📥 Job {job_id} queued: {total_blocks} {mode} tasks "
+              f"({row_blocks}×{col_blocks}×{depth_blocks}, {skipped_blocks} all-zero skipped)")
+
+        return {
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}",
+            "state": "queued",
+            "queue_position": queued_priorities_from(priority),
+            "blocks_total": total_blocks,
+            "blocks_skipped": skipped_blocks,
+            "block_size": block_size,
+            "tiling": tiling,
+            "mode": mode,
+            "assignment": plan or {"mode": "shared"},
+            "shape_A": list(A.shape),
+            "shape_B": list(B.shape),
+            "A_hash": A_hash,
+            "B_hash": B_hash
+        }
+
+    except HTTPException:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    except Exception as e:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if memo_key:
+            settle_memo(memo_key, job_id)
+
+
+async def run_job(spec):
+    """Dispatch every task of an accepted job, updating its status as it goes."""
+    job_id = spec["job_id"]
+    status = split_jobs[job_id]
+    A, B, br, bc, bk = spec["A"], spec["B"], spec["br"], spec["bc"], spec["bk"]
+    (m, n), p = A.shape, B.shape[1]
+    row_blocks, col_blocks, depth_blocks = spec["grid"]
+    A_occ, B_occ = spec["A_occ"], spec["B_occ"]
+    total_blocks = status["blocks_total"]
+    aggregator_url = spec["aggregator_url"]
+    submit_url = spec["submit_url"]
+    use_cache = spec["use_cache"]
+
+    start_time = time.perf_counter()
+    status["state"] = "dispatching"
+    print(f"📦 Job {job_id}: dispatching {total_blocks} {status['mode']} tasks "
+          f"({row_blocks}×{col_blocks}×{depth_blocks})")
+
+    # Content hashes of the operand blocks, computed once per block
+    refs = {}
+    # Requests are prepared by several dispatcher threads
+    serialized_lock = threading.Lock()
+
+    def count_serialized(blocks):
+        with serialized_lock:
+            status["blocks_serialized"] += blocks
+
+    def operand_ref(key, block):
+        if key not in refs:
+            refs[key] = block_ref(block)
+        return refs[key]
+
+    def prepare_block(task):
+        """
+        Slice the operands for C[i,j] += A[i,k] × B[k,j] out of the
+        memmaps (in tile mode k is always 0 and the slice is the whole
+        panel). Runs in a producer thread.
+        """
+        i, j, k = task
+        A_block = A[i*br:(i+1)*br, k*bk:(k+1)*bk]
+        B_block = B[k*bk:(k+1)*bk, j*bc:(j+1)*bc]
+        if not is_sparse(A_block):
+            A_block = np.ascontiguousarray(A_block)
+        if not is_sparse(B_block):
+            B_block = np.ascontiguousarray(B_block)
+        return A_block, B_block
+
+    def task_flops(i, j, k):
+        return 2 * min(br, m - i * br) * min(bc, p - j * bc) * min(bk, n - k * bk)
+
+    def prepare_single(unit):
+        (i, j, k), = unit
+        A_block, B_block = prepare_block((i, j, k))
+        operands = {"A": A_block, "B": B_block}
+
+        meta = {
+            "job_id": job_id,
+            "row_block": i,
+            "col_block": j,
+            "depth_block": k,  # ✅ ADDED: Include k-index
+            "aggregator_url": submit_url
+        }
+
+        if use_cache:
+            meta["A_ref"] = operand_ref(("A", i, k), A_block)
+            meta["B_ref"] = operand_ref(("B", k, j), B_block)
+            body = task_frame(meta, operands, [])
+        else:
+            body = task_frame(meta, operands, ["A", "B"])
+
+        count_serialized(1)
+        return "/multiply", unit, meta, operands, body
+
+    def batch_operands(unit):
+        """
+        Describe several tasks as a /multiply_batch request. Operands are
+        keyed by ref, so a block shared by tasks in the batch is sent
+        once; without the cache the refs are just block coordinates.
+        """
+        tasks, operands = [], {}
+        for i, j, k in unit:
+            A_block, B_block = prepare_block((i, j, k))
+            if use_cache:
+                A_ref = operand_ref(("A", i, k), A_block)
+                B_ref = operand_ref(("B", k, j), B_block)
+            else:
+                A_ref, B_ref = f"A:{i}:{k}", f"B:{k}:{j}"
+            operands.setdefault(A_ref, A_block)
+            operands.setdefault(B_ref, B_block)
+            tasks.append({
+                "job_id": job_id,
+                "row_block": i,
+                "col_block": j,
+                "depth_block": k,
+                "A_ref": A_ref,
+                "B_ref": B_ref
+            })
+
+        meta = {"aggregator_url": submit_url, "cacheable": use_cache, "tasks": tasks}
+        count_serialized(len(unit))
+        return meta, operands
+
+    def prepare_batch(unit):
+        """Pack several small tasks into one /multiply_batch frame."""
+        meta, operands = batch_operands(unit)
+        body = task_frame(meta, operands, [] if use_cache else list(operands))
+        return "/multiply_batch", unit, meta, operands, body
+
+    def lease_payload(unit):
+        """A leased batch always carries its operands by value."""
+        meta, operands = batch_operands(unit)
+        meta["job_id"] = job_id
+        return meta, operands
+
+    headers = {"Content-Type": FRAME_CONTENT_TYPE}
+    plan = spec["plan"]
+    if plan is None:
+        owner = None
+        worker_urls = [spec["worker_url"]]
+        if spec["dispatch"] == "push":
+            # Requests to the worker URL are spread over every instance behind it
+            replicas = await asyncio.to_thread(discover_workers, spec["worker_url"], spec["worker_urls"])
+            gate.set_replicas(spec["worker_url"], len(replicas))
+    else:
+        # Every tile goes to the worker owning it on the processor grid
+        owner = grid_owner(*plan["grid"], row_blocks, col_blocks)
+        worker_urls = plan["workers"]
+    workers = [dispatcher.client(url) for url in worker_urls]
+
+    def make_units(tasks):
+        if owner is None:
+            return batched(tasks, batch_size)
+        tasks = np.asarray(list(tasks), dtype=np.int64).reshape(-1, 3)
+        return interleave_units(tasks, owner(tasks[:, 0], tasks[:, 1]), batch_size)
+
+    async def send_unit(item):
+        path, unit, meta, operands, body = item
+        index = 0 if owner is None else owner(*unit[0][:2])
+        worker = workers[index]
+        try:
+            async with gate.slot(job_id, worker_urls[index], len(body)):
+                status["blocks_sent"] += len(unit)
+                status["bytes_sent"] += len(body)
+                sent, start = len(body), time.perf_counter()
+                resp = await worker.post(path, content=body, headers=headers)
+                if resp.status_code == 409:
+                    # Cache miss: upload only the operands the worker lacks
+                    missing = resp.json()["detail"]["missing"]
+                    body = await asyncio.to_thread(task_frame, meta, operands, missing)
+                    status["bytes_sent"] += len(body)
+                    sent += len(body)
+                    resp = await worker.post(path, content=body, headers=headers)
+                elapsed = time.perf_counter() - start
+
             if resp.status_code == 200:
-                print(f"✅ Initialized aggregator job {job_id}")
+                if status["mode"] != "sparse":
+                    # Dense products feed the block-size cost model
+                    cost_model.observe(sum(task_flops(*task) for task in unit), sent, elapsed,
+                                       resp.json().get("compute_time_sec", 0.0))
+                return True
             else:
-                print(f"⚠️ Aggregator returned {resp.status_code} (may already exist)")
-        except requests.exceptions.RequestException as e:
-            print(f"⚠️ Aggregator init failed: {e}")
-
-        print(f"📦 Job {job_id}: dispatching {total_blocks} blocks "
-              f"({row_blocks}×{col_blocks}×{depth_blocks})")
-
-        # Define block sending task
-        def send_block(i, j, k):
-            """
-            Compute partial result for C[i,j] from k-th depth slice:
-            C[i,j] += A[i,k] × B[k,j]
-            """
+                print(f"❌ Worker returned {resp.status_code} for blocks {unit[0]}..{unit[-1]}")
+                return False
+
+        except Exception as e:
+            print(f"❌ Failed blocks {unit[0]}..{unit[-1]}: {e}")
+            return False
+
+    def report(unit, ok):
+        status["blocks_acknowledged" if ok else "blocks_failed"] += len(unit)
+        done = status["blocks_acknowledged"] + status["blocks_failed"]
+        if done // 100 != (done - len(unit)) // 100 or done == total_blocks:
+            print(f"🚀 Progress: {done}/{total_blocks} dispatched "
+                  f"({status['blocks_acknowledged']} success, {status['blocks_failed']} failed)")
+
+    # Small blocks are packed into batches so per-request overhead does
+    # not dominate; large blocks and tile tasks go one per request
+    itemsize = np.result_type(A.dtype, B.dtype).itemsize
+    batch_size = batch_size_for(br, bc, bk, itemsize) if status["mode"] == "block" else 1
+    status["batch_size"] = batch_size
+
+    # Requests are prepared and held in flight within the tile budget
+    if status["mode"] == "sparse":
+        # Average bytes of a CSR row-panel of A and a CSC column-panel of B
+        unit_bytes = array_nbytes(A) * br // max(1, A.shape[0]) + array_nbytes(B) * bc // max(1, B.shape[1])
+    else:
+        unit_bytes = batch_size * (br * bk + bk * bc) * itemsize
+    window = budget_window(spec["max_in_flight"], unit_bytes)
+    status["window"] = window
+
+    # Every request gets retries and, once it straggles past the
+    # latency deadline, a speculative copy; the aggregator drops duplicates
+    latency = LatencyTracker(HEDGE_PERCENTILE, HEDGE_FACTOR, HEDGE_MIN_SEC)
+
+    async def send_hedged(item):
+        return await dispatcher.send_hedged(send_unit, item, latency, attempts=SEND_ATTEMPTS)
+
+    async def dispatch_tasks(tasks, total, on_result):
+        if spec["dispatch"] == "pull":
+            # Workers lease the tasks through /lease and confirm via /complete
+            def report_lease(unit, ok):
+                if ok:
+                    status["blocks_sent"] += len(unit)
+                on_result(unit, ok)
+
+            await scheduler.run(job_id, tasks, total, max(batch_size, PULL_MIN_LEASE),
+                                lease_payload, report_lease, weight=spec["weight"],
+                                priority=spec["priority"])
+        else:
+            # Push with a bounded number in flight
+            await dispatcher.dispatch(
+                make_units(tasks),
+                prepare_batch if batch_size > 1 else prepare_single,
+                send_hedged,
+                window=window,
+                on_result=on_result
+            )
+
+    def report_redispatch(unit, ok):
+        if ok:
+            status["blocks_redispatched"] += len(unit)
+
+    # Dispatch the nonzero blocks, in blocks of output tiles whose A and
+    # B panels fit the tile budget together
+    panel_bytes = (br * A.shape[1] * A.dtype.itemsize + B.shape[0] * bc * B.dtype.itemsize)
+    group = max(1, TILE_BUDGET_BYTES // panel_bytes)
+    await dispatch_tasks(tiled_tasks(A_occ, B_occ, group), total_blocks, report)
+    dispatched, failed = status["blocks_acknowledged"], status["blocks_failed"]
+
+    # An acknowledged block can still be lost between worker and aggregator
+    # (worker restart, failed submit), and failed blocks were never
+    # computed: once arrivals stall, dispatch whatever is still missing
+    missing = await missing_blocks(job_id, aggregator_url)
+    for _ in range(RECONCILE_ROUNDS):
+        if not missing:
+            break
+        status["state"] = "reconciling"
+        print(f"🔁 Job {job_id}: re-dispatching {len(missing)} missing blocks")
+        await dispatch_tasks([tuple(task) for task in missing], len(missing), report_redispatch)
+        missing = await missing_blocks(job_id, aggregator_url)
+
+    status["latency"] = latency.stats()
+    if missing is not None:
+        status["blocks_missing"] = len(missing)
+        failed = len(missing)
+
+    elapsed = time.perf_counter() - start_time
+    status["state"] = "done" if failed == 0 else "failed"
+    status["time_sec"] = elapsed
+    print(f"✅ Splitter job {job_id} completed: {dispatched}/{total_blocks} "
+          f"blocks ({status['blocks_redispatched']} re-dispatched) in {elapsed:.2f}s")
+
+
+async def run_summa(spec):
+    """
+    Run a SUMMA job: for every step k, send grid worker (p, q) the slices
+    A[rows_p, panel k] and B[panel k, cols_q], then ask every worker to
+    submit its finished C tile. Tiles the aggregator still misses are
+    redone from scratch under a new round.
+    """
+    job_id = spec["job_id"]
+    status = split_jobs[job_id]
+    plan = spec["plan"]
+    A, B, width = spec["A"], spec["B"], spec["bk"]
+    pr, pc = plan["grid"]
+    tile_rows, tile_cols = plan["tile_shape"]
+    steps = plan["steps"]
+    aggregator_url = spec["aggregator_url"]
+    workers = [dispatcher.client(url) for url in plan["workers"]]
+    dtype = np.result_type(A.dtype, B.dtype).str
+    headers = {"Content-Type": FRAME_CONTENT_TYPE}
+    latency = LatencyTracker(HEDGE_PERCENTILE, HEDGE_FACTOR, HEDGE_MIN_SEC)
+    rounds = {}
+
+    start_time = time.perf_counter()
+    status["state"] = "dispatching"
+    status.update(steps_total=pr * pc * steps, steps_acknowledged=0, steps_failed=0)
+    print(f"📦 Job {job_id}: SUMMA with {steps} steps on a {pr}×{pc} grid")
+
+    def prepare_step(task):
+        p, q, k = task
+        A_panel = np.ascontiguousarray(A[p*tile_rows:(p+1)*tile_rows, k*width:(k+1)*width])
+        B_panel = np.ascontiguousarray(B[k*width:(k+1)*width, q*tile_cols:(q+1)*tile_cols])
+        meta = {
+            "job_id": job_id,
+            "row_block": p,
+            "col_block": q,
+            "round": rounds.get((p, q), 0),
+            "step": k,
+            "shape": [A_panel.shape[0], B_panel.shape[1]],
+            "dtype": dtype
+        }
+        return task, encode_frame(meta, {"A": A_panel, "B": B_panel})
+
+    async def send_step(item):
+        (p, q, k), body = item
+        try:
+            async with gate.slot(job_id, plan["workers"][p * pc + q], len(body)):
+                status["bytes_sent"] += len(body)
+                start = time.perf_counter()
+                resp = await workers[p * pc + q].post("/summa/step", content=body, headers=headers)
+                elapsed = time.perf_counter() - start
+            if resp.status_code == 200:
+                rows = min(tile_rows, A.shape[0] - p * tile_rows)
+                cols = min(tile_cols, B.shape[1] - q * tile_cols)
+                depth = min(width, A.shape[1] - k * width)
+                cost_model.observe(2 * rows * cols * depth, len(body), elapsed,
+                                   resp.json().get("compute_time_sec", 0.0))
+                return True
+            print(f"❌ Worker returned {resp.status_code} for SUMMA step {k} of tile ({p},{q})")
+            return False
+        except httpx.HTTPError as e:
+            print(f"❌ Failed SUMMA step {k} of tile ({p},{q}): {e}")
+            return False
+
+    async def send_hedged(item):
+        return await dispatcher.send_hedged(send_step, item, latency, attempts=SEND_ATTEMPTS)
+
+    def report(task, ok):
+        status["steps_acknowledged" if ok else "steps_failed"] += 1
+
+    itemsize = np.result_type(A.dtype, B.dtype).itemsize
+    window = budget_window(spec["max_in_flight"], (tile_rows + tile_cols) * width * itemsize)
+    status["window"] = window
+
+    async def run_steps(tasks):
+        await dispatcher.dispatch(tasks, prepare_step, send_hedged,
+                                  window=window, on_result=report)
+
+    async def finish(p, q):
+        """Have worker (p, q) submit its tile, resending steps it lost."""
+        for _ in range(SEND_ATTEMPTS):
             try:
-                A_block = A[i*b:(i+1)*b, k*b:(k+1)*b]
-                B_block = B[k*b:(k+1)*b, j*b:(j+1)*b]
-
-                bufA, bufB = io.BytesIO(), io.BytesIO()
-                np.save(bufA, A_block, allow_pickle=False)
-                np.save(bufB, B_block, allow_pickle=False)
-                bufA.seek(0)
-                bufB.seek(0)
-
-                files = {
-                    "A_file": (f"A_block_{i}_{k}.npy", bufA, "application/octet-stream"),
-                    "B_file": (f"B_block_{k}_{j}.npy", bufB, "application/octet-stream")
-                }
-                
-                data = {
+                resp = await workers[p * pc + q].post("/summa/finish", json={
                     "job_id": job_id,
-                    "row_block": i,
-                    "col_block": j,
-                    "depth_block": k,  # ✅ ADDED: Include k-index
-                    "aggregator_url": aggregator_url
-                }
-
-                resp = requests.post(
-                    f"{worker_url}/multiply",
-                    data=data,
-                    files=files,
-                    timeout=30
-                )
-                
-                if resp.status_code == 200:
-                    return True
-                else:
-                    print(f"❌ Worker returned {resp.status_code} for block ({i},{j},{k})")
-                    return False
+                    "row_block": p,
+                    "col_block": q,
+                    "round": rounds.get((p, q), 0),
+                    "steps": steps,
+                    "aggregator_url": spec["submit_url"]
+                })
+            except httpx.HTTPError as e:
+                print(f"❌ Failed to finish SUMMA tile ({p},{q}): {e}")
+                await asyncio.sleep(1.0)
+                continue
+            if resp.status_code == 200:
+                return True
+            if resp.status_code == 409:
+                missing = resp.json()["detail"]["missing_steps"]
+                print(f"🔁 Tile ({p},{q}) is missing {len(missing)} steps, resending")
+                await run_steps((p, q, k) for k in missing)
+                continue
+            print(f"❌ Worker returned {resp.status_code} finishing SUMMA tile ({p},{q})")
+            return False
+        return False
 
-            except Exception as e:
-                print(f"❌ Failed block ({i},{j},{k}): {e}")
-                return False
+    async def run_tiles(tiles):
+        # Step-major order, so every worker gets step k before step k+1
+        await run_steps((p, q, k) for k in range(steps) for p, q in tiles)
+        return await asyncio.gather(*(finish(p, q) for p, q in tiles))
 
-        # Dispatch all blocks concurrently
-        dispatched, failed = 0, 0
-        with ThreadPoolExecutor(max_workers=16) as executor:
-            futures = [
-                executor.submit(send_block, i, j, k)
-                for i in range(row_blocks)
-                for j in range(col_blocks)
-                for k in range(depth_blocks)
-            ]
-
-            for idx, f in enumerate(as_completed(futures), start=1):
-                result = f.result()
-                if result:
-                    dispatched += 1
-                else:
-                    failed += 1
+    tiles = [(p, q) for p in range(pr) for q in range(pc)]
+    finished = await run_tiles(tiles)
+    status["blocks_acknowledged"] = sum(finished)
+    status["blocks_failed"] = len(finished) - sum(finished)
+
+    missing = await missing_blocks(job_id, aggregator_url)
+    for _ in range(RECONCILE_ROUNDS):
+        if not missing:
+            break
+        status["state"] = "reconciling"
+        tiles = [(p, q) for p, q, _ in missing]
+        for tile in tiles:
+            rounds[tile] = rounds.get(tile, 0) + 1
+        print(f"🔁 Job {job_id}: redoing {len(tiles)} SUMMA tiles")
+        await run_tiles(tiles)
+        status["blocks_redispatched"] += len(tiles)
+        missing = await missing_blocks(job_id, aggregator_url)
+
+    failed = status["blocks_failed"] if missing is None else len(missing)
+    if missing is not None:
+        status["blocks_missing"] = len(missing)
+    status["latency"] = latency.stats()
+
+    elapsed = time.perf_counter() - start_time
+    status["state"] = "done" if failed == 0 else "failed"
+    status["time_sec"] = elapsed
+    print(f"✅ Splitter SUMMA job {job_id} completed: {status['blocks_acknowledged']}/{pr * pc} "
+          f"tiles, {status['bytes_sent'] / 1e6:.1f} MB sent in {elapsed:.2f}s")
+
+
+async def aggregator_shards(aggregator_url):
+    """The shard URLs behind a sharded aggregator front, or None for a single aggregator."""
+    try:
+        resp = await dispatcher.client(aggregator_url).get("/shards", timeout=10)
+    except httpx.HTTPError:
+        return None
+    return resp.json()["shards"] if resp.status_code == 200 else None
 
-                if idx % 100 == 0 or idx == total_blocks:
-                    print(f"🚀 Progress: {idx}/{total_blocks} dispatched "
-                          f"({dispatched} success, {failed} failed)")
 
-        elapsed = time.perf_counter() - start_time
-        print(f"✅ Splitter job {job_id} completed: {dispatched}/{total_blocks} "
-              f"blocks in {elapsed:.2f}s")
+async def live_workers(worker_url, worker_urls, dispatch):
+    """
+    Number of workers a job can count on: the pulling workers seen in the
+    last minute for dispatch="pull", else the worker instances (see
+    discover_workers) that answer /health.
+    """
+    if dispatch == "pull":
+        now = time.time()
+        return max(1, sum(1 for worker in scheduler.workers.values()
+                          if now - worker.get("last_seen", 0) < 60))
+    urls = await asyncio.to_thread(discover_workers, worker_url, worker_urls)
 
-        # Cleanup temp files
+    async def alive(url):
         try:
-            os.remove(A_path)
-            os.remove(B_path)
-            os.rmdir(tmp_dir)
-        except:
-            pass
+            return (await dispatcher.client(url).get("/health", timeout=2)).status_code == 200
+        except httpx.HTTPError:
+            return False
 
-        return {
-            "job_id": job_id,
-            "blocks_dispatched": dispatched,
-            "block_size": b,
-            "shape_A": list(A.shape),
-            "shape_B": list(B.shape),
-            "time_sec": elapsed,
-            "failed": failed
-        }
+    return max(1, sum(await asyncio.gather(*(alive(url) for url in urls))))
+
+
+async def missing_blocks(job_id, aggregator_url):
+    """
+    Wait until the aggregator has every block or has received nothing new
+    for RECONCILE_GRACE_SEC, and return the (i,j,k) blocks it is missing
+    (None if the aggregator cannot be asked). An aggregator that cannot be
+    reached is retried for up to AGGREGATOR_RESTART_SEC.
+    """
+    aggregator = dispatcher.client(aggregator_url)
+    received, last_change = None, time.perf_counter()
+    unreachable_since = None
+    while True:
+        try:
+            resp = await aggregator.get(f"/aggregate/missing/{job_id}")
+            resp.raise_for_status()
+            report = resp.json()
+        except httpx.TransportError as e:
+            if unreachable_since is None:
+                print(f"⚠️ Aggregator unreachable while reconciling job {job_id}: {e!r}, retrying")
+                unreachable_since = time.perf_counter()
+            elif time.perf_counter() - unreachable_since >= AGGREGATOR_RESTART_SEC:
+                print(f"⚠️ Could not reconcile job {job_id} with the aggregator: {e!r}")
+                return None
+            await asyncio.sleep(1.0)
+            continue
+        except httpx.HTTPError as e:
+            print(f"⚠️ Could not reconcile job {job_id} with the aggregator: {e}")
+            return None
+        unreachable_since = None
+
+        if report["missing_total"] == 0:
+            return []
+        if report["received"] != received:
+            received, last_change = report["received"], time.perf_counter()
+        elif time.perf_counter() - last_change >= RECONCILE_GRACE_SEC:
+            return report["missing"]
+        await asyncio.sleep(0.5)
+
+
+@app.post("/lease")
+async def lease_tasks(request: Request):
+    """
+    Lease a batch of tasks for a pulling worker.
 
+    The JSON body holds worker_id, max_tasks and wait_sec (long-poll
+    time). The response is a /multiply_batch frame whose meta adds
+    lease_id, job_id and lease_timeout_sec, with every operand attached;
+    204 if no task became available within wait_sec.
+    """
+    data = await request.json()
+    worker_id = data.get("worker_id")
+    if not worker_id:
+        raise HTTPException(status_code=400, detail="Missing worker_id")
+    max_tasks = max(1, int(data.get("max_tasks", 1)))
+    wait_sec = min(max(0.0, float(data.get("wait_sec", 0))), 30.0)
+
+    leased = await scheduler.lease(worker_id, max_tasks, wait_sec)
+    if leased is None:
+        return Response(status_code=204)
+
+    lease_id, job_id, tasks, build = leased
+    try:
+        meta, operands = await asyncio.to_thread(build, tasks)
+        meta.update(lease_id=lease_id, lease_timeout_sec=scheduler.lease_timeout)
+        body = await asyncio.to_thread(task_frame, meta, operands, list(operands))
     except Exception as e:
+        scheduler.release(lease_id)
+        print(f"❌ Failed to prepare lease {lease_id} for job {job_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    return Response(content=body, media_type=FRAME_CONTENT_TYPE)
+
+
+@app.post("/complete")
+async def complete_lease(request: Request):
+    """
+    Report a lease as done ({"lease_id", "ok": true}) once its results are
+    queued for the aggregator, or as failed ("ok": false) to requeue it.
+    """
+    data = await request.json()
+    lease_id = data.get("lease_id")
+    if not lease_id:
+        raise HTTPException(status_code=400, detail="Missing lease_id")
+    accepted = scheduler.complete(lease_id, bool(data.get("ok", True)))
+    return {"lease_id": lease_id, "accepted": accepted}
+
+
+@app.get("/scheduler")
+def scheduler_stats():
+    return {
+        **scheduler.stats(),
+        "push": gate.stats(),
+        "queued_jobs": job_queue.qsize(),
+        "max_queued_jobs": MAX_QUEUED_JOBS,
+    }
+
+
+@app.get("/autotune")
+def autotune_stats():
+    """The cost model block_size="auto" currently plans with."""
+    return {**cost_model.estimate(), "max_task_bytes": AUTO_MAX_TASK_BYTES}
+
+
+@app.get("/cache")
+def cache_stats():
+    return {**content_cache.stats(), "memo_keys": len(memo_jobs)}
+
+
+def job_state(status):
+    """A job attached to an identical one is in that job's state."""
+    if status["state"] == "attached":
+        return split_jobs[status["attached_to"]]["state"]
+    return status["state"]
+
+
+@app.get("/jobs")
+def list_jobs():
+    return {
+        job_id: {
+            "state": job_state(status),
+            "acknowledged": status["blocks_acknowledged"],
+            "total": status["blocks_total"]
+        } for job_id, status in split_jobs.items()
+    }
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    if job_id not in split_jobs:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    status = split_jobs[job_id]
+    return {**status, "state": job_state(status)}
 
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
@@ -0,0 +1,61 @@
+import json
+import time
+
+import requests
+
+
+def submit_job(splitter_url, files, data, job_label="", timeout=300):
+    """
+    POST a job to the splitter's /split and return the response. /split
+    returns once the job is queued, so only the upload counts against
+    `timeout`. A full splitter queue (503) or aggregator (429) says when
+    to retry in Retry-After; the upload is rewound and sent again then.
+    """
+    while True:
+        resp = requests.post(f"{splitter_url}/split", files=files, data=data, timeout=timeout)
+        if resp.status_code not in (429, 503):
+            return resp
+        retry_after = float(resp.headers.get("Retry-After", 5))
+        print(f"{job_label}  Splitter busy ({resp.status_code}), retrying in {retry_after:.0f}s")
+        time.sleep(retry_after)
+        for _, buf, *_ in files.values():
+            buf.seek(0)
+
+
+def wait_for_result(aggregator_url, job_id, job_label="", timeout=2700):
+    """
+    Follow the aggregator's Server-Sent Events stream for `job_id` and
+    return the final_result response from its "complete" event, or None
+    after `timeout` seconds. Reconnects if the stream drops.
+    """
+    events_url = f"{aggregator_url}/aggregate/events/{job_id}"
+    deadline = time.time() + timeout
+    last_report = time.time()
+
+    while time.time() < deadline:
+        try:
+            # The aggregator sends a keep-alive every 15s, so a 60s read timeout only trips on a dead stream
+            with requests.get(events_url, stream=True, timeout=(10, 60)) as r:
+                if r.status_code == 404:
+                    time.sleep(1)
+                    continue
+                r.raise_for_status()
+
+                event = None
+                for line in r.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:"):
+                        data = json.loads(line[len("data:"):])
+                        if event == "complete":
+                            return data
+                        # Print progress every minute
+                        if event == "progress" and time.time() - last_report >= 60:
+                            print(f"{job_label}  Still waiting... "
+                                  f"({data['received']}/{data['blocks_expected']} blocks)")
+                            last_report = time.time()
+        except requests.RequestException as e:
+            print(f"{job_label}  Event stream error: {e}")
+            time.sleep(1)
+
+    return None
@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from common.common_utils import array_nbytes, is_sparse
+
+
+def _detach(block):
+    """
+    Copy a block that is a view into a larger buffer (e.g. np.frombuffer
+    over a request body), so caching it does not pin the whole buffer.
+    """
+    if is_sparse(block):
+        parts = (block.data, block.indices, block.indptr) if block.format in ("csr", "csc") else ()
+        return block.copy() if any(part.base is not None for part in parts) else block
+    return np.array(block, copy=True) if block.base is not None else block
+
+
+class OperandCache:
+    """
+    LRU cache of operand blocks keyed by the content hash the splitter
+    computed for them, bounded by a total byte budget. Sparse operands
+    count their data, indices and indptr bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._blocks: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, ref: str):
+        with self._lock:
+            block = self._blocks.get(ref)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(ref)
+            self.hits += 1
+            return block
+
+    def put(self, ref: str, block: np.ndarray):
+        block = _detach(block)
+        nbytes = array_nbytes(block)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(ref, None)
+            if old is not None:
+                self._bytes -= array_nbytes(old)
+            self._blocks[ref] = block
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self._bytes -= array_nbytes(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._blocks),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import httpx
+
+from common.common_utils import FRAME_CONTENT_TYPE, array_nbytes, encode_frame, shard_url
+
+
+class ResultSubmitter:
+    """
+    Background queue that ships finished blocks to the aggregator.
+
+    Blocks that finish within `linger_sec` of each other are coalesced into
+    one /aggregate/submit_blocks request (up to `max_batch` blocks or
+    `max_batch_bytes`), sent over a pooled keep-alive connection per
+    aggregator, and retried with exponential backoff on transport errors,
+    429 and 5xx responses. The aggregator drops duplicate (i,j,k) blocks,
+    so a retry after a lost response is harmless.
+    """
+
+    def __init__(self, max_batch=32, max_batch_bytes=64 * 1024 * 1024, linger_sec=0.005,
+                 queue_size=256, senders=2, max_attempts=5, timeout=30.0):
+        self.max_batch = max_batch
+        self.max_batch_bytes = max_batch_bytes
+        self.linger_sec = linger_sec
+        self.senders = senders
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._clients = {}
+        self._tasks = []
+        self.submitted = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.senders)]
+
+    async def stop(self, drain_timeout=10.0):
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Dropping {self.queue.qsize()} unsent blocks on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        for client in self._clients.values():
+            await client.aclose()
+
+    async def submit(self, aggregator_url, meta, block):
+        """
+        Queue one block; waits only if the queue is full (backpressure).
+        If aggregator_url lists several shards the block goes to the one
+        owning its tile.
+        """
+        await self.queue.put((shard_url(aggregator_url, meta), meta, block))
+
+    def _client(self, base_url):
+        client = self._clients.get(base_url)
+        if client is None:
+            client = httpx.AsyncClient(base_url=base_url, timeout=self.timeout)
+            self._clients[base_url] = client
+        return client
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        nbytes = array_nbytes(batch[0][2])
+        deadline = time.perf_counter() + self.linger_sec
+        while len(batch) < self.max_batch and nbytes < self.max_batch_bytes:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            nbytes += array_nbytes(item[2])
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                by_aggregator = {}
+                for aggregator_url, meta, block in batch:
+                    by_aggregator.setdefault(aggregator_url, []).append((meta, block))
+                for aggregator_url, items in by_aggregator.items():
+                    await self._send(aggregator_url, items)
+            except Exception as e:
+                print(f"❌ Result submitter error: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _send(self, aggregator_url, items):
+        frame = encode_frame(
+            {"blocks": [meta for meta, _ in items]},
+            {f"C{idx}": block for idx, (_, block) in enumerate(items)}
+        )
+        client = self._client(aggregator_url)
+        delay = 0.1
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                resp = await client.post(
+                    "/aggregate/submit_blocks",
+                    content=frame,
+                    headers={"Content-Type": FRAME_CONTENT_TYPE}
+                )
+                resp.raise_for_status()
+                for meta, result in zip((meta for meta, _ in items), resp.json()["results"]):
+                    if result["status"] == "error":
+                        print(f"❌ Aggregator rejected block ({meta['row_block']},{meta['col_block']},"
+                              f"{meta['depth_block']}) for job {meta['job_id']}: {result['detail']}")
+                self.submitted += len(items)
+                self.batches += 1
+                return
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                transient = (not isinstance(e, httpx.HTTPStatusError)
+                             or e.response.status_code == 429 or e.response.status_code >= 500)
+                if not transient or attempt == self.max_attempts:
+                    self.failed += len(items)
+                    print(f"❌ Failed to submit {len(items)} blocks to {aggregator_url}: {e}")
+                    return
+                self.retries += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "submitted": self.submitted,
+            "batches": self.batches,
+            "avg_batch_size": self.submitted / self.batches if self.batches else 0.0,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
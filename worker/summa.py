@@ -0,0 +1,77 @@
+import threading
+import time
+
+import numpy as np
+
+
+class SummaAccumulators:
+    """
+    Local C tiles of the SUMMA jobs this worker takes part in, keyed by
+    (job_id, row_block, col_block, round).
+
+    Every step adds one A panel × B panel product into the job's tile.
+    Steps are recorded so a retried or speculative copy of a step is
+    added only once, and so the splitter can learn which steps a worker
+    lost (e.g. after a restart). Tiles untouched for `ttl_sec` are dropped.
+    """
+
+    def __init__(self, ttl_sec=3600.0):
+        self.ttl_sec = ttl_sec
+        self._tiles = {}
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, step, shape, dtype, product):
+        """Add `product` for `step`; returns False if the step was already added."""
+        with self._lock:
+            self._evict_stale()
+            if key in self._finished:
+                return False
+            tile = self._tiles.get(key)
+            if tile is None:
+                tile = self._tiles[key] = {
+                    "C": np.zeros(shape, dtype=dtype),
+                    "steps": set(),
+                    "lock": threading.Lock(),
+                }
+            tile["touched"] = time.monotonic()
+            if step in tile["steps"]:
+                return False
+            tile["steps"].add(step)
+        with tile["lock"]:
+            tile["C"] += product
+        return True
+
+    def missing(self, key, steps):
+        with self._lock:
+            if key in self._finished:
+                return []
+            tile = self._tiles.get(key)
+            done = tile["steps"] if tile else set()
+            return [step for step in range(steps) if step not in done]
+
+    def pop(self, key):
+        """Take the finished tile; None if it was taken already."""
+        with self._lock:
+            tile = self._tiles.pop(key, None)
+            if tile is not None:
+                self._finished[key] = time.monotonic()
+        if tile is None:
+            return None
+        with tile["lock"]:
+            return tile["C"]
+
+    def _evict_stale(self):
+        now = time.monotonic()
+        for key in [key for key, tile in self._tiles.items() if now - tile["touched"] > self.ttl_sec]:
+            print(f"🧹 Dropping stale SUMMA tile {key}")
+            del self._tiles[key]
+        for key in [key for key, finished in self._finished.items() if now - finished > self.ttl_sec]:
+            del self._finished[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tiles": len(self._tiles),
+                "bytes": sum(tile["C"].nbytes for tile in self._tiles.values()),
+            }
@@ -1,37 +1,241 @@
-from fastapi import FastAPI, UploadFile, Form, HTTPException
+import os
+
+# Threads per BLAS call. This has to be in the environment before numpy
+# loads its BLAS library; explicit OMP/OPENBLAS/MKL settings still win.
+BLAS_THREADS = int(os.environ.get("WORKER_BLAS_THREADS", 1))
+for _var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_var, str(BLAS_THREADS))
+
+from fastapi import FastAPI, Request, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import numpy as np
-import requests
-import io
+import asyncio
+import httpx
+import operator
+import socket
+import threading
 import time
 
-app = FastAPI(title="Worker Microservice")
+from common.common_utils import decode_frame, is_sparse
+from operand_cache import OperandCache
+from submitter import ResultSubmitter
+from summa import SummaAccumulators
+
+
+def available_cpus():
+    """CPUs this container may use: the cgroup quota if set, else the affinity mask."""
+    cpus = len(os.sched_getaffinity(0))
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+# Matmuls run in this pool so the event loop keeps receiving blocks while
+# others compute. Compute threads × BLAS threads defaults to the CPU count.
+COMPUTE_THREADS = int(os.environ.get("WORKER_COMPUTE_THREADS", 0)) or max(1, available_cpus() // BLAS_THREADS)
+compute_pool = ThreadPoolExecutor(max_workers=COMPUTE_THREADS, thread_name_prefix="matmul")
+
+
+class WorkerMetrics:
+    """Concurrency and utilization counters for /metrics."""
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.started_at = time.time()
+        self.in_flight = 0        # requests inside /multiply
+        self.computing = 0        # matmuls running in the compute pool
+        self.computed = 0         # matmuls finished
+        self.completed = 0        # blocks computed and queued for the aggregator
+        self.failed = 0
+        self.busy_sec = 0.0       # total matmul time across threads
+        self.queue_wait_sec = 0.0 # total time blocks waited for a compute thread
+        self._lock = threading.Lock()
+
+    def compute(self, queued_at, fn, *args):
+        """Run fn(*args) in a compute thread and record its timing."""
+        start = time.perf_counter()
+        with self._lock:
+            self.computing += 1
+            self.queue_wait_sec += start - queued_at
+        try:
+            return fn(*args), time.perf_counter() - start
+        finally:
+            with self._lock:
+                self.computing -= 1
+                self.computed += 1
+                self.busy_sec += time.perf_counter() - start
+
+    def snapshot(self):
+        with self._lock:
+            uptime = time.time() - self.started_at
+            return {
+                "compute_threads": self.threads,
+                "blas_threads": BLAS_THREADS,
+                "in_flight": self.in_flight,
+                "computing": self.computing,
+                "completed": self.completed,
+                "failed": self.failed,
+                "busy_sec": self.busy_sec,
+                "avg_queue_wait_sec": self.queue_wait_sec / self.computed if self.computed else 0.0,
+                "utilization": self.busy_sec / (uptime * self.threads) if uptime > 0 else 0.0,
+                "uptime_sec": uptime,
+            }
+
+
+metrics = WorkerMetrics(COMPUTE_THREADS)
+
+# Finished blocks are coalesced and sent to the aggregator in the background
+submitter = ResultSubmitter(
+    max_batch=int(os.environ.get("WORKER_SUBMIT_MAX_BATCH", 32)),
+    linger_sec=float(os.environ.get("WORKER_SUBMIT_LINGER_SEC", 0.005)),
+    queue_size=int(os.environ.get("WORKER_SUBMIT_QUEUE_SIZE", 256))
+)
+
+
+# Pull mode: with WORKER_PULL_URL set to the splitter, PULL_CONCURRENCY
+# loops lease up to PULL_MAX_TASKS tasks at a time from its /lease endpoint,
+# so this worker takes work as fast as it finishes it
+PULL_URL = os.environ.get("WORKER_PULL_URL")
+PULL_CONCURRENCY = int(os.environ.get("WORKER_PULL_CONCURRENCY", 0)) or COMPUTE_THREADS
+PULL_MAX_TASKS = int(os.environ.get("WORKER_PULL_MAX_TASKS", 32))
+PULL_WAIT_SEC = float(os.environ.get("WORKER_PULL_WAIT_SEC", 10))
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+async def pull_loop(client):
+    """Lease batches from the splitter, compute them and report completion."""
+    while True:
+        try:
+            resp = await client.post("/lease", json={
+                "worker_id": WORKER_ID,
+                "max_tasks": PULL_MAX_TASKS,
+                "wait_sec": PULL_WAIT_SEC
+            })
+            if resp.status_code == 204:
+                continue
+            resp.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"⚠️ Lease request to {PULL_URL} failed: {e}")
+            await asyncio.sleep(1.0)
+            continue
+
+        try:
+            meta, arrays = decode_frame(resp.content)
+        except ValueError as e:
+            print(f"❌ Malformed lease from {PULL_URL}: {e}")
+            continue
+
+        ok = True
+        metrics.in_flight += 1
+        try:
+            await run_batch(meta, arrays)
+        except Exception as e:
+            ok = False
+            metrics.failed += 1
+            detail = e.detail if isinstance(e, HTTPException) else e
+            print(f"❌ Worker error for lease {meta.get('lease_id')}: {detail}")
+        finally:
+            metrics.in_flight -= 1
+
+        try:
+            await client.post("/complete", json={"lease_id": meta["lease_id"], "ok": ok})
+        except httpx.HTTPError as e:
+            # The lease expires and is requeued by the splitter
+            print(f"⚠️ Could not complete lease {meta['lease_id']}: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await submitter.start()
+    pullers, client = [], None
+    if PULL_URL:
+        client = httpx.AsyncClient(base_url=PULL_URL, timeout=PULL_WAIT_SEC + 30)
+        pullers = [asyncio.create_task(pull_loop(client)) for _ in range(PULL_CONCURRENCY)]
+        print(f"📡 Worker {WORKER_ID} pulling work from {PULL_URL} ({PULL_CONCURRENCY} loops)")
+    yield
+    for puller in pullers:
+        puller.cancel()
+    if client is not None:
+        await client.aclose()
+    await submitter.stop()
+    compute_pool.shutdown(wait=False)
+
+
+app = FastAPI(title="Worker Microservice", lifespan=lifespan)
+
+# Operand blocks received by value, kept so later tasks can send a reference
+operand_cache = OperandCache(int(os.environ.get("WORKER_CACHE_BYTES", 512 * 1024 * 1024)))
+
+# C tiles owned by this worker in SUMMA jobs
+summa_tiles = SummaAccumulators(float(os.environ.get("WORKER_SUMMA_TTL_SEC", 3600)))
+
+
+def resolve_operand(name, block, ref, missing):
+    """
+    Return the operand sent by value (`block`), or the cached block for
+    `ref`. Blocks sent by value are cached under their ref. If the operand
+    is neither attached nor cached, its name is appended to `missing`.
+    """
+    if block is not None:
+        if ref:
+            operand_cache.put(ref, block)
+        return block
+
+    block = operand_cache.get(ref) if ref else None
+    if block is None:
+        missing.append(name)
+    return block
+
 
 @app.post("/multiply")
-async def multiply_blocks(
-    A_file: UploadFile,
-    B_file: UploadFile,
-    job_id: str = Form(...),
-    row_block: int = Form(...),
-    col_block: int = Form(...),
-    depth_block: int = Form(...),  # ✅ ADDED: Receive k-index
-    aggregator_url: str = Form(...)
-):
+async def multiply_blocks(request: Request):
     """
     Compute partial result for C[row_block, col_block]:
     partial_result = A[row_block, depth_block] × B[depth_block, col_block]
     
     This represents ONE contribution to the final C[i,j] block.
     The aggregator will sum all depth_block contributions.
+
+    In tile mode the splitter sends the whole A row-panel and B
+    column-panel with depth_block=0, so the k-reduction happens here and
+    the submitted block is the finished C[i,j] tile.
+
+    Sparse jobs send CSR row-panels and CSC column-panels (either may
+    also be dense); the product is computed with scipy's sparse×dense or
+    sparse×sparse kernel and submitted as it comes out (dense, or CSR).
+
+    The body is a block frame (see common.common_utils) whose meta holds
+    job_id, row_block, col_block, depth_block and aggregator_url.
+    Operands are sent by value as the frame arrays "A"/"B", or by
+    reference through meta A_ref/B_ref (the content hash of the block). A
+    reference that is not in this worker's operand cache is answered with
+    409 and {"missing": [...]} so the splitter can resend those operands
+    by value.
     """
+    meta = {}
+    metrics.in_flight += 1
     try:
-        start_time = time.perf_counter()
+        try:
+            meta, arrays = decode_frame(await request.body())
+            job_id = meta["job_id"]
+            row_block, col_block, depth_block = meta["row_block"], meta["col_block"], meta["depth_block"]
+            aggregator_url = meta["aggregator_url"]
+        except (ValueError, KeyError) as e:
+            raise HTTPException(status_code=400, detail=f"Malformed block frame: {e}")
 
-        # Load matrix blocks
-        A_content = await A_file.read()
-        B_content = await B_file.read()
-        
-        A_block = np.load(io.BytesIO(A_content))
-        B_block = np.load(io.BytesIO(B_content))
+        # Matrix blocks come from the request or from the operand cache
+        missing = []
+        A_block = resolve_operand("A", arrays.get("A"), meta.get("A_ref"), missing)
+        B_block = resolve_operand("B", arrays.get("B"), meta.get("B_ref"), missing)
+
+        if missing:
+            raise HTTPException(status_code=409, detail={"missing": missing})
 
         # Validate dimensions
         if A_block.shape[1] != B_block.shape[0]:
@@ -41,58 +245,260 @@ async def multiply_blocks(
                        f"A{A_block.shape} × B{B_block.shape}"
             )
 
-        # Perform block multiplication
-        result_block = A_block @ B_block
-        
-        compute_time = time.perf_counter() - start_time
+        # Perform block multiplication in the compute pool
+        result_block, compute_time = await asyncio.get_running_loop().run_in_executor(
+            compute_pool, metrics.compute, time.perf_counter(), operator.matmul, A_block, B_block
+        )
 
         print(f"✅ Computed block ({row_block},{col_block},{depth_block}) "
               f"for job {job_id} in {compute_time:.4f}s")
 
-        # Send result to aggregator
-        buf = io.BytesIO()
-        np.save(buf, result_block, allow_pickle=False)
-        buf.seek(0)
-
-        files = {
-            "file": (
-                f"result_{row_block}_{col_block}_{depth_block}.npy",
-                buf,
-                "application/octet-stream"
-            )
-        }
-        
-        data = {
-            "job_id": job_id,
-            "row_block": row_block,
-            "col_block": col_block,
-            "depth_block": depth_block,  # ✅ ADDED: Pass k-index to aggregator
-            "worker_time_sec": compute_time
-        }
-
-        resp = requests.post(
-            f"{aggregator_url}/aggregate/submit_block",
-            data=data,
-            files=files,
-            timeout=30
+        # Hand the result to the background submitter; the splitter's
+        # request does not wait for the aggregator round-trip
+        await submitter.submit(
+            aggregator_url,
+            {
+                "job_id": job_id,
+                "row_block": row_block,
+                "col_block": col_block,
+                "depth_block": depth_block,  # ✅ ADDED: Pass k-index to aggregator
+                "worker_time_sec": compute_time
+            },
+            result_block
         )
-        
-        resp.raise_for_status()
-
-        print(f"✅ Submitted block ({row_block},{col_block},{depth_block}) "
-              f"to aggregator for job {job_id}")
+        metrics.completed += 1
 
         return {
-            "message": "Block computed and submitted",
+            "message": "Block computed and queued for the aggregator",
             "job_id": job_id,
             "block_position": (row_block, col_block, depth_block),
             "result_shape": result_block.shape,
             "compute_time_sec": compute_time
         }
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        metrics.failed += 1
+        print(f"❌ Worker error for block ({meta.get('row_block')},{meta.get('col_block')},"
+              f"{meta.get('depth_block')}): {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        metrics.in_flight -= 1
+
+
+def batch_matmul(As, Bs):
+    """Multiply equally shaped block pairs with one stacked matmul."""
+    if any(is_sparse(block) for block in As + Bs):
+        return [A @ B for A, B in zip(As, Bs)]
+    return np.matmul(np.stack(As), np.stack(Bs))
+
+
+@app.post("/multiply_batch")
+async def multiply_batch(request: Request):
+    """
+    Compute many small partial products from one request.
+
+    The frame meta holds aggregator_url, cacheable and a list of tasks,
+    each with job_id, row_block, col_block, depth_block, A_ref and B_ref.
+    The frame arrays are keyed by ref, so an operand shared by several
+    tasks in the batch is sent once. Refs that are neither attached nor
+    cached are answered with 409 and {"missing": [refs]}. Operands are only
+    kept in the operand cache if the batch is cacheable (refs are content
+    hashes rather than block coordinates).
+
+    Tasks with the same operand shapes and dtypes are computed with one
+    stacked matmul, and every result is queued for the aggregator.
+    """
+    metrics.in_flight += 1
+    try:
+        try:
+            meta, arrays = decode_frame(await request.body())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Malformed batch frame: {e}")
+        return await run_batch(meta, arrays)
+
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Worker error for block ({row_block},{col_block},{depth_block}): {e}")
+        metrics.failed += 1
+        print(f"❌ Worker error for batch: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        metrics.in_flight -= 1
+
+
+async def run_batch(meta, arrays):
+    """
+    Resolve, compute and submit the tasks of a batch frame (from
+    /multiply_batch or a lease). Raises HTTPException for malformed
+    batches and missing operands.
+    """
+    try:
+        tasks = meta["tasks"]
+        aggregator_url = meta["aggregator_url"]
+        cacheable = bool(meta.get("cacheable", False))
+        refs = {ref for task in tasks for ref in (task["A_ref"], task["B_ref"])}
+    except (KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed batch frame: {e}")
+
+    missing, operands = [], {}
+    for ref in refs:
+        if ref in arrays:
+            operands[ref] = arrays[ref]
+            if cacheable:
+                operand_cache.put(ref, arrays[ref])
+        else:
+            block = operand_cache.get(ref) if cacheable else None
+            if block is None:
+                missing.append(ref)
+            operands[ref] = block
+    if missing:
+        raise HTTPException(status_code=409, detail={"missing": missing})
+
+    groups = {}
+    for task in tasks:
+        A_block, B_block = operands[task["A_ref"]], operands[task["B_ref"]]
+        if A_block.shape[1] != B_block.shape[0]:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Incompatible block dimensions: "
+                       f"A{A_block.shape} × B{B_block.shape}"
+            )
+        key = (A_block.shape, B_block.shape, A_block.dtype.str, B_block.dtype.str)
+        groups.setdefault(key, []).append((task, A_block, B_block))
+
+    loop = asyncio.get_running_loop()
+    total_time = 0.0
+    for group in groups.values():
+        results, compute_time = await loop.run_in_executor(
+            compute_pool, metrics.compute, time.perf_counter(), batch_matmul,
+            [A for _, A, _ in group], [B for _, _, B in group]
+        )
+        total_time += compute_time
+        for (task, _, _), result_block in zip(group, results):
+            await submitter.submit(
+                aggregator_url,
+                {
+                    "job_id": task["job_id"],
+                    "row_block": task["row_block"],
+                    "col_block": task["col_block"],
+                    "depth_block": task["depth_block"],
+                    "worker_time_sec": compute_time / len(group)
+                },
+                result_block
+            )
+        metrics.completed += len(group)
+
+    print(f"✅ Computed batch of {len(tasks)} blocks in {len(groups)} stacked "
+          f"matmul(s) in {total_time:.4f}s")
+
+    return {
+        "message": "Batch computed and queued for the aggregator",
+        "blocks": len(tasks),
+        "groups": len(groups),
+        "compute_time_sec": total_time
+    }
+
+
+def summa_key(meta):
+    # A tile the splitter has to redo from scratch comes with a new round
+    return (meta["job_id"], meta["row_block"], meta["col_block"], meta.get("round", 0))
+
+
+@app.post("/summa/step")
+async def summa_step(request: Request):
+    """
+    One SUMMA step for the C tile this worker owns: add A_panel × B_panel
+    into the local accumulator.
+
+    The frame meta holds job_id, row_block, col_block (the worker's grid
+    position), round, step and shape/dtype of the local C tile, with arrays "A"
+    (this grid row's slice of A panel `step`) and "B" (this grid column's
+    slice of B panel `step`). A repeated step is acknowledged but not
+    added again.
+    """
+    metrics.in_flight += 1
+    try:
+        try:
+            meta, arrays = decode_frame(await request.body())
+            key, step = summa_key(meta), meta["step"]
+            shape, dtype = tuple(meta["shape"]), np.dtype(meta["dtype"])
+            A_panel, B_panel = arrays["A"], arrays["B"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=f"Malformed SUMMA frame: {e}")
+
+        if A_panel.shape[1] != B_panel.shape[0] or (A_panel.shape[0], B_panel.shape[1]) != shape:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Panels A{A_panel.shape} × B{B_panel.shape} do not match tile {shape}"
+            )
+
+        product, compute_time = await asyncio.get_running_loop().run_in_executor(
+            compute_pool, metrics.compute, time.perf_counter(), np.matmul, A_panel, B_panel
+        )
+        added = await asyncio.to_thread(summa_tiles.add, key, step, shape, dtype, product)
+        return {"job_id": key[0], "step": step, "added": added, "compute_time_sec": compute_time}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        metrics.failed += 1
+        print(f"❌ Worker error for SUMMA step: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        metrics.in_flight -= 1
+
+
+@app.post("/summa/finish")
+async def summa_finish(request: Request):
+    """
+    Submit the finished C tile of a SUMMA job to the aggregator.
+
+    The JSON body holds job_id, row_block, col_block, round, steps (the
+    number of steps the tile needs) and aggregator_url. Answers 409 with
+    {"missing_steps": [...]} if some steps never arrived, so the splitter
+    can resend them.
+    """
+    meta = await request.json()
+    try:
+        key, steps, aggregator_url = summa_key(meta), meta["steps"], meta["aggregator_url"]
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Missing field {e}")
+
+    missing = summa_tiles.missing(key, steps)
+    if missing:
+        raise HTTPException(status_code=409, detail={"missing_steps": missing})
+
+    tile = summa_tiles.pop(key)
+    if tile is None:
+        # Finished already (a retried request); the aggregator has the tile
+        return {"job_id": key[0], "message": "Tile already submitted"}
+
+    await submitter.submit(
+        aggregator_url,
+        {
+            "job_id": key[0],
+            "row_block": key[1],
+            "col_block": key[2],
+            "depth_block": 0,
+            "worker_time_sec": 0.0
+        },
+        tile
+    )
+    metrics.completed += 1
+    print(f"✅ SUMMA tile ({key[1]},{key[2]}) of job {key[0]} queued for the aggregator")
+    return {"job_id": key[0], "message": "Tile queued for the aggregator"}
+
+
+@app.get("/metrics")
+def worker_metrics():
+    return {**metrics.snapshot(), "submitter": submitter.stats(), "summa": summa_tiles.stats()}
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return operand_cache.stats()
 
 
 @app.get("/health")